@@ -1,14 +1,19 @@
 """Generate unique job id and S3 tokens for each job."""
 
 from datetime import datetime
+from hashlib import sha256
+from hmac import new as hmac_new
+from math import ceil
 from logging import getLevelName, getLogger, Formatter, INFO
 from os import getenv
 from random import choices
+from re import compile as re_compile
 from string import ascii_lowercase, digits
-from typing import List
-from boto3 import client
-from botocore.exceptions import ClientError
+from typing import Dict, List, Optional
+from urllib.parse import quote, urlsplit
+from botocore.exceptions import ClientError, NoCredentialsError
 from dateutil.tz import UTC
+from .aws_clients import get_client, get_frozen_credentials
 
 
 def apbs_logger():
@@ -35,58 +40,299 @@ def apbs_logger():
 
 _LOGGER = apbs_logger()
 
+PRESIGNED_URL_EXPIRATION = 3600
+SIGV4_ALGORITHM = "AWS4-HMAC-SHA256"
+# Declared file sizes above this get a multipart upload plan
+MULTIPART_THRESHOLD = int(getenv("MULTIPART_THRESHOLD", 100 * 1024 * 1024))
+MULTIPART_PART_SIZE = int(getenv("MULTIPART_PART_SIZE", 16 * 1024 * 1024))
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+S3_MAX_OBJECT_SIZE = 5 * 1024**4
+# Declared file sizes above this are rejected
+MAX_FILE_SIZE = min(
+    int(getenv("MAX_FILE_SIZE", 100 * 1024**3)), S3_MAX_OBJECT_SIZE
+)
+# Upload plans use larger parts rather than presign more URLs than this
+MAX_PLAN_PARTS = min(int(getenv("MAX_PLAN_PARTS", 1000)), S3_MAX_PARTS)
+# Buckets that can be addressed as "{bucket}.{s3 endpoint}" over HTTPS
+_VIRTUAL_HOST_BUCKET = re_compile(r"^[a-z0-9][a-z0-9-]{1,61}[a-z0-9]$")
 
-def create_s3_url(bucket_name: str, job_tag: str, file_name: str) -> str:
-    """Create an URL that will allow a file to be stored on an S3 bucket.
+
+def _hmac_sha256(key: bytes, message: str) -> bytes:
+    return hmac_new(key, message.encode("utf-8"), sha256).digest()
+
+
+class BatchPresigner:
+    """Presign many S3 PUT URLs for one bucket with a single signing key.
+
+    botocore re-resolves credentials and re-derives the SigV4 signing key
+    for every presigned URL. Here both are done once, when the presigner is
+    built, and each key then only costs one canonical request and one HMAC.
+    URLs are query-string signed (SigV4, UNSIGNED-PAYLOAD), like those of
+    botocore's generate_presigned_url().
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        expires_in: int = PRESIGNED_URL_EXPIRATION,
+        signing_time: Optional[datetime] = None,
+    ):
+        """
+        Args:
+            bucket_name (str): AWS S3 bucket the URLs upload to
+            expires_in (int): Number of seconds the URLs stay valid
+            signing_time (Optional[datetime]): Time to sign at (default: now)
+        Raises:
+            NoCredentialsError: No AWS credentials could be resolved
+        """
+        credentials = get_frozen_credentials()
+        if credentials is None:
+            raise NoCredentialsError()
+
+        s3_client = get_client("s3")
+        region = s3_client.meta.region_name
+        if signing_time is None:
+            signing_time = datetime.now(UTC)
+        date_stamp = signing_time.strftime("%Y%m%d")
+        credential_scope = f"{date_stamp}/{region}/s3/aws4_request"
+
+        # Derive the signing key once for every URL in the batch
+        signing_key = _hmac_sha256(
+            f"AWS4{credentials.secret_key}".encode("utf-8"), date_stamp
+        )
+        for scope_part in (region, "s3", "aws4_request"):
+            signing_key = _hmac_sha256(signing_key, scope_part)
+        self._signing_key = signing_key
+
+        endpoint = urlsplit(s3_client.meta.endpoint_url)
+        self._scheme = endpoint.scheme
+        if _VIRTUAL_HOST_BUCKET.match(bucket_name):
+            self._host = f"{bucket_name}.{endpoint.netloc}"
+            self._path_prefix = ""
+        else:
+            self._host = endpoint.netloc
+            self._path_prefix = f"/{bucket_name}"
+
+        self.bucket_name = bucket_name
+        self._amz_date = signing_time.strftime("%Y%m%dT%H%M%SZ")
+        self._credential_scope = credential_scope
+
+        self._query = {
+            "X-Amz-Algorithm": SIGV4_ALGORITHM,
+            "X-Amz-Credential": (
+                f"{credentials.access_key}/{credential_scope}"
+            ),
+            "X-Amz-Date": self._amz_date,
+            "X-Amz-Expires": str(expires_in),
+            "X-Amz-SignedHeaders": "host",
+        }
+        if credentials.token:
+            self._query["X-Amz-Security-Token"] = credentials.token
+
+    def presign(
+        self,
+        http_method: str,
+        object_name: str,
+        params: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """Create a presigned URL for one request on an object.
+
+        Args:
+            http_method (str): The HTTP method of the request (e.g. "PUT")
+            object_name (str): The S3 object key the request acts on
+            params (Optional[Dict[str, str]]): Extra query string parameters
+                (e.g. "partNumber" and "uploadId" for a multipart upload)
+        Returns:
+            str: A URL that can be used to make the request
+        """
+        query = dict(self._query)
+        if params:
+            query.update(params)
+        canonical_query = "&".join(
+            f"{quote(name, safe='')}={quote(value, safe='')}"
+            for name, value in sorted(query.items())
+        )
+        canonical_uri = quote(f"{self._path_prefix}/{object_name}", safe="/")
+        canonical_request = "\n".join(
+            (
+                http_method,
+                canonical_uri,
+                canonical_query,
+                f"host:{self._host}",
+                "",
+                "host",
+                "UNSIGNED-PAYLOAD",
+            )
+        )
+        string_to_sign = "\n".join(
+            (
+                SIGV4_ALGORITHM,
+                self._amz_date,
+                self._credential_scope,
+                sha256(canonical_request.encode("utf-8")).hexdigest(),
+            )
+        )
+        signature = hmac_new(
+            self._signing_key, string_to_sign.encode("utf-8"), sha256
+        ).hexdigest()
+        return (
+            f"{self._scheme}://{self._host}{canonical_uri}"
+            f"?{canonical_query}&X-Amz-Signature={signature}"
+        )
+
+    def presign_put(self, object_name: str) -> str:
+        """Create a presigned PUT URL for one object.
+
+        Args:
+            object_name (str): The S3 object key to upload to
+        Returns:
+            str: A URL that can be used to upload the object
+        """
+        return self.presign("PUT", object_name)
+
+    def presign_multipart_upload(
+        self, object_name: str, upload_id: str, file_size: int
+    ) -> dict:
+        """Presign every request needed to finish a multipart upload.
+
+        Args:
+            object_name (str): The S3 object key being uploaded
+            upload_id (str): The UploadId from CreateMultipartUpload
+            file_size (int): The declared size of the file, in bytes
+        Returns:
+            dict: The upload plan, with the part size, a URL for each part
+                and the URLs to complete or abort the upload
+        """
+        part_size = max(
+            MULTIPART_PART_SIZE,
+            S3_MIN_PART_SIZE,
+            ceil(file_size / MAX_PLAN_PARTS),
+        )
+        part_count = max(1, ceil(file_size / part_size))
+        upload_params = {"uploadId": upload_id}
+        return {
+            "upload_id": upload_id,
+            "part_size": part_size,
+            "parts": [
+                {
+                    "part_number": part_number,
+                    "url": self.presign(
+                        "PUT",
+                        object_name,
+                        {"partNumber": str(part_number), **upload_params},
+                    ),
+                }
+                for part_number in range(1, part_count + 1)
+            ],
+            "complete_url": self.presign("POST", object_name, upload_params),
+            "abort_url": self.presign("DELETE", object_name, upload_params),
+        }
+
+    def presign_put_urls(
+        self, job_tag: str, file_list: List[str]
+    ) -> Dict[str, str]:
+        """Create presigned PUT URLs for every file of a job.
+
+        Args:
+            job_tag (str): the directory in the bucket
+            file_list (List[str]): the filenames to put under job_tag
+        Returns:
+            Dict[str, str]: A URL for each filename in file_list
+        """
+        return {
+            file_name: self.presign_put(f"{job_tag}/{file_name}")
+            for file_name in file_list
+        }
+
+
+def create_multipart_upload_plan(
+    presigner: BatchPresigner, job_tag: str, file_name: str, file_size: int
+) -> Optional[dict]:
+    """Start a multipart upload and presign the requests to finish it.
 
     Args:
-        bucket_name str: AWS S3 bucket to store file in
-        job_tag str: the directory in the bucket_name
+        presigner (BatchPresigner): The presigner for the input bucket
+        job_tag str: the directory in the bucket
         file_name str: the filename to put under the job_tag directory
+        file_size int: the declared size of the file, in bytes
     Returns:
-        url (str): A URL that can be used to upload a file to the S3 bucket
+        Optional[dict]: The multipart upload plan, or None if the upload
+            could not be started
     """
-
     object_name = f"{job_tag}/{file_name}"
-    url = ""
     try:
-        # Generate presigned URL for file
-        url = client("s3").generate_presigned_url(
-            "put_object",
-            Params={
-                "Bucket": bucket_name,
-                "Key": object_name,
-            },
-            ExpiresIn=3600,
-            HttpMethod="PUT",
-        )
-    except (ClientError) as err:
+        upload_id: str = get_client("s3").create_multipart_upload(
+            Bucket=presigner.bucket_name,
+            Key=object_name,
+        )["UploadId"]
+    except ClientError as err:
         _LOGGER.exception(
-            "%s Unable to create presigned URL for %s/%s: %s",
+            "%s Unable to create multipart upload for %s/%s: %s",
             job_tag,
-            bucket_name,
+            presigner.bucket_name,
             object_name,
             err,
         )
-    return url
+        return None
+    return presigner.presign_multipart_upload(
+        object_name, upload_id, file_size
+    )
+
+
+def validate_file_sizes(file_sizes) -> Optional[str]:
+    """Check the file sizes declared in a token request.
+
+    Args:
+        file_sizes: The "file_sizes" value of the request
+    Returns:
+        Optional[str]: Why the sizes are invalid, or None if they are valid
+    """
+    if not isinstance(file_sizes, dict):
+        return "file_sizes must map file names to sizes in bytes"
+    for file_name, file_size in file_sizes.items():
+        # bool is a subclass of int, but never a file size
+        if not isinstance(file_size, int) or isinstance(file_size, bool):
+            return f"Size of {file_name} must be an integer number of bytes"
+        if file_size < 0:
+            return f"Size of {file_name} must not be negative"
+        if file_size > MAX_FILE_SIZE:
+            return (
+                f"Size of {file_name} ({file_size} bytes) is above the "
+                f"maximum of {MAX_FILE_SIZE} bytes"
+            )
+    return None
 
 
 def generate_id_and_tokens(event: dict, context) -> dict:
     # pylint: disable=unused-argument
     """Generate an unique job id and S3 auth tokens.
 
+    Files whose size is declared in event["file_sizes"] and is above
+    MULTIPART_THRESHOLD also get a multipart upload plan, so their parts
+    can be uploaded in parallel and retried one at a time. Sizes that are
+    not integers, are negative or are above MAX_FILE_SIZE are rejected.
+
     Args:
         event (dict): A dictionary of terms.
         context: Required by AWS Lambda
     Returns:
-        URLs (dict): A dictionary of URLs and filenames
+        URLs (dict): A dictionary of URLs and filenames, or a dictionary
+            with a 400 "statusCode" and an "error" if the request is invalid
     """
 
     # Assign object variables from Lambda event
     bucket_name: str = getenv("INPUT_BUCKET", "TEST_BUCKET")
     file_list: List[str] = event["file_list"]
+    file_sizes: Dict[str, int] = event.get("file_sizes", {})
     job_id: str
 
+    # Reject bad sizes before any multipart upload is started
+    size_error = validate_file_sizes(file_sizes)
+    if size_error is not None:
+        _LOGGER.warning("Invalid token request: %s", size_error)
+        return {"statusCode": 400, "error": size_error}
+
     # Generate new job ID if not provided
     if "job_id" in event:
         job_id = event["job_id"]
@@ -94,13 +340,31 @@ def generate_id_and_tokens(event: dict, context) -> dict:
         # Random 10-character alphanumeric string
         job_id = "".join(choices(ascii_lowercase + digits, k=10))
 
-    # Create URLs with S3 tokens
-    url_dict = {}
+    # Create URLs with S3 tokens, signing every file in one pass
     current_date = datetime.now(UTC).strftime("%Y-%m-%d")
     job_tag = f"{current_date}/{job_id}"
-    for file_name in file_list:
-        # Generate presigned URL for file
-        url_dict[file_name] = create_s3_url(bucket_name, job_tag, file_name)
+    url_dict: Dict[str, str]
+    multipart_dict: Dict[str, dict] = {}
+    try:
+        presigner = BatchPresigner(bucket_name)
+        url_dict = presigner.presign_put_urls(job_tag, file_list)
+        for file_name in file_list:
+            file_size = file_sizes.get(file_name, 0)
+            if file_size > MULTIPART_THRESHOLD:
+                upload_plan = create_multipart_upload_plan(
+                    presigner, job_tag, file_name, file_size
+                )
+                if upload_plan is not None:
+                    multipart_dict[file_name] = upload_plan
+    except NoCredentialsError as err:
+        _LOGGER.exception(
+            "%s Unable to create presigned URLs for %s/%s: %s",
+            job_tag,
+            bucket_name,
+            job_tag,
+            err,
+        )
+        url_dict = {file_name: "" for file_name in file_list}
 
     _LOGGER.info(
         "%s Created URL for %s/%s: %s",
@@ -116,4 +380,5 @@ def generate_id_and_tokens(event: dict, context) -> dict:
         "job_id": job_id,
         "job_tag": job_tag,
         "urls": url_dict,
+        "multipart": multipart_dict,
     }
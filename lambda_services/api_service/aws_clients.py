@@ -0,0 +1,77 @@
+"""A registry of pooled boto3 clients shared across warm invocations."""
+
+from os import getenv
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from boto3.session import Session
+from botocore.config import Config
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(getenv("AWS_MAX_POOL_CONNECTIONS", "50")),
+    retries={
+        "max_attempts": int(getenv("AWS_MAX_ATTEMPTS", "5")),
+        "mode": getenv("AWS_RETRY_MODE", "adaptive"),
+    },
+    tcp_keepalive=True,
+)
+
+_CLIENTS: Dict[Tuple[str, Optional[str]], object] = {}
+_CLIENTS_LOCK = Lock()
+_SESSION: Optional[Session] = None
+
+
+def get_client(service_name: str, region_name: Optional[str] = None):
+    """Return a pooled boto3 client, creating it on first use.
+
+    Clients are created lazily, once per (service, region) pair, and reused
+    by every later call in the same process. boto3 clients are thread-safe
+    once built, but building them is not, so creation happens under a lock.
+
+    Args:
+        service_name (str): The AWS service name (e.g. "s3", "sqs")
+        region_name (Optional[str]): The AWS region; default region if None
+    Returns:
+        botocore.client.BaseClient: The shared client for the service
+    """
+    global _SESSION
+    key = (service_name, region_name)
+    service_client = _CLIENTS.get(key)
+    if service_client is not None:
+        return service_client
+
+    with _CLIENTS_LOCK:
+        service_client = _CLIENTS.get(key)
+        if service_client is None:
+            if _SESSION is None:
+                _SESSION = Session()
+            service_client = _SESSION.client(
+                service_name, region_name=region_name, config=CLIENT_CONFIG
+            )
+            _CLIENTS[key] = service_client
+    return service_client
+
+
+def get_frozen_credentials():
+    """Resolve the shared session's credentials once, as a snapshot.
+
+    Returns:
+        Optional[ReadOnlyCredentials]: The access key, secret key and token,
+            or None if no credentials could be found
+    """
+    global _SESSION
+    with _CLIENTS_LOCK:
+        if _SESSION is None:
+            _SESSION = Session()
+        credentials = _SESSION.get_credentials()
+    if credentials is None:
+        return None
+    return credentials.get_frozen_credentials()
+
+
+def reset_clients():
+    """Drop every cached client (e.g. after credentials change)."""
+    global _SESSION
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+        _SESSION = None
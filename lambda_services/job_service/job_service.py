@@ -1,14 +1,19 @@
 """Interpret APBS/PDBP2QR job configurations and submit to SQS."""
 
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
+from copy import deepcopy
 from json import dumps, loads, JSONDecodeError
+from math import ceil, inf
 from os import getenv
 from time import time
-from boto3 import client, resource
+from typing import Callable, Dict, List, Optional, Tuple
 
 # from urllib3 import PoolManager
 from botocore.exceptions import ClientError
-from .launcher import pdb2pqr_runner, apbs_runner
+from .launcher import estimator, pdb2pqr_runner, apbs_runner, result_cache
+from .launcher.aws_clients import get_client
 from .launcher.jobsetup import MissingFilesError
+from .launcher.ttl_cache import TTLCache
 from .launcher.utils import _LOGGER
 
 OUTPUT_BUCKET = getenv("OUTPUT_BUCKET")
@@ -19,6 +24,34 @@ VERSION_KEY = getenv("VERSION_KEY")
 SQS_QUEUE_NAME = getenv("JOB_QUEUE_NAME")
 JOB_QUEUE_REGION = getenv("JOB_QUEUE_REGION", "us-west-2")
 JOB_MAX_RUNTIME = int(getenv("JOB_MAX_RUNTIME", 2000))
+# Queues ("lanes") for jobs of different sizes, tried in order, e.g.
+#   [{"name": "small", "queue": "apbs-job-q-small", "job_types": ["pdb2pqr"],
+#     "max_runtime": 900, "max_memory_mb": 4096}]
+# Every given criterion must hold; the size limits only apply to jobs with
+# an estimate. Jobs that fit no lane go to JOB_QUEUE_NAME.
+JOB_QUEUE_LANES: List[dict] = loads(getenv("JOB_QUEUE_LANES", "[]"))
+DEFAULT_LANE = "default"
+# Version info and queue URLs only change on deployment
+CACHE_TTL_SECONDS = int(getenv("CACHE_TTL_SECONDS", 300))
+# Number of S3 event records prepared at once
+SUBMISSION_THREADS = int(getenv("SUBMISSION_THREADS", 8))
+# Number of independent S3/SQS requests (prefetches, lookups, status
+#   uploads) in flight at once, on top of the records being prepared
+SUBMISSION_IO_THREADS = int(getenv("SUBMISSION_IO_THREADS", 16))
+# SQS accepts at most 10 entries per SendMessageBatch call
+SQS_BATCH_SIZE = 10
+# Days to reuse the results of identical jobs (0 disables the cache)
+RESULT_CACHE_DAYS = float(getenv("RESULT_CACHE_DAYS", 0))
+# Location of the runtime/memory estimator model (unset disables it)
+ESTIMATOR_BUCKET = getenv("ESTIMATOR_BUCKET")
+ESTIMATOR_KEY = getenv("ESTIMATOR_KEY")
+# Jobs predicted to need more than this are rejected
+JOB_MEMORY_LIMIT_MB = int(getenv("JOB_MEMORY_LIMIT_MB", 15 * 1024))
+JOB_RUNTIME_LIMIT = int(getenv("JOB_RUNTIME_LIMIT", 86400))
+
+_VERSION_INFO_CACHE = TTLCache(CACHE_TTL_SECONDS)
+_QUEUE_URL_CACHE = TTLCache(CACHE_TTL_SECONDS)
+_ESTIMATOR_CACHE = TTLCache(CACHE_TTL_SECONDS)
 
 
 def get_s3_object_json(job_tag: str, bucket_name: str, object_name: str):
@@ -33,7 +66,7 @@ def get_s3_object_json(job_tag: str, bucket_name: str, object_name: str):
     # Download job info object from S3
     object_response = {}
     try:
-        object_response = client("s3").get_object(
+        object_response = get_client("s3").get_object(
             Bucket=bucket_name,
             Key=object_name,
         )
@@ -92,25 +125,108 @@ def get_version_info(job_tag: str) -> dict:
     """Download the current version information from AWS S3, returning a
     dictionary with its contents
 
+    The contents are cached for CACHE_TTL_SECONDS across invocations.
+
     :param job_tag str: Unique ID for this job
     :return: a dictionary containing version information retrieved from S3
     :rtype: dict
     """
-    # Download version info object from S3 via URL
-    _LOGGER.debug(
-        "%s Downloading version file: %s/%s",
-        job_tag,
-        VERSION_BUCKET,
-        VERSION_KEY,
-    )
-    version_info: dict = get_s3_object_json(
-        job_tag, VERSION_BUCKET, VERSION_KEY
+
+    def download_version_info() -> dict:
+        # Download version info object from S3 via URL
+        _LOGGER.debug(
+            "%s Downloading version file: %s/%s",
+            job_tag,
+            VERSION_BUCKET,
+            VERSION_KEY,
+        )
+        return get_s3_object_json(job_tag, VERSION_BUCKET, VERSION_KEY)
+
+    version_info: dict = deepcopy(
+        _VERSION_INFO_CACHE.get(
+            (VERSION_BUCKET, VERSION_KEY), download_version_info
+        )
     )
 
     _LOGGER.debug("%s Current version info: %s", job_tag, version_info)
     return version_info
 
 
+def get_queue_url(queue_name: str, region_name: str) -> str:
+    """Get the URL of an SQS queue, cached for CACHE_TTL_SECONDS.
+
+    :param queue_name str: Name of the SQS queue
+    :param region_name str: AWS region of the SQS queue
+    :return: The URL of the queue
+    :rtype: str
+    """
+    return _QUEUE_URL_CACHE.get(
+        (queue_name, region_name),
+        lambda: get_client("sqs", region_name).get_queue_url(
+            QueueName=queue_name
+        )["QueueUrl"],
+    )
+
+
+def get_estimator_model(job_tag: str) -> Optional[dict]:
+    """Download the runtime/memory estimator model, cached like versions.
+
+    :param job_tag str: Unique ID for this job
+    :return: The model, or None if there is none
+    :rtype: Optional[dict]
+    """
+
+    def download_model() -> Optional[dict]:
+        try:
+            return get_s3_object_json(job_tag, ESTIMATOR_BUCKET, ESTIMATOR_KEY)
+        except ClientError:
+            return None
+
+    return _ESTIMATOR_CACHE.get(
+        (ESTIMATOR_BUCKET, ESTIMATOR_KEY), download_model
+    )
+
+
+def invalidate_caches():
+    """Forget cached version info, queue URLs and estimator model."""
+    _VERSION_INFO_CACHE.invalidate()
+    _QUEUE_URL_CACHE.invalidate()
+    _ESTIMATOR_CACHE.invalidate()
+
+
+def choose_lane(job_type: str, estimate: Optional[estimator.Estimate]) -> str:
+    """Choose the queue lane for a job from its type and predicted cost.
+
+    :param job_type str: Name of job type (e.g. 'apbs', 'pdb2pqr')
+    :param estimate Optional[Estimate]: Predicted resources, if known
+    :return: The name of the first lane the job fits, or DEFAULT_LANE
+    :rtype: str
+    """
+    for lane in JOB_QUEUE_LANES:
+        if job_type not in lane.get("job_types", [job_type]):
+            continue
+        if estimate is not None and (
+            estimate.runtime_seconds > lane.get("max_runtime", inf)
+            or estimate.memory_mb > lane.get("max_memory_mb", inf)
+        ):
+            continue
+        return lane["name"]
+    return DEFAULT_LANE
+
+
+def get_lane_queue_name(lane_name: Optional[str]) -> str:
+    """Get the name of the SQS queue of a lane.
+
+    :param lane_name str: Name of the lane, from choose_lane()
+    :return: The queue name, JOB_QUEUE_NAME for the default lane
+    :rtype: str
+    """
+    for lane in JOB_QUEUE_LANES:
+        if lane["name"] == lane_name:
+            return lane["queue"]
+    return SQS_QUEUE_NAME
+
+
 def build_status_dict(
     job_id: str,
     job_tag: str,
@@ -153,9 +269,9 @@ def build_status_dict(
         "metadata": {"versions": get_version_info(job_tag)},
     }
 
-    # if message is not None:
-    if status == "invalid":
+    if message is not None:
         initial_status_dict[job_type]["message"] = message
+    if status == "invalid":
         initial_status_dict[job_type]["startTime"] = None
         initial_status_dict[job_type]["subtasks"] = None
         initial_status_dict[job_type]["inputFiles"] = None
@@ -165,43 +281,135 @@ def build_status_dict(
     return initial_status_dict
 
 
-def upload_status_file(object_filename: str, initial_status_dict: dict):
+def upload_status_file(
+    object_filename: str,
+    initial_status_dict: dict,
+    etag: Optional[str] = None,
+) -> str:
     """Upload the initial status object to S3
 
+    The object is only created, so that a retried S3 event can't reset the
+    status of a job that already ran; given an ETag, it is only replaced if
+    it is unchanged.
+
     :param object_filename str: the S3 object key of the file to download
     :param initial_status_dict dict: a JSON-compatible dictionary containing
                                      initial status info of the job
+    :param etag Optional[str]: ETag of the status object being replaced
+    :return: The ETag of the uploaded status object
+    :rtype: str
+    :raises ClientError: PreconditionFailed if the object exists (or, given
+                         an ETag, changed)
     """
     # TODO: 2021/03/02, Elvis - add submission time to initial status
     # TODO: 2021/03/25, Elvis - Reconstruct format of status since
     #                           they're constructed on a per-job basis
 
-    s3_client = client("s3")
-    s3_client.put_object(
+    s3_client = get_client("s3")
+    condition = {"IfNoneMatch": "*"} if etag is None else {"IfMatch": etag}
+    s3_response: dict = s3_client.put_object(
         Body=dumps(initial_status_dict),
         Bucket=OUTPUT_BUCKET,
         Key=object_filename,
+        **condition,
     )
+    return s3_response["ETag"]
 
 
-def interpret_job_submission(event: dict, context):
-    # pylint: disable=unused-argument
-    """Interpret contents of job configuration, triggered from S3 event.
+def get_existing_status(object_filename: str) -> Tuple[str, str]:
+    """Get the status of a job from its existing status object.
 
-    :param event dict: Amazon S3 event, containing info to retrieve contents
-    :param context: context object for AWS Lambda handler, containing info
-                    about the invocation, function, and execution environment
+    :param object_filename str: the S3 object key of the status file
+    :return: The job's status (e.g. 'pending') and the object's ETag
+    :rtype: Tuple[str, str]
     """
+    s3_client = get_client("s3")
+    s3_response: dict = s3_client.get_object(
+        Bucket=OUTPUT_BUCKET, Key=object_filename
+    )
+    status_dict: dict = loads(s3_response["Body"].read())
+    return status_dict[status_dict["jobtype"]]["status"], s3_response["ETag"]
+
+
+def _is_precondition_failure(err: Exception) -> bool:
+    """Check whether a conditional S3 write was refused."""
+    return isinstance(err, ClientError) and err.response["Error"]["Code"] in (
+        "PreconditionFailed",
+        "ConditionalRequestConflict",
+    )
+
+
+def _start(executor: Optional[Executor], func: Callable, *args) -> Future:
+    """Run func on the executor, or right away if there is none."""
+    if executor is not None:
+        return executor.submit(func, *args)
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as err:  # pylint: disable=broad-except
+        future.set_exception(err)
+    return future
+
+
+def find_cached_result(
+    job_runner, job_type: str, bucket_name: str, versions: dict
+) -> Tuple[Optional[str], Optional[dict]]:
+    """Look up the result cache for a prepared job.
 
-    # Get basic job information from S3 event
-    #   TODO: will need to modify to correctly retrieve info
-    jobinfo_object_name: str = event["Records"][0]["s3"]["object"]["key"]
-    bucket_name: str = event["Records"][0]["s3"]["bucket"]["name"]
+    :param job_runner JobSetup: A runner whose prepare_job() has been called
+    :param job_type str: Name of job type (e.g. 'apbs', 'pdb2pqr')
+    :param bucket_name str: AWS S3 bucket holding the input files
+    :param versions dict: Version info, as returned by get_version_info()
+    :return: The cache key (None if uncacheable) and the manifest of a
+             finished identical job (None on a miss)
+    :rtype: Tuple[Optional[str], Optional[dict]]
+    """
+    cache_key = result_cache.compute_cache_key(
+        job_runner, job_type, bucket_name, versions
+    )
+    if cache_key is None:
+        return None, None
+    manifest = result_cache.lookup_result(
+        job_runner.job_tag, bucket_name, cache_key, RESULT_CACHE_DAYS * 86400
+    )
+    return cache_key, manifest
+
+
+def parse_job_object_name(jobinfo_object_name: str) -> Tuple[str, str, str]:
+    """Get the date, ID and type of a job from its job file's S3 key.
+
+    :param jobinfo_object_name str: e.g. '2021-05-16/sampleId/apbs-job.json'
+    :return: The job date, job ID and job type
+    :rtype: Tuple[str, str, str]
+    """
     job_id, jobinfo_filename = jobinfo_object_name.split("/")[-2:]
     job_date: str = jobinfo_object_name.split("/")[0]
-    job_tag = f"{job_date}/{job_id}"
     # Assumes 'pdb2pqr-job.json', or similar format
     job_type = jobinfo_filename.split("-")[0]
+    return job_date, job_id, job_type
+
+
+def prepare_job_submission(
+    record: dict, executor: Optional[Executor] = None
+) -> Tuple[str, dict, Optional[dict]]:
+    """Interpret one job configuration and build its initial status.
+
+    Independent lookups (result cache, job features) run concurrently on
+    the executor if one is given. The status is not uploaded here, so that
+    the caller can upload it while the job is being enqueued.
+
+    :param record dict: A single record of an Amazon S3 event
+    :param executor Optional[Executor]: Runs the independent lookups
+    :return: The status object name, the initial status, and the SQS
+             message body for the job (None if it is not queued)
+    :rtype: Tuple[str, dict, Optional[dict]]
+    """
+
+    # Get basic job information from S3 event record
+    jobinfo_object_name: str = record["s3"]["object"]["key"]
+    bucket_name: str = record["s3"]["bucket"]["name"]
+    job_date, job_id, job_type = parse_job_object_name(jobinfo_object_name)
+    job_tag = f"{job_date}/{job_id}"
 
     input_files = None
     output_files = None
@@ -209,9 +417,11 @@ def interpret_job_submission(event: dict, context):
     message = None
     status = "pending"
     timeout_seconds = None
+    fetch_start = time()
     job_info_form = get_job_info(job_tag, bucket_name, jobinfo_object_name)[
         "form"
     ]
+    prepare_start = time()
     _LOGGER.info("%s Preparing %s job execution", job_tag, job_type.upper())
     if job_type in "pdb2pqr":
         # If PDB2PQR:
@@ -249,36 +459,517 @@ def interpret_job_submission(event: dict, context):
         output_files = job_runner.output_files
         timeout_seconds = job_runner.estimated_max_runtime
 
-    # Create and upload status file to S3
+    # Look up the result cache and extract the job's features at once;
+    #   both read the same listing of the job's input files
+    cache_future = None
+    features_future = None
+    if status == "pending" and (RESULT_CACHE_DAYS > 0 or ESTIMATOR_KEY):
+        job_runner.input_index(bucket_name)
+        if RESULT_CACHE_DAYS > 0:
+            cache_future = _start(
+                executor,
+                find_cached_result,
+                job_runner,
+                job_type,
+                bucket_name,
+                get_version_info(job_tag),
+            )
+        if ESTIMATOR_KEY:
+            features_future = _start(
+                executor,
+                estimator.extract_features,
+                job_type,
+                job_runner,
+                bucket_name,
+            )
+
+    # Reuse the outputs of an identical job instead of running it again
+    cache_key = None
+    if cache_future is not None:
+        cache_key, manifest = cache_future.result()
+        if manifest is not None:
+            cached_output_files = result_cache.reuse_result(
+                job_runner, manifest, OUTPUT_BUCKET
+            )
+            if cached_output_files is not None:
+                status = "complete"
+                output_files = cached_output_files
+
+    # Record the job's features and predict the resources it needs
+    features = None
+    estimate = None
+    if status == "pending" and features_future is not None:
+        features = features_future.result()
+        model = get_estimator_model(job_tag)
+        if model is not None:
+            estimate = estimator.predict(model, job_type, features)
+    if estimate is not None:
+        _LOGGER.info("%s Estimated resources: %s", job_tag, estimate)
+        if estimate.memory_mb > JOB_MEMORY_LIMIT_MB:
+            status = "failed"
+            message = (
+                f"Job is predicted to need {estimate.memory_mb:.0f} MB of "
+                f"memory, more than the {JOB_MEMORY_LIMIT_MB} MB available. "
+                f"Please reduce the problem size (e.g. the grid dimensions)."
+            )
+        elif estimate.runtime_seconds > JOB_RUNTIME_LIMIT:
+            status = "failed"
+            message = (
+                f"Job is predicted to run for {estimate.runtime_seconds:.0f} "
+                f"seconds, more than the {JOB_RUNTIME_LIMIT} allowed. "
+                f"Please reduce the problem size (e.g. the grid dimensions)."
+            )
+        else:
+            timeout_seconds = min(
+                ceil(estimate.runtime_upper), JOB_RUNTIME_LIMIT
+            )
+
+    # Create status file contents
     status_filename = f"{job_type}-status.json"
     status_object_name = f"{job_tag}/{status_filename}"
     initial_status: dict = build_status_dict(
         job_id, job_tag, job_type, status, input_files, output_files, message
     )
-    _LOGGER.info(
-        "%s Uploading status file, %s: %s",
+    if status == "complete":
+        initial_status[job_type]["endTime"] = time()
+
+    if status in ("invalid", "failed", "complete"):
+        return status_object_name, initial_status, None
+
+    # Build run info for SQS
+    if timeout_seconds is None:
+        timeout_seconds = JOB_MAX_RUNTIME
+
+    sqs_json = {
+        "job_date": job_date,
+        "job_id": job_id,
+        "job_tag": job_tag,
+        "job_type": job_type,
+        "bucket_name": bucket_name,
+        "input_files": job_runner.input_files,
+        "command_line_args": job_command_line_args,
+        "max_run_time": timeout_seconds,
+    }
+    if job_runner.input_renames:
+        # The worker downloads these objects to their sanitized names
+        sqs_json["input_renames"] = job_runner.input_renames
+    input_etags = job_runner.input_etags()
+    if input_etags:
+        # The worker's input cache keys these objects by their contents
+        sqs_json["input_etags"] = input_etags
+    lane_name = choose_lane(job_type, estimate)
+    if lane_name != DEFAULT_LANE:
+        sqs_json["lane"] = lane_name
+    if cache_key is not None:
+        # The worker records the outputs under this key when the job ends
+        sqs_json["result_cache_key"] = cache_key
+    if features is not None:
+        # The worker records the features with the job's metrics
+        sqs_json["features"] = features
+    if estimate is not None:
+        sqs_json["memory_mb"] = ceil(estimate.memory_upper)
+    # The worker adds its own phases and the time to enqueue (from the
+    #   message's SentTimestamp) and records them with the job's metrics
+    prepared_at = time()
+    sqs_json["timings"] = {
+        "fetch_job_info": round(prepare_start - fetch_start, 3),
+        "prepare_job": round(prepared_at - prepare_start, 3),
+        "prepared_at": prepared_at,
+    }
+    return status_object_name, initial_status, sqs_json
+
+
+def send_job_messages(
+    sqs_messages: List[dict],
+) -> Tuple[List[int], List[int], Dict[int, float]]:
+    """Send job messages to their lanes' queues in batches.
+
+    Each queue gets batches of up to SQS_BATCH_SIZE messages. SQS may have
+    accepted a batch whose request raised, so its messages are neither sent
+    nor failed.
+
+    :param sqs_messages List[dict]: The message bodies to enqueue
+    :return: The indices of the messages SQS did not accept, those of the
+             messages it may or may not have accepted, and the time SQS
+             accepted each of the others, by index
+    :rtype: Tuple[List[int], List[int], Dict[int, float]]
+    """
+    sqs_client = get_client("sqs", JOB_QUEUE_REGION)
+    by_queue: Dict[str, List[int]] = {}
+    for index, sqs_json in enumerate(sqs_messages):
+        queue_name = get_lane_queue_name(sqs_json.get("lane"))
+        by_queue.setdefault(queue_name, []).append(index)
+
+    failed: List[int] = []
+    unconfirmed: List[int] = []
+    sent_at: Dict[int, float] = {}
+    for queue_name, indices in by_queue.items():
+        try:
+            queue_url = get_queue_url(queue_name, JOB_QUEUE_REGION)
+        except ClientError as err:
+            for index in indices:
+                _LOGGER.error(
+                    "%s Failed to get URL of queue %s: %s",
+                    sqs_messages[index]["job_tag"],
+                    queue_name,
+                    err,
+                )
+            failed.extend(indices)
+            continue
+        for start in range(0, len(indices), SQS_BATCH_SIZE):
+            end = start + SQS_BATCH_SIZE
+            batch = indices[start:end]
+            for index in batch:
+                _LOGGER.info(
+                    "%s Sending message to queue %s: %s",
+                    sqs_messages[index]["job_tag"],
+                    queue_name,
+                    sqs_messages[index],
+                )
+            try:
+                response = sqs_client.send_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[
+                        {
+                            "Id": str(index),
+                            "MessageBody": dumps(sqs_messages[index]),
+                        }
+                        for index in batch
+                    ],
+                )
+            except ClientError as err:
+                for index in batch:
+                    _LOGGER.error(
+                        "%s Message may not have been sent to queue: %s",
+                        sqs_messages[index]["job_tag"],
+                        err,
+                    )
+                    unconfirmed.append(index)
+                continue
+            batch_sent_at = time()
+            for entry in response.get("Successful", []):
+                sent_at[int(entry["Id"])] = batch_sent_at
+            for entry in response.get("Failed", []):
+                index = int(entry["Id"])
+                _LOGGER.error(
+                    "%s Failed to send message to queue: %s (%s)",
+                    sqs_messages[index]["job_tag"],
+                    entry.get("Message"),
+                    entry.get("Code"),
+                )
+                failed.append(index)
+    return failed, unconfirmed, sent_at
+
+
+def prefetch_shared_info(executor: Executor):
+    """Start loading the version info, estimator model and queue URLs.
+
+    They are cached, so the jobs being prepared meanwhile wait for these
+    loads instead of starting their own.
+
+    :param executor Executor: Runs the loads in the background
+    """
+    executor.submit(get_version_info, "prefetch")
+    if ESTIMATOR_KEY:
+        executor.submit(get_estimator_model, "prefetch")
+    queue_names = {lane["queue"] for lane in JOB_QUEUE_LANES}
+    for queue_name in (queue_names | {SQS_QUEUE_NAME}) - {None}:
+        executor.submit(get_queue_url, queue_name, JOB_QUEUE_REGION)
+
+
+def rollback_job_status(
+    job_tag: str,
+    status_object_name: str,
+    initial_status: dict,
+    etag: Optional[str],
+):
+    """Mark a job that could not be enqueued as failed.
+
+    :param job_tag str: Unique ID for this job
+    :param status_object_name str: The S3 object key of the status file
+    :param initial_status dict: The pending status that was uploaded
+    :param etag Optional[str]: ETag of the pending status object (None if
+                               it was not uploaded)
+    :raises ClientError: PreconditionFailed if the status changed
+    """
+    job_type: str = initial_status["jobtype"]
+    failed_status = deepcopy(initial_status)
+    failed_status[job_type].update(
+        status="failed",
+        endTime=time(),
+        message="Job could not be queued. Please resubmit.",
+    )
+    _LOGGER.warning("%s Rolling back status to failed", job_tag)
+    upload_status_file(status_object_name, failed_status, etag)
+
+
+def fail_job_submission(jobinfo_object_name: str):
+    """Mark a job that could not be prepared as failed.
+
+    A job that already has a status (from an earlier try of the same S3
+    event) keeps it.
+
+    :param jobinfo_object_name str: The S3 object key of the job file
+    """
+    job_date, job_id, job_type = parse_job_object_name(jobinfo_object_name)
+    job_tag = f"{job_date}/{job_id}"
+    failed_status = build_status_dict(
+        job_id,
         job_tag,
-        status_object_name,
-        initial_status,
+        job_type,
+        "failed",
+        None,
+        None,
+        "Job could not be submitted. Please resubmit.",
     )
-    upload_status_file(status_object_name, initial_status)
-
-    # Submit run info to SQS
-    if status not in ("invalid", "failed"):
-        if timeout_seconds is None:
-            timeout_seconds = JOB_MAX_RUNTIME
-
-        sqs_json = {
-            "job_date": job_date,
-            "job_id": job_id,
-            "job_tag": job_tag,
-            "job_type": job_type,
-            "bucket_name": bucket_name,
-            "input_files": job_runner.input_files,
-            "command_line_args": job_command_line_args,
-            "max_run_time": timeout_seconds,
-        }
-        sqs_client = resource("sqs", JOB_QUEUE_REGION)
-        queue = sqs_client.get_queue_by_name(QueueName=SQS_QUEUE_NAME)
-        _LOGGER.info("%s Sending message to queue: %s", job_tag, sqs_json)
-        queue.send_message(MessageBody=dumps(sqs_json))
+    failed_status[job_type]["endTime"] = time()
+    _LOGGER.warning("%s Marking unprepared job as failed", job_tag)
+    try:
+        upload_status_file(f"{job_tag}/{job_type}-status.json", failed_status)
+    except ClientError as err:
+        if not _is_precondition_failure(err):
+            raise
+        _LOGGER.info("%s Job already has a status; keeping it", job_tag)
+
+
+def timed_upload_status_file(
+    object_filename: str, initial_status_dict: dict
+) -> Tuple[float, str]:
+    """Upload the initial status object to S3 and time the upload.
+
+    :param object_filename str: the S3 object key of the status file
+    :param initial_status_dict dict: the initial status info of the job
+    :return: The seconds the upload took and the ETag of the status object
+    :rtype: Tuple[float, str]
+    """
+    start = time()
+    etag = upload_status_file(object_filename, initial_status_dict)
+    return time() - start, etag
+
+
+def interpret_job_submission(event: dict, context):
+    # pylint: disable=unused-argument
+    """Interpret contents of job configuration, triggered from S3 event.
+
+    Every record of the event is prepared concurrently, while the version
+    info, estimator model and queue URLs are prefetched. Each job's status
+    is uploaded as soon as the job is prepared, while other records are
+    still being prepared, and runnable jobs are then enqueued in SQS
+    batches. A job whose message SQS does not accept has its status rolled
+    back to failed, a status upload that failed is tried once more (the job
+    is enqueued anyway), and a job that could not be prepared gets a failed
+    status. If even that can't be written, or SQS may not have accepted a
+    job's message (its send raised), the invocation raises so that Lambda
+    retries the event.
+
+    Status files are only created, never overwritten, so a retry can't
+    reset a job that already ran. A job whose status already exists is
+    only enqueued again if it is still pending, since its message may not
+    have been sent; the worker's job lease keeps the copies from running
+    at once, and drops them once the job is finished.
+
+    The timings of each queued job's phases are logged. Those known when
+    it is sent also go into its message, for the worker to record.
+
+    :param event dict: Amazon S3 event, containing info to retrieve contents
+    :param context: context object for AWS Lambda handler, containing info
+                    about the invocation, function, and execution environment
+    :return: The outcome of each record, keyed by S3 object key
+    :rtype: dict
+    :raises RuntimeError: If some job was left without a status, or may not
+                          have been queued
+    """
+
+    records: List[dict] = event.get("Records", [])
+    outcomes = {}
+    prepared_jobs: Dict[str, Tuple[str, dict]] = {}
+    job_messages: Dict[str, dict] = {}
+    status_uploads: Dict[str, Future] = {}
+    status_etags: Dict[str, str] = {}
+    unrecorded: List[str] = []
+    unconfirmed_names: List[str] = []
+    if not records:
+        return outcomes
+
+    with ThreadPoolExecutor(
+        max_workers=SUBMISSION_IO_THREADS, thread_name_prefix="submission-io"
+    ) as io_executor:
+        prefetch_shared_info(io_executor)
+
+        def prepare(record: dict):
+            object_name = record["s3"]["object"]["key"]
+            try:
+                status_object_name, initial_status, sqs_json = (
+                    prepare_job_submission(record, io_executor)
+                )
+            except Exception as err:  # pylint: disable=broad-except
+                _LOGGER.exception(
+                    "%s Failed to prepare job: %s", object_name, err
+                )
+                return None
+            _LOGGER.info(
+                "%s Uploading status file, %s: %s",
+                object_name,
+                status_object_name,
+                initial_status,
+            )
+            status_uploads[object_name] = io_executor.submit(
+                timed_upload_status_file, status_object_name, initial_status
+            )
+            return status_object_name, initial_status, sqs_json
+
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(SUBMISSION_THREADS, len(records)))
+        ) as executor:
+            for record, prepared in zip(
+                records, executor.map(prepare, records)
+            ):
+                object_name = record["s3"]["object"]["key"]
+                if prepared is None:
+                    outcomes[object_name] = "error"
+                    continue
+                prepared_jobs[object_name] = prepared[:2]
+                if prepared[2] is None:
+                    outcomes[object_name] = "not queued"
+                else:
+                    outcomes[object_name] = "queued"
+                    job_messages[object_name] = prepared[2]
+
+        # A retried event finds the statuses its earlier tries created
+        wait(status_uploads.values())
+        for object_name, upload in status_uploads.items():
+            err = upload.exception()
+            if err is None:
+                status_etags[object_name] = upload.result()[1]
+                continue
+            if not _is_precondition_failure(err):
+                continue
+            status_object_name = prepared_jobs[object_name][0]
+            try:
+                status, etag = get_existing_status(status_object_name)
+            except ClientError as read_err:
+                # Unreadable; a job message is dropped if the job ran
+                _LOGGER.error(
+                    "%s Failed to read existing status file: %s",
+                    object_name,
+                    read_err,
+                )
+                continue
+            if status == "pending" and object_name in job_messages:
+                _LOGGER.info("%s Job is still pending; resending", object_name)
+                status_etags[object_name] = etag
+                continue
+            _LOGGER.info(
+                "%s Job was already submitted (%s); skipping it",
+                object_name,
+                status,
+            )
+            outcomes[object_name] = "already submitted"
+            job_messages.pop(object_name, None)
+
+        queued: List[Tuple[str, str, dict]] = [
+            (object_name, *prepared_jobs[object_name])
+            for object_name in job_messages
+        ]
+        sqs_messages: List[dict] = list(job_messages.values())
+        failed_sends: List[int] = []
+        unconfirmed_sends: List[int] = []
+        sent_at: Dict[int, float] = {}
+        if sqs_messages:
+            failed_sends, unconfirmed_sends, sent_at = send_job_messages(
+                sqs_messages
+            )
+
+        # The pending status of these is kept for the retry to resend them
+        for index in unconfirmed_sends:
+            outcomes[queued[index][0]] = "error"
+            unconfirmed_names.append(queued[index][0])
+
+        for index in failed_sends:
+            object_name, status_object_name, initial_status = queued[index]
+            outcomes[object_name] = "error"
+            try:
+                rollback_job_status(
+                    sqs_messages[index]["job_tag"],
+                    status_object_name,
+                    initial_status,
+                    status_etags.get(object_name),
+                )
+            except ClientError as err:
+                if _is_precondition_failure(err):
+                    # A worker got the job from an earlier try's message
+                    outcomes[object_name] = "already submitted"
+                    continue
+                _LOGGER.error(
+                    "%s Failed to roll back status file: %s",
+                    object_name,
+                    err,
+                )
+                unrecorded.append(object_name)
+
+        failed_send_names = {queued[index][0] for index in failed_sends}
+        for object_name, upload in status_uploads.items():
+            err = upload.exception()
+            if (
+                err is None
+                or _is_precondition_failure(err)
+                or object_name in failed_send_names
+            ):
+                continue
+            # A sent job's worker waits a little for its status to appear
+            _LOGGER.error(
+                "%s Failed to upload status file, retrying: %s",
+                object_name,
+                err,
+            )
+            try:
+                upload_status_file(*prepared_jobs[object_name])
+            except ClientError as retry_err:
+                if _is_precondition_failure(retry_err):
+                    # The first upload did reach S3
+                    continue
+                _LOGGER.error(
+                    "%s Failed to upload status file: %s",
+                    object_name,
+                    retry_err,
+                )
+                outcomes[object_name] = "error"
+                unrecorded.append(object_name)
+
+        for object_name, outcome in outcomes.items():
+            if outcome != "error" or object_name in prepared_jobs:
+                continue
+            try:
+                fail_job_submission(object_name)
+            except Exception as err:  # pylint: disable=broad-except
+                _LOGGER.exception(
+                    "%s Failed to record job as failed: %s", object_name, err
+                )
+                unrecorded.append(object_name)
+
+        for index, enqueued_at in sent_at.items():
+            object_name = queued[index][0]
+            sqs_json = sqs_messages[index]
+            upload = status_uploads[object_name]
+            timings = dict(sqs_json["timings"])
+            # From the job being prepared to SQS accepting its batch
+            timings["enqueue"] = round(
+                enqueued_at - timings.pop("prepared_at"), 3
+            )
+            if upload.exception() is None:
+                timings["status_upload"] = round(upload.result()[0], 3)
+            _LOGGER.info(
+                "%s Submission timings: %s", sqs_json["job_tag"], timings
+            )
+
+    _LOGGER.info("Processed %d job submission(s): %s", len(records), outcomes)
+    problems = []
+    if unrecorded:
+        problems.append(f"left without a status file: {sorted(unrecorded)}")
+    if unconfirmed_names:
+        problems.append(f"maybe not queued: {sorted(unconfirmed_names)}")
+    if problems:
+        # Let Lambda retry the event rather than leave jobs without a status,
+        #   or pending without a message
+        raise RuntimeError(f"Job(s) {'; '.join(problems)}")
+    return outcomes
@@ -1,6 +1,5 @@
 """A class to interpret/prepare an APBS job submission for job queue."""
 
-from io import StringIO
 from locale import atof, atoi
 from os.path import splitext
 
@@ -11,6 +10,7 @@ from .utils import (
     _LOGGER,
     apbs_extract_input_files,
     apbs_infile_creator,
+    pqr_is_water,
 )
 
 
@@ -62,11 +62,12 @@ class Runner(JobSetup):
             # If APBS directly run, verify necessary files exist in S3
             infile_object_name = f"{job_date}/{job_id}/{infile_name}"
 
+            # List the job's files in S3 once to check for existence
+            input_index = self.input_index(input_bucket_name)
+
             # Check S3 for .in file existence; add to missing list if not
             self.add_input_file(infile_name)
-            if not S3Utils.object_exists(
-                input_bucket_name, infile_object_name
-            ):
+            if infile_object_name not in input_index:
                 _LOGGER.error(
                     "%s Missing APBS input file '%s'",
                     job_tag,
@@ -81,7 +82,7 @@ class Runner(JobSetup):
             for name in expected_files_list:
                 object_name = f"{job_tag}/{name}"
                 self.add_input_file(str(name))
-                if not S3Utils.object_exists(input_bucket_name, object_name):
+                if object_name not in input_index:
                     _LOGGER.error(
                         "%s Missing APBS input file '%s'",
                         job_tag,
@@ -120,14 +121,23 @@ class Runner(JobSetup):
             apbs_options["tempFile"] = "apbsinput.in"
             new_infile_contents = apbs_infile_creator(job_tag, apbs_options)
 
-            # Get contents of PQR file from PDB2PQR run
-            pqrfile_text = S3Utils.download_file_str(
-                output_bucket_name, f"{job_tag}/{pqr_file_name}"
+            # Upload *.in file to input bucket
+            _LOGGER.debug(
+                "%s Write file to S3: %s",
+                job_tag,
+                f"{job_tag}/{apbs_options['tempFile']}",
+            )
+            S3Utils.put_object(
+                input_bucket_name,
+                f"{job_tag}/{apbs_options['tempFile']}",
+                new_infile_contents.encode("utf-8"),
             )
 
-            # Remove waters from molecule (PQR file) if requested by the user
-            try:
-                if "removewater" in form and form["removewater"] == "on":
+            # Copy PQR file from PDB2PQR run to input bucket, removing
+            #   waters from the molecule if requested by the user
+            pqr_object_name = f"{job_tag}/{pqr_file_name}"
+            if "removewater" in form and form["removewater"] == "on":
+                try:
                     pqr_filename_root, pqr_filename_ext = splitext(
                         pqr_file_name
                     )
@@ -136,53 +146,46 @@ class Runner(JobSetup):
                         f"{pqr_filename_root}-water{pqr_filename_ext}"
                     )
 
-                    # Add lines to new PQR text, skipping lines with water
-                    nowater_pqrfile_text = "".join(
-                        line
-                        for line in StringIO(pqrfile_text)
-                        if "WAT" not in line and "HOH" not in line
-                    )
-
-                    # Send original PQR file (with water) to S3 output bucket
-                    S3Utils.put_object(
+                    # Keep original PQR file (with water) in output bucket
+                    S3Utils.copy_object(
+                        job_tag,
                         output_bucket_name,
+                        pqr_object_name,
                         f"{job_tag}/{water_pqrname}",
-                        pqrfile_text.encode("utf-8"),
                     )
-                    self.add_output_file(f"{job_id}/{water_pqrname}")
+                    self.add_output_file(water_pqrname)
 
-                    # Replace PQR file text with version with water removed
-                    pqrfile_text = nowater_pqrfile_text
+                    # Stream PQR file to input bucket, skipping water atoms
+                    removed = S3Utils.filter_lines(
+                        job_tag,
+                        output_bucket_name,
+                        pqr_object_name,
+                        input_bucket_name,
+                        pqr_object_name,
+                        lambda line: not pqr_is_water(line),
+                    )
+                    _LOGGER.debug(
+                        "%s Removed %d water atom(s) from '%s'",
+                        job_tag,
+                        removed,
+                        pqr_file_name,
+                    )
 
-            except Exception as err:
-                _LOGGER.exception(
-                    "%s Failed to remove water molecules: %s",
-                    self.job_tag,
-                    err,
+                except Exception as err:
+                    _LOGGER.exception(
+                        "%s Failed to remove water molecules: %s",
+                        self.job_tag,
+                        err,
+                    )
+                    raise
+            else:
+                S3Utils.copy_object(
+                    job_tag,
+                    output_bucket_name,
+                    pqr_object_name,
+                    pqr_object_name,
+                    input_bucket_name,
                 )
-                raise
-
-            # Upload *.pqr and *.in file to input bucket
-            _LOGGER.debug(
-                "%s Write file to S3: %s",
-                job_tag,
-                f"{job_tag}/{apbs_options['tempFile']}",
-            )
-            S3Utils.put_object(
-                input_bucket_name,
-                f"{job_tag}/{apbs_options['tempFile']}",
-                new_infile_contents.encode("utf-8"),
-            )
-            _LOGGER.debug(
-                "%s Write file to S3: %s",
-                job_tag,
-                f"{job_tag}/{pqr_file_name}",
-            )
-            S3Utils.put_object(
-                input_bucket_name,
-                f"{job_tag}/{pqr_file_name}",
-                pqrfile_text.encode("utf-8"),
-            )
 
             # Set input files for status reporting
             self.add_input_file(pqr_file_name)
@@ -0,0 +1,388 @@
+"""Predict the runtime and peak memory of a job from its inputs.
+
+The model is fit from the {job_type}-metrics.json files of finished jobs,
+which record the features the job service sent with each job. For each
+job type and variant (APBS calculation type, PDB2PQR pKa method), the log
+of the runtime and of the peak memory are fit as linear functions of the
+log grid size and log atom count. Predictions add a margin of CONFIDENCE_Z
+standard deviations of the fit's residuals.
+
+Atom counts are approximated from the size of uploaded molecule files.
+Structures fetched by the worker (e.g. an RCSB ID) can't be sized here:
+the worker counts their atoms into the metrics, so they train the model,
+but their own predictions use the median atom count of past jobs.
+
+Peak memory is the ru_maxrss the worker gets from wait4(). It counts the
+job's process from its fork, so it can include the worker's resident
+memory copied at the fork (before the exec), and predictions err high by
+up to that much.
+
+Train a model from the output bucket with, e.g.:
+
+    python -m lambda_services.job_service.launcher.estimator \\
+        --bucket OUTPUT_BUCKET --prefix 2024- \\
+        --model-bucket INPUT_BUCKET --model-key estimator/model.json
+"""
+
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from json import dumps, loads
+from math import exp, log, sqrt
+from os.path import splitext
+from re import IGNORECASE, compile as re_compile
+from statistics import median
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .aws_clients import get_client
+from .jobsetup import JobSetup
+from .s3_utils import S3Utils
+from .utils import _LOGGER
+
+# Standard deviations of margin on predictions (~99% one-sided)
+CONFIDENCE_Z = 2.33
+# Fewest samples needed to fit a variant; smaller ones use the job type
+MIN_SAMPLES = 10
+MIN_RUNTIME_SECONDS = 300
+MIN_MEMORY_MB = 256
+# Approximate bytes per atom record, to count atoms from a file's size
+BYTES_PER_ATOM = {".pqr": 70, ".pdb": 80, ".cif": 90}
+_RIDGE = 1e-6
+_ANY_VARIANT = "*"
+
+_CALC_TYPE = re_compile(
+    r"^\s*(mg-auto|mg-para|mg-manual|mg-dummy|fe-manual|geoflow-auto"
+    r"|geoflow-manual|bem-manual|pbam-auto|pbsam-auto)\b",
+    IGNORECASE,
+)
+_DIME = re_compile(r"^\s*dime\s+(\d+)\s+(\d+)\s+(\d+)", IGNORECASE)
+_PDIME = re_compile(r"^\s*pdime\s+(\d+)\s+(\d+)\s+(\d+)", IGNORECASE)
+_MOLECULE = re_compile(r"^\s*mol\s+(?:pqr|pdb)\s+(\S+)", IGNORECASE)
+_PKA_METHOD = re_compile(
+    r"--(?:ph-calc-method|titration-state-method)[= ](\S+)"
+)
+
+
+@dataclass
+class Estimate:
+    """Predicted resource use of a job.
+
+    The *_seconds and *_mb values are point estimates; the upper bounds
+    include the confidence margin.
+    """
+
+    runtime_seconds: float
+    memory_mb: float
+    runtime_upper: float
+    memory_upper: float
+
+
+def _product(values: Iterable[str]) -> int:
+    result = 1
+    for value in values:
+        result *= int(value)
+    return result
+
+
+def apbs_features(infile_text: str, molecule_sizes: Dict[str, int]) -> dict:
+    """Extract the features of an APBS job from its input file.
+
+    Args:
+        infile_text (str): Contents of the APBS input file
+        molecule_sizes (Dict[str, int]): Size in bytes of each molecule file
+
+    Returns:
+        dict: calc_type, grid_points and atoms (None if unknown)
+    """
+    calc_type = None
+    grid_points = 0
+    pdime = 1
+    for line in infile_text.splitlines():
+        match = _CALC_TYPE.match(line)
+        if match and calc_type is None:
+            calc_type = match.group(1).lower()
+        match = _DIME.match(line)
+        if match:
+            grid_points += _product(match.groups())
+        match = _PDIME.match(line)
+        if match:
+            pdime = max(pdime, _product(match.groups()))
+
+    atoms = sum(
+        size // BYTES_PER_ATOM.get(splitext(name)[1].lower(), 80)
+        for name, size in molecule_sizes.items()
+    )
+    return {
+        "calc_type": calc_type,
+        "grid_points": grid_points * pdime or None,
+        "atoms": atoms or None,
+    }
+
+
+def pdb2pqr_features(
+    command_line_args: str, molecule_name: str, molecule_size: Optional[int]
+) -> dict:
+    """Extract the features of a PDB2PQR job from its command line.
+
+    Args:
+        command_line_args (str): The PDB2PQR command line arguments
+        molecule_name (str): Name of the input structure file
+        molecule_size (Optional[int]): Its size in bytes, None if unknown
+            (e.g. a structure fetched by ID)
+
+    Returns:
+        dict: pka_method and atoms (None if unknown)
+    """
+    match = _PKA_METHOD.search(command_line_args or "")
+    atoms = None
+    if molecule_size:
+        bytes_per_atom = BYTES_PER_ATOM.get(
+            splitext(molecule_name)[1].lower(), 80
+        )
+        atoms = molecule_size // bytes_per_atom or None
+    return {
+        "pka_method": match.group(1).lower() if match else None,
+        "atoms": atoms,
+    }
+
+
+def extract_features(
+    job_type: str, job_runner: JobSetup, bucket_name: str
+) -> dict:
+    """Extract the features of a prepared job from its input files.
+
+    Args:
+        job_type (str): Name of job type (e.g. 'apbs', 'pdb2pqr')
+        job_runner (JobSetup): A runner whose prepare_job() has been called
+        bucket_name (str): AWS S3 bucket holding the input files
+
+    Returns:
+        dict: The features of the job
+    """
+    job_tag = job_runner.job_tag
+    input_index = job_runner.input_index(bucket_name)
+    if job_type == "apbs":
+        infile_text = S3Utils.download_file_str(
+            bucket_name, f"{job_tag}/{job_runner.command_line_args}"
+        )
+        molecule_sizes = {}
+        for line in infile_text.splitlines():
+            match = _MOLECULE.match(line)
+            if match and f"{job_tag}/{match[1]}" in input_index:
+                molecule_sizes[match[1]] = input_index[
+                    f"{job_tag}/{match[1]}"
+                ].size
+        return apbs_features(infile_text, molecule_sizes)
+
+    molecule_name = job_runner.input_files[0] if job_runner.input_files else ""
+    molecule_size = None
+    if molecule_name in input_index:
+        molecule_size = input_index[molecule_name].size
+    return pdb2pqr_features(
+        job_runner.command_line_args, molecule_name, molecule_size
+    )
+
+
+def _variant(job_type: str, features: dict) -> str:
+    if job_type == "apbs":
+        return features.get("calc_type") or "none"
+    return features.get("pka_method") or "none"
+
+
+def _feature_row(features: dict, medians: Dict[str, float]) -> List[float]:
+    """Return [1, log grid points, log atoms], imputing unknown values."""
+    return [1.0] + [
+        log(max(features.get(name) or medians.get(name) or 1, 1))
+        for name in ("grid_points", "atoms")
+    ]
+
+
+def _solve(matrix: List[List[float]], vector: List[float]) -> List[float]:
+    """Solve a small linear system by Gaussian elimination."""
+    size = len(vector)
+    rows = [matrix[idx][:] + [vector[idx]] for idx in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda idx: abs(rows[idx][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for idx in range(size):
+            if idx != col and rows[col][col]:
+                factor = rows[idx][col] / rows[col][col]
+                rows[idx] = [
+                    a - factor * b for a, b in zip(rows[idx], rows[col])
+                ]
+    return [
+        rows[idx][size] / rows[idx][idx] if rows[idx][idx] else 0.0
+        for idx in range(size)
+    ]
+
+
+def _fit(rows: List[List[float]], targets: List[float]) -> dict:
+    """Fit targets ~ rows by ridge-regularized least squares."""
+    width = len(rows[0])
+    normal = [
+        [
+            sum(row[i] * row[j] for row in rows) + (_RIDGE if i == j else 0)
+            for j in range(width)
+        ]
+        for i in range(width)
+    ]
+    coef = _solve(
+        normal,
+        [
+            sum(row[i] * y for row, y in zip(rows, targets))
+            for i in range(width)
+        ],
+    )
+    residuals = [
+        y - sum(c * x for c, x in zip(coef, row))
+        for row, y in zip(rows, targets)
+    ]
+    sigma = sqrt(sum(r * r for r in residuals) / max(len(rows) - width, 1))
+    return {"coef": coef, "sigma": sigma, "samples": len(rows)}
+
+
+def train_model(samples: Iterable[Tuple[str, dict, float, float]]) -> dict:
+    """Fit a model from the features and resource use of finished jobs.
+
+    Args:
+        samples (Iterable[Tuple[str, dict, float, float]]): The job type,
+            features, runtime in seconds and peak memory in MB of each job
+
+    Returns:
+        dict: The model, as accepted by predict()
+    """
+    groups: Dict[str, Dict[str, list]] = {}
+    for job_type, features, runtime, memory_mb in samples:
+        if runtime <= 0 or memory_mb <= 0:
+            continue
+        by_variant = groups.setdefault(job_type, {})
+        for variant in (_variant(job_type, features), _ANY_VARIANT):
+            by_variant.setdefault(variant, []).append(
+                (features, runtime, memory_mb)
+            )
+
+    model = {}
+    for job_type, by_variant in groups.items():
+        # Unknown features are imputed with the job type's median
+        medians = {}
+        for name in ("grid_points", "atoms"):
+            values = [
+                f[name] for f, _, _ in by_variant[_ANY_VARIANT] if f.get(name)
+            ]
+            if values:
+                medians[name] = median(values)
+        variants = {}
+        for variant, rows in by_variant.items():
+            if len(rows) < MIN_SAMPLES:
+                continue
+            features = [_feature_row(f, medians) for f, _, _ in rows]
+            variants[variant] = {
+                "runtime": _fit(features, [log(r) for _, r, _ in rows]),
+                "memory_mb": _fit(features, [log(m) for _, _, m in rows]),
+            }
+        if variants:
+            model[job_type] = {"medians": medians, "variants": variants}
+    return model
+
+
+def predict(model: dict, job_type: str, features: dict) -> Optional[Estimate]:
+    """Predict the runtime and peak memory of a job.
+
+    Args:
+        model (dict): A model from train_model()
+        job_type (str): Name of job type (e.g. 'apbs', 'pdb2pqr')
+        features (dict): The features of the job, from extract_features()
+
+    Returns:
+        Optional[Estimate]: The prediction, None if the model can't tell
+    """
+    if job_type not in model:
+        return None
+    variants: dict = model[job_type]["variants"]
+    fit = variants.get(_variant(job_type, features))
+    if fit is None:
+        fit = variants.get(_ANY_VARIANT)
+    if fit is None:
+        return None
+
+    row = _feature_row(features, model[job_type]["medians"])
+
+    def point_and_upper(target: dict) -> Tuple[float, float]:
+        mean = sum(c * x for c, x in zip(target["coef"], row))
+        return exp(mean), exp(mean + CONFIDENCE_Z * target["sigma"])
+
+    runtime, runtime_upper = point_and_upper(fit["runtime"])
+    memory_mb, memory_upper = point_and_upper(fit["memory_mb"])
+    return Estimate(
+        runtime_seconds=runtime,
+        memory_mb=memory_mb,
+        runtime_upper=max(runtime_upper, MIN_RUNTIME_SECONDS),
+        memory_upper=max(memory_upper, MIN_MEMORY_MB),
+    )
+
+
+def load_samples(
+    bucket_name: str, prefix: str = ""
+) -> List[Tuple[str, dict, float, float]]:
+    """Read the metrics of successful jobs that recorded their features.
+
+    A job served from the result cache has a copy of the original job's
+    metrics, with the same ETag; only the first one listed is read.
+
+    Args:
+        bucket_name (str): The output bucket of the jobs
+        prefix (str): Only read jobs whose tag starts with this prefix
+
+    Returns:
+        List[Tuple[str, dict, float, float]]: Samples for train_model()
+    """
+    s3_client = get_client("s3")
+    samples = []
+    seen_etags = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for s3_object in page.get("Contents", []):
+            object_name: str = s3_object["Key"]
+            if not object_name.endswith("-metrics.json"):
+                continue
+            if s3_object["ETag"] in seen_etags:
+                continue
+            seen_etags.add(s3_object["ETag"])
+            metrics_json: dict = loads(
+                S3Utils.download_file_str(bucket_name, object_name)
+            )
+            metrics: dict = metrics_json.get("metrics", {})
+            if "features" not in metrics_json or metrics.get("exit_code"):
+                continue
+            job_type = object_name.split("/")[-1][: -len("-metrics.json")]
+            samples.append(
+                (
+                    job_type,
+                    metrics_json["features"],
+                    metrics["runtime_in_seconds"],
+                    # ru_maxrss is in KiB on Linux
+                    metrics["rusage"]["ru_maxrss"] / 1024,
+                )
+            )
+    return samples
+
+
+def main():
+    parser = ArgumentParser(
+        description="Train the job runtime and memory estimator"
+    )
+    parser.add_argument("--bucket", required=True, help="Job output bucket")
+    parser.add_argument("--prefix", default="", help="Job tag prefix")
+    parser.add_argument("--model-bucket", required=True)
+    parser.add_argument("--model-key", required=True)
+    args = parser.parse_args()
+
+    samples = load_samples(args.bucket, args.prefix)
+    model = train_model(samples)
+    _LOGGER.info("Trained estimator from %d samples: %s", len(samples), model)
+    get_client("s3").put_object(
+        Bucket=args.model_bucket, Key=args.model_key, Body=dumps(model)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 """Base class containing shared methods used in APBS/PDB2PQR setup classes."""
 
+from typing import Dict, Optional
+
+from urllib3.exceptions import LocationParseError
 from urllib3.util import parse_url
+from .s3_utils import S3ObjectInfo, S3Utils
 from .utils import _LOGGER
 
 
@@ -23,9 +27,16 @@ class JobSetup:
         self.input_files = []
         self.output_files = []
         self._missing_files = []
+        # Local file names of input objects whose names were sanitized
+        self.input_renames: Dict[str, str] = {}
+        self._input_index: Optional[Dict[str, S3ObjectInfo]] = None
 
     def is_url(self, file_string: str):
-        url_obj = parse_url(file_string)
+        try:
+            url_obj = parse_url(file_string)
+        except LocationParseError:
+            # e.g. uploaded file names with spaces
+            return False
         return url_obj.scheme is not None
 
     def get_object_name(self, filename):
@@ -35,6 +46,39 @@ class JobSetup:
             )
         return f"{self.job_tag}/{filename}"
 
+    def input_index(self, bucket_name: str) -> Dict[str, S3ObjectInfo]:
+        """Get the size and ETag of each object under the job's prefix.
+
+        The prefix is listed once, on the first call, so existence checks
+        and input sizes cost a single request per job.
+
+        Args:
+            bucket_name (str): AWS S3 bucket holding the input files
+
+        Returns:
+            Dict[str, S3ObjectInfo]: The objects of this job, by key
+        """
+        if self._input_index is None:
+            self._input_index = S3Utils.list_prefix(
+                self.job_tag, bucket_name, f"{self.job_tag}/"
+            )
+        return self._input_index
+
+    def input_etags(self) -> Dict[str, str]:
+        """Get the ETags of the job's S3 input files, if already listed.
+
+        Returns:
+            Dict[str, str]: The ETag of each listed input object, by key;
+                empty if input_index() was never called
+        """
+        if self._input_index is None:
+            return {}
+        return {
+            file_name: self._input_index[file_name].etag
+            for file_name in self.input_files
+            if file_name in self._input_index
+        }
+
     def add_input_file(self, file_name: str):
         if not self.is_url(file_name):
             file_name = f"{self.job_tag}/{file_name}"
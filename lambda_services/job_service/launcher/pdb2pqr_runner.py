@@ -4,7 +4,6 @@ from os.path import splitext
 
 from .jobsetup import JobSetup
 from .utils import _LOGGER
-from .s3_utils import S3Utils
 from .weboptions import WebOptions, WebOptionsError
 
 
@@ -52,22 +51,6 @@ class Runner(JobSetup):
         if self.invoke_method in ["gui", "v1"]:
             command_line_args = self.version_1_job(job_id)
 
-            # Copy all the sanitized files from the file queue
-            for payload in self.weboptions.files_copy_queue:
-                _LOGGER.info(
-                    "%s Copying original object '%s' to sanitized object name '%s' (bucket: %s)",
-                    self.job_tag,
-                    payload.source_object,
-                    payload.dest_object,
-                    payload.bucket_name,
-                )
-                S3Utils.copy_object(
-                    self.job_tag,
-                    input_bucket_name,
-                    payload.source_object,
-                    payload.dest_object,
-                )
-
         elif self.invoke_method in ["cli", "v2"]:
             command_line_args = self.version_2_job()
         self.command_line_args = command_line_args
@@ -78,6 +61,22 @@ class Runner(JobSetup):
         )
         return command_line_args
 
+    def add_uploaded_file(self, file_name: str):
+        """Add an uploaded input file, given its sanitized name.
+
+        Files whose names were sanitized stay under their uploaded names in
+        S3; the worker downloads them to the sanitized name instead.
+
+        Args:
+            file_name (str): The sanitized name of the uploaded file
+        """
+        original_name = self.weboptions.original_filenames.get(
+            file_name, file_name
+        )
+        self.add_input_file(original_name)
+        if original_name != file_name:
+            self.input_renames[self.get_object_name(original_name)] = file_name
+
     def version_2_job(self):
         """Setup the job to run from the command line."""
         # construct command line argument string for when CLI is invoked
@@ -124,7 +123,7 @@ class Runner(JobSetup):
         #   PDB fileand command line arguments
         if self.weboptions.user_did_upload:
             # Update input files
-            self.add_input_file(self.weboptions.pdbfilename)
+            self.add_uploaded_file(self.weboptions.pdbfilename)
         elif splitext(self.weboptions.pdbfilename)[1] != ".pdb":
             self.weboptions.pdbfilename = (
                 self.weboptions.pdbfilename + ".pdb"
@@ -138,11 +137,11 @@ class Runner(JobSetup):
 
         # Check for userff, names, ligand files to add to input_file list
         if hasattr(self.weboptions, "ligandfilename"):
-            self.add_input_file(self.weboptions.ligandfilename)
+            self.add_uploaded_file(self.weboptions.ligandfilename)
         if hasattr(self.weboptions, "userfffilename"):
-            self.add_input_file(self.weboptions.userfffilename)
+            self.add_uploaded_file(self.weboptions.userfffilename)
         if hasattr(self.weboptions, "usernamesfilename"):
-            self.add_input_file(self.weboptions.usernamesfilename)
+            self.add_uploaded_file(self.weboptions.usernamesfilename)
 
         # Make the pqr name prefix the job_id
         self.weboptions.pqrfilename = job_id + ".pqr"
@@ -0,0 +1,196 @@
+"""A content-addressed cache of finished job results.
+
+A job's cache key hashes everything that determines its outputs: the job
+type, its command line with the job ID factored out, the content (ETag) of
+each input file and the tool versions. When a job finishes, the worker
+records its output files in a manifest named by the key under
+RESULT_CACHE_PREFIX in the input bucket. A later job with the same key gets
+those outputs copied into its own prefix instead of being run again.
+
+Only manifests are stored; the outputs stay under the original job's
+prefix. Manifests are ignored once they are older than the retention
+period, and a lifecycle rule on RESULT_CACHE_PREFIX deletes them.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from json import dumps, loads
+from time import time
+from typing import List, Optional
+
+from botocore.exceptions import ClientError
+from .aws_clients import get_client
+from .jobsetup import JobSetup
+from .utils import _LOGGER
+
+RESULT_CACHE_PREFIX = "result-cache/"
+# Small text outputs that name the job ID in their contents
+REWRITE_SUFFIXES = (".in",)
+COPY_THREADS = 8
+_JOB_ID_TOKEN = "{job_id}"
+
+
+def compute_cache_key(
+    job_runner: JobSetup,
+    job_type: str,
+    input_bucket_name: str,
+    versions: dict,
+) -> Optional[str]:
+    """Hash the inputs that determine the outputs of a prepared job.
+
+    Args:
+        job_runner (JobSetup): A runner whose prepare_job() has been called
+        job_type (str): Name of job type (e.g. 'apbs', 'pdb2pqr')
+        input_bucket_name (str): AWS S3 bucket holding the input files
+        versions (dict): Version info, as returned by get_version_info()
+
+    Returns:
+        Optional[str]: The cache key, or None if an input can't be read
+    """
+    job_id = job_runner.job_id
+    prefix_length = len(job_runner.job_tag) + 1
+    input_index = job_runner.input_index(input_bucket_name)
+
+    inputs = []
+    for file_name in job_runner.input_files:
+        if job_runner.is_url(file_name):
+            inputs.append([file_name, ""])
+            continue
+        if file_name not in input_index:
+            _LOGGER.warning(
+                "%s Not caching result, can't find input '%s'",
+                job_runner.job_tag,
+                file_name,
+            )
+            return None
+        etag = input_index[file_name].etag
+        relative_name = file_name[prefix_length:]
+        inputs.append([relative_name.replace(job_id, _JOB_ID_TOKEN), etag])
+
+    canonical = dumps(
+        {
+            "job_type": job_type,
+            "command_line_args": str(job_runner.command_line_args).replace(
+                job_id, _JOB_ID_TOKEN
+            ),
+            "inputs": sorted(inputs),
+            "versions": {
+                "aws": versions.get("aws"),
+                job_type: versions.get(job_type),
+            },
+        },
+        sort_keys=True,
+    )
+    return sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def lookup_result(
+    job_tag: str, bucket_name: str, cache_key: str, max_age_seconds: float
+) -> Optional[dict]:
+    """Get the manifest of a finished job with the same cache key.
+
+    Args:
+        job_tag (str): Unique ID for the new job
+        bucket_name (str): AWS S3 bucket holding the cache manifests
+        cache_key (str): The cache key of the new job
+        max_age_seconds (float): Manifests older than this are ignored
+
+    Returns:
+        Optional[dict]: The manifest, or None on a miss
+    """
+    try:
+        response = get_client("s3").get_object(
+            Bucket=bucket_name, Key=f"{RESULT_CACHE_PREFIX}{cache_key}.json"
+        )
+        manifest: dict = loads(response["Body"].read().decode("utf-8"))
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "NoSuchKey":
+            _LOGGER.warning(
+                "%s Unable to read result cache entry %s: %s",
+                job_tag,
+                cache_key,
+                err,
+            )
+        return None
+
+    if manifest["created"] + max_age_seconds < time():
+        _LOGGER.debug(
+            "%s Result cache entry %s has expired", job_tag, cache_key
+        )
+        return None
+    return manifest
+
+
+def reuse_result(
+    job_runner: JobSetup, manifest: dict, output_bucket_name: str
+) -> Optional[List[str]]:
+    """Copy the outputs listed in a manifest into the new job's prefix.
+
+    Objects are copied server-side and renamed for the new job ID. Small
+    text files that mention the old job ID are rewritten instead.
+
+    Args:
+        job_runner (JobSetup): The runner of the new job
+        manifest (dict): A manifest returned by lookup_result()
+        output_bucket_name (str): AWS S3 bucket holding job outputs
+
+    Returns:
+        Optional[List[str]]: The new output object names, or None if any
+            output could not be copied
+    """
+    job_tag = job_runner.job_tag
+    job_id = job_runner.job_id
+    source_job_id: str = manifest["job_id"]
+    prefix_length = len(manifest["job_tag"]) + 1
+    s3_client = get_client("s3")
+
+    def copy_output(source_object_name: str) -> str:
+        relative_name = source_object_name[prefix_length:]
+        dest_object_name = (
+            f"{job_tag}/{relative_name.replace(source_job_id, job_id)}"
+        )
+        if relative_name.endswith(REWRITE_SUFFIXES):
+            body: str = (
+                s3_client.get_object(
+                    Bucket=output_bucket_name, Key=source_object_name
+                )["Body"]
+                .read()
+                .decode("utf-8")
+            )
+            s3_client.put_object(
+                Bucket=output_bucket_name,
+                Key=dest_object_name,
+                Body=body.replace(source_job_id, job_id).encode("utf-8"),
+            )
+        else:
+            s3_client.copy_object(
+                CopySource={
+                    "Bucket": output_bucket_name,
+                    "Key": source_object_name,
+                },
+                Bucket=output_bucket_name,
+                Key=dest_object_name,
+            )
+        return dest_object_name
+
+    try:
+        with ThreadPoolExecutor(max_workers=COPY_THREADS) as executor:
+            output_files = list(
+                executor.map(copy_output, manifest["output_files"])
+            )
+    except (ClientError, UnicodeDecodeError) as err:
+        _LOGGER.warning(
+            "%s Unable to reuse results of %s: %s",
+            job_tag,
+            manifest["job_tag"],
+            err,
+        )
+        return None
+
+    _LOGGER.info(
+        "%s Reused %d output file(s) of %s",
+        job_tag,
+        len(output_files),
+        manifest["job_tag"],
+    )
+    return output_files
@@ -1,10 +1,15 @@
-from typing import Optional
-from boto3 import client
+from typing import Callable, Dict, Optional
 from dataclasses import dataclass
 
 from botocore.exceptions import ClientError
+from .aws_clients import get_client
 from .utils import _LOGGER
 
+# Size of the chunks read from S3 when streaming an object
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Size of each part of a multipart upload (S3 requires at least 5 MiB)
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
 
 class S3Utils:
     @staticmethod
@@ -19,8 +24,8 @@ class S3Utils:
         if dest_bucket_name is None:
             dest_bucket_name = source_bucket_name
 
-        # Initialize boto3 S3 client
-        s3_client = client("s3")
+        # Reuse the pooled boto3 S3 client
+        s3_client = get_client("s3")
 
         # Use S3 client to copy object
         _LOGGER.debug(
@@ -33,7 +38,7 @@ class S3Utils:
         )
         s3_client.copy_object(
             CopySource=f"{source_bucket_name}/{source_object_name}",
-            Bucket=source_bucket_name,
+            Bucket=dest_bucket_name,
             Key=dest_object_name,
         )
 
@@ -41,7 +46,7 @@ class S3Utils:
     def download_file_str(bucket_name: str, object_name: str) -> str:
         job_tag = _extract_job_tag_from_objectname(object_name)
         try:
-            s3_client = client("s3")
+            s3_client = get_client("s3")
             s3_response: dict = s3_client.get_object(
                 Bucket=bucket_name,
                 Key=object_name,
@@ -60,7 +65,7 @@ class S3Utils:
     @staticmethod
     def put_object(bucket_name: str, object_name: str, body):
         job_tag = _extract_job_tag_from_objectname(object_name)
-        s3_client = client("s3")
+        s3_client = get_client("s3")
         _ = s3_client.put_object(
             Bucket=bucket_name,
             Key=object_name,
@@ -74,46 +79,160 @@ class S3Utils:
         )
 
     @staticmethod
-    def object_exists(bucket_name: str, object_name: str) -> bool:
-        s3_client = client("s3")
-        try:
-            _ = s3_client.head_object(
-                Bucket=bucket_name,
-                Key=object_name,
+    def filter_lines(
+        job_tag: str,
+        source_bucket_name: str,
+        source_object_name: str,
+        dest_bucket_name: str,
+        dest_object_name: str,
+        keep_line: Callable[[bytes], bool],
+    ) -> int:
+        """Copy an object line by line, keeping only the matching lines.
+
+        The source is read in chunks and the result is written through a
+        multipart upload, so neither is ever held in memory as a whole.
+        Results smaller than one part are written with a single PUT.
+
+        Args:
+            job_tag (str): Unique ID for this job
+            source_bucket_name (str): AWS S3 bucket of the source object
+            source_object_name (str): Key of the source object
+            dest_bucket_name (str): AWS S3 bucket of the filtered object
+            dest_object_name (str): Key of the filtered object
+            keep_line (Callable[[bytes], bool]): Whether to keep a line,
+                given its bytes including the line ending
+
+        Returns:
+            int: The number of lines removed
+        """
+        s3_client = get_client("s3")
+        _LOGGER.debug(
+            "%s Filtering file: '%s' (bucket: %s) - "
+            "Destination: '%s' (bucket: %s)",
+            job_tag,
+            source_object_name,
+            source_bucket_name,
+            dest_object_name,
+            dest_bucket_name,
+        )
+        body = s3_client.get_object(
+            Bucket=source_bucket_name, Key=source_object_name
+        )["Body"]
+
+        upload_id: Optional[str] = None
+        parts = []
+        buffer = bytearray()
+        removed = 0
+
+        def upload_part(data: bytes):
+            nonlocal upload_id
+            if upload_id is None:
+                upload_id = s3_client.create_multipart_upload(
+                    Bucket=dest_bucket_name, Key=dest_object_name
+                )["UploadId"]
+            part_number = len(parts) + 1
+            response = s3_client.upload_part(
+                Bucket=dest_bucket_name,
+                Key=dest_object_name,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
             )
-            return True
-        except ClientError as err:
-            if err.response["Error"]["Code"] == "404":  # "NoSuchKey" error
-                return False
-            elif err.response["Error"]["Code"] == "403":
-                job_tag: str = _extract_job_tag_from_objectname(object_name)
-                _LOGGER.warning(
-                    "%s Received '%s' (%d) message on object HEAD: %s",
-                    job_tag,
-                    err.response["Error"]["Message"],
-                    err.response["ResponseMetadata"]["HTTPStatusCode"],
-                    object_name,
+            parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+        try:
+            remainder = b""
+            for chunk in body.iter_chunks(STREAM_CHUNK_SIZE):
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop()
+                for line in lines:
+                    line += b"\n"
+                    if keep_line(line):
+                        buffer += line
+                    else:
+                        removed += 1
+                if len(buffer) >= MULTIPART_PART_SIZE:
+                    upload_part(bytes(buffer))
+                    buffer.clear()
+            if remainder:
+                if keep_line(remainder):
+                    buffer += remainder
+                else:
+                    removed += 1
+
+            if upload_id is None:
+                s3_client.put_object(
+                    Bucket=dest_bucket_name,
+                    Key=dest_object_name,
+                    Body=bytes(buffer),
                 )
-                return False
             else:
-                raise
+                if buffer:
+                    upload_part(bytes(buffer))
+                s3_client.complete_multipart_upload(
+                    Bucket=dest_bucket_name,
+                    Key=dest_object_name,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+        except Exception:
+            if upload_id is not None:
+                s3_client.abort_multipart_upload(
+                    Bucket=dest_bucket_name,
+                    Key=dest_object_name,
+                    UploadId=upload_id,
+                )
+            raise
+        finally:
+            body.close()
+        return removed
 
+    @staticmethod
+    def list_prefix(
+        job_tag: str, bucket_name: str, prefix: str
+    ) -> Dict[str, "S3ObjectInfo"]:
+        """Index the objects under a prefix with a single listing.
 
-@dataclass
-class S3CopyPayload:
-    source_object: str
-    dest_object: str
-    bucket_name: Optional[str] = None
+        Args:
+            job_tag (str): Unique ID for this job
+            bucket_name (str): AWS S3 bucket to list
+            prefix (str): Key prefix to list, e.g. the job tag and a "/"
 
-    def __init__(
-        self,
-        source_object_name: str,
-        dest_object_name: str,
-        bucket_name: Optional[str] = None,
-    ):
-        self.source_object = source_object_name
-        self.dest_object = dest_object_name
-        self.bucket_name = bucket_name
+        Returns:
+            Dict[str, S3ObjectInfo]: The size and ETag of each object, by key
+        """
+        s3_client = get_client("s3")
+        index: Dict[str, S3ObjectInfo] = {}
+        try:
+            paginator = s3_client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for s3_object in page.get("Contents", []):
+                    index[s3_object["Key"]] = S3ObjectInfo(
+                        s3_object["Size"], s3_object["ETag"]
+                    )
+        except ClientError as err:
+            _LOGGER.exception(
+                "%s ERROR listing '%s' in bucket '%s': %s",
+                job_tag,
+                prefix,
+                bucket_name,
+                err,
+            )
+            raise
+        _LOGGER.debug(
+            "%s Listed %d object(s) under '%s' (bucket: %s)",
+            job_tag,
+            len(index),
+            prefix,
+            bucket_name,
+        )
+        return index
+
+
+@dataclass
+class S3ObjectInfo:
+    size: int
+    etag: str
 
 
 def _extract_job_tag_from_objectname(s3_object_name: str) -> str:
@@ -0,0 +1,60 @@
+"""A small thread-safe cache whose entries expire after a fixed time."""
+
+from threading import Event, Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Cache values for ttl_seconds, shared across warm invocations.
+
+    Values are loaded on a miss by the caller's loader function. Loading
+    happens outside the lock, so a slow load doesn't block other keys.
+    Callers that miss on a key while it is loading wait for that load
+    instead of starting their own, so a key can be prefetched in the
+    background. If the load fails, one of them tries again.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+        self._loading: Dict[Hashable, Event] = {}
+        self._lock = Lock()
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Return the cached value for key, loading it if missing or stale.
+
+        Args:
+            key (Hashable): The cache key
+            loader (Callable[[], Any]): Called to load the value on a miss
+        Returns:
+            Any: The cached or freshly loaded value
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > monotonic():
+                    return entry[1]
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = Event()
+                    break
+            loading.wait()
+
+        try:
+            value = loader()
+            with self._lock:
+                self._entries[key] = (monotonic() + self.ttl_seconds, value)
+            return value
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Drop one entry, or every entry if no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
@@ -30,6 +30,9 @@ def apbs_logger():
 
 _LOGGER = apbs_logger()
 
+# Residue names of water molecules in PQR files
+WATER_RESIDUE_NAMES = (b"HOH", b"WAT")
+
 
 def sanitize_file_name(job_tag: str, file_name: str):
     """Make sure that a file name does not have any special characters in it.
@@ -56,6 +59,27 @@ def sanitize_file_name(job_tag: str, file_name: str):
     return file_name
 
 
+def pqr_is_water(line: bytes) -> bool:
+    """Check whether a PQR line is an atom record of a water molecule.
+
+    PQR files are whitespace-delimited, so the residue name is the third
+    field after the record name. The record name is matched as a prefix,
+    since a 5-digit serial number runs into it (e.g. "HETATM10000").
+
+    Args:
+        line (bytes): A line of a PQR file
+
+    Returns:
+        bool: True if the line is an atom of a water residue
+    """
+    for record_name in (b"ATOM", b"HETATM"):
+        if line.startswith(record_name):
+            record_length = len(record_name)
+            fields = line[record_length:].split(None, 3)
+            return len(fields) > 2 and fields[2] in WATER_RESIDUE_NAMES
+    return False
+
+
 def apbs_extract_input_files(job_tag, infile_text):
     # Read only the READ section of infile,
     # extracting out the files needed for APBS
@@ -1,9 +1,8 @@
 """This file contains utilities to handle options from the GUI."""
 
 from io import StringIO
-from typing import List
+from typing import Dict
 from .utils import _LOGGER, sanitize_file_name
-from .s3_utils import S3CopyPayload
 from os.path import splitext
 
 
@@ -33,7 +32,8 @@ class WebOptions:
         self.runoptions["debump"] = "DEBUMP" in form
         self.runoptions["opt"] = "OPT" in form
 
-        self.files_copy_queue: List[S3CopyPayload] = []
+        # Uploaded file names, keyed by their sanitized names
+        self.original_filenames: Dict[str, str] = {}
 
         if "FF" in form:
             self.ff: str = form["FF"].lower()
@@ -228,36 +228,22 @@ class WebOptions:
         return " ".join(command_line)
 
     def _sanitize_uploaded_file(self, orig_filename: str):
-        """Helper to sanitize a filename, adding to the list of files to later create copies for in S3
+        """Helper to sanitize a filename, remembering the uploaded name
 
         Args:
             orig_filename (str): Name of the source file
         """
         sanitized_filename = sanitize_file_name(self.job_tag, orig_filename)
         if orig_filename != sanitized_filename:
-            self._add_to_copy_queue(orig_filename, sanitized_filename)
+            _LOGGER.debug(
+                "%s Uploaded file '%s' will be downloaded as '%s'",
+                self.job_tag,
+                orig_filename,
+                sanitized_filename,
+            )
+            self.original_filenames[sanitized_filename] = orig_filename
         return sanitized_filename
 
-    def _add_to_copy_queue(self, source_filename: str, dest_filename: str):
-        """Add to the list of file objects to later create copies for.
-
-        Args:
-            source_filename (str): Name of source file
-            dest_filename (str): Name of destination file
-        """
-        original_object_name = f"{self.job_tag}/{source_filename}"
-        destination_object_name = f"{self.job_tag}/{dest_filename}"
-
-        _LOGGER.debug(
-            "%s Adding payload to S3 copy queue (source: '%s', destination: '%s')",
-            self.job_tag,
-            original_object_name,
-            destination_object_name,
-        )
-        self.files_copy_queue.append(
-            S3CopyPayload(original_object_name, destination_object_name)
-        )
-
     def __contains__(self, item):
         """Helper for checking for the presence of an option"""
         return item in self.runoptions or item in self.otheroptions
@@ -2,31 +2,79 @@
 """Software to run apbs and pdb2pqr jobs."""
 
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from enum import Enum
+from hashlib import sha256
 from json import dumps, loads, JSONDecodeError
 from logging import basicConfig, getLogger, DEBUG, INFO, StreamHandler
-from os import chdir, getenv, getpid, listdir, makedirs
+from math import ceil
+from os import (
+    _exit,
+    getenv,
+    getpid,
+    makedirs,
+    remove,
+    replace,
+    scandir,
+    sched_getaffinity,
+    sysconf,
+    wait4,
+    waitid,
+    P_PID,
+    WEXITED,
+    WEXITSTATUS,
+    WIFSIGNALED,
+    WNOWAIT,
+    WTERMSIG,
+)
 from pathlib import Path
-from resource import getrusage, RUSAGE_CHILDREN
-from shutil import rmtree
+from random import uniform
+from resource import struct_rusage
+from shutil import copyfileobj, rmtree
 import signal
-from subprocess import run, CalledProcessError, PIPE
+from socket import gethostname
+from subprocess import Popen, PIPE
+from threading import Event, Lock, Thread, get_ident
 from time import sleep, time
-from typing import Any, Dict, List, Optional
-from urllib import request
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
 from sys import stderr
-import sys
-from boto3 import client, resource
+from uuid import uuid4
+from boto3 import client
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from boto3.session import Session
+from botocore.config import Config
+from botocore import __version__ as botocore_version
 from botocore.exceptions import ClientError, ParamValidationError
+from urllib3 import PoolManager, Retry, Timeout
 
 
 # Global Environment Variables
 GLOBAL_VARS = {
     "Q_TIMEOUT": None,
     "AWS_REGION": None,
-    "MAX_TRIES": None,
+    "MAX_IDLE_TIME": None,
     "RETRY_TIME": None,
+    "WAIT_TIME": None,
+    "MAX_MESSAGES": None,
+    "WORKER_PROFILE": None,
+    "JOB_SLOTS": None,
+    "TRANSFER_THREADS": None,
+    "INPUT_CACHE_DIR": None,
+    "INPUT_CACHE_MB": None,
+    "INPUT_CACHE_BUCKET": None,
+    "INPUT_CACHE_PREFIX": None,
+    "LOG_MAX_BYTES": None,
+    "SAMPLE_SECONDS": None,
+    "MAX_SAMPLES": None,
+    "HEARTBEAT_TIMEOUT": None,
+    "DRAIN_GRACE_SECONDS": None,
+    "APBS_CPUS": None,
+    "APBS_MEMORY_MB": None,
+    "PDB2PQR_CPUS": None,
+    "PDB2PQR_MEMORY_MB": None,
     "LOG_LEVEL": INFO,
     "JOB_PATH": None,
     "S3_TOPLEVEL_BUCKET": None,
@@ -46,6 +94,88 @@ basicConfig(
 # Default to start processing immediately
 PROCESSING = True
 
+# Set on SIGTERM: take no new work, then finish or requeue running jobs
+DRAINING = Event()
+# Set once the drain grace period is over and running jobs are killed
+_ABORTING = Event()
+# Processes of running jobs, so that a drain can kill them
+_JOB_PROCS: set = set()
+_JOB_PROCS_LOCK = Lock()
+# How often the main loop looks for a drain while jobs run, in seconds
+DRAIN_CHECK_SECONDS = 1
+
+LOG_CHUNK_SIZE = 64 * 1024
+
+# Status documents of running jobs, with their ETag, by S3 object key
+_STATUS_CACHE: Dict[str, Tuple[Dict, str]] = {}
+_STATUS_CACHE_LOCK = Lock()
+STATUS_WRITE_ATTEMPTS = 3
+# PutObject parameters that status writes and job leases need from botocore
+CONDITIONAL_WRITE_PARAMS = ("IfMatch", "IfNoneMatch")
+# The job service uploads a job's status while enqueueing it, so a job may
+#   arrive before its status file; wait this many seconds per attempt
+STATUS_READ_DELAYS = (0.5, 1, 2, 4)
+
+# Manifests of finished jobs in the input bucket, by result cache key
+RESULT_CACHE_PREFIX = "result-cache/"
+
+# Claims on jobs being run, in the output bucket, by job tag
+JOB_LEASE_PREFIX = "job-lease/"
+# Job states after which a redelivered message has nothing left to do
+FINISHED_STATES = ("complete", "failed")
+
+# Pooled AWS clients, shared by every job this worker runs
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(getenv("AWS_MAX_POOL_CONNECTIONS", "50")),
+    retries={
+        "max_attempts": int(getenv("AWS_MAX_ATTEMPTS", "5")),
+        "mode": getenv("AWS_RETRY_MODE", "adaptive"),
+    },
+    tcp_keepalive=True,
+)
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(getenv("S3_MULTIPART_THRESHOLD", 64 * 1024**2)),
+    multipart_chunksize=int(getenv("S3_MULTIPART_CHUNKSIZE", 16 * 1024**2)),
+    max_concurrency=int(getenv("S3_TRANSFER_CONCURRENCY", "8")),
+)
+_CLIENTS: Dict[Tuple[str, Optional[str]], Any] = {}
+_CLIENTS_LOCK = Lock()
+_SESSION: Optional[Session] = None
+
+# Pooled HTTP connections for URL inputs (e.g. RCSB downloads)
+HTTP_POOL = PoolManager(
+    maxsize=int(getenv("TRANSFER_THREADS", "8")),
+    retries=Retry(
+        total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503)
+    ),
+    timeout=Timeout(connect=10, read=60),
+)
+_INPUT_CACHE: Optional["InputCache"] = None
+_INPUT_CACHE_LOCK = Lock()
+
+# Defaults for workers of each queue lane, chosen with WORKER_PROFILE.
+# Environment variables still override them.
+WORKER_PROFILES: Dict[str, Dict[str, str]] = {
+    # Many short interactive jobs, one CPU each
+    "small": {
+        "JOB_SLOTS": "4",
+        "SQS_MAX_MESSAGES": "4",
+        "APBS_CPUS": "1",
+        "APBS_MEMORY_MB": "2048",
+        "PDB2PQR_CPUS": "1",
+        "PDB2PQR_MEMORY_MB": "1024",
+    },
+    # Long or memory-hungry jobs, each given the whole worker
+    "large": {
+        "JOB_SLOTS": "1",
+        "SQS_MAX_MESSAGES": "1",
+        "APBS_CPUS": "0",
+        "APBS_MEMORY_MB": "8192",
+        "PDB2PQR_CPUS": "1",
+        "PDB2PQR_MEMORY_MB": "2048",
+    },
+}
+
 
 class JOBTYPE(Enum):
     """The valid values for a job's type."""
@@ -64,14 +194,184 @@ class JOBSTATUS(Enum):
     FAILED = 4
 
 
+def read_proc_stats() -> Dict[int, List[str]]:
+    """Read /proc/[pid]/stat of every process, without the PID and name.
+
+    :return:  The fields of each process, from the state onwards (so the
+              parent PID is at index 1), by PID
+    :rtype:  Dict[int, List[str]]
+    """
+    stats = {}
+    for entry in scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as fin:
+                stat = fin.read()
+        except OSError:
+            continue
+        # The command name is in parentheses and may contain anything
+        fields_start = stat.rfind(")") + 2
+        stats[int(entry.name)] = stat[fields_start:].split()
+    return stats
+
+
+class ResourceSampler:
+    """
+    Sample the resource use of a job's process tree while it runs.
+
+    Every interval seconds a background thread sums, over the job's
+    process and its descendants, the resident memory, CPU utilisation
+    (percent of one CPU since the last sample), threads, bytes written to
+    storage and open files. Each series is a ring buffer of max_samples
+    values, so a long job keeps only its latest samples.
+    """
+
+    FIELDS = (
+        "seconds",
+        "rss_bytes",
+        "cpu_percent",
+        "threads",
+        "write_bytes",
+        "open_files",
+    )
+
+    def __init__(self, pid: int, interval: float, max_samples: int):
+        self._pid = pid
+        self._interval = interval
+        self.series: Dict[str, deque] = {
+            name: deque(maxlen=max_samples) for name in self.FIELDS
+        }
+        self.count = 0
+        self._start = time()
+        self._last = (self._start, 0.0)
+        self._stopped = Event()
+        self._thread: Optional[Thread] = None
+
+    def _tree(self, stats: Dict[int, List[str]]) -> List[int]:
+        children: Dict[int, List[int]] = {}
+        for pid, fields in stats.items():
+            children.setdefault(int(fields[1]), []).append(pid)
+        tree = []
+        pending = [self._pid] if self._pid in stats else []
+        while pending:
+            pid = pending.pop()
+            tree.append(pid)
+            pending.extend(children.get(pid, []))
+        return tree
+
+    def sample(self):
+        """Record one sample of the process tree, if it is still alive."""
+        stats = read_proc_stats()
+        tree = self._tree(stats)
+        if not tree:
+            return
+        now = time()
+        cpu_ticks = rss_pages = threads = write_bytes = open_files = 0
+        for pid in tree:
+            fields = stats[pid]
+            # utime, stime, and those of reaped children
+            cpu_ticks += sum(int(value) for value in fields[11:15])
+            threads += int(fields[17])
+            rss_pages += int(fields[21])
+            try:
+                with open(f"/proc/{pid}/io") as fin:
+                    for line in fin:
+                        if line.startswith("write_bytes:"):
+                            write_bytes += int(line.split()[1])
+                open_files += sum(1 for _ in scandir(f"/proc/{pid}/fd"))
+            except OSError:
+                # Exited since the stats were read, or not ours to read
+                pass
+        cpu_seconds = cpu_ticks / sysconf("SC_CLK_TCK")
+        last_time, last_cpu = self._last
+        self._last = (now, cpu_seconds)
+        cpu_percent = 100 * max(cpu_seconds - last_cpu, 0) / (now - last_time)
+        for name, value in zip(
+            self.FIELDS,
+            (
+                round(now - self._start, 1),
+                rss_pages * sysconf("SC_PAGE_SIZE"),
+                round(cpu_percent, 1),
+                threads,
+                write_bytes,
+                open_files,
+            ),
+        ):
+            self.series[name].append(value)
+        self.count += 1
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.sample()
+
+    def start(self):
+        """Start sampling in the background."""
+        self._stopped.clear()
+        self._thread = Thread(
+            target=self._run, name=f"sampler-{self._pid}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get_timeseries(self) -> Dict:
+        """
+        Get the kept samples, one list per field.
+
+        :return:  The sampling interval, the number of samples taken and
+                  dropped, and the samples
+        :rtype:  Dict
+        """
+        kept = len(self.series["seconds"])
+        return {
+            "interval_seconds": self._interval,
+            "samples": kept,
+            "dropped_samples": self.count - kept,
+            "series": {name: list(self.series[name]) for name in self.FIELDS},
+        }
+
+
+class PhaseTimer:
+    """
+    Add up the time a job spends in each of its phases.
+
+    Each lap() charges the time since the previous lap (or since the timer
+    was created) to the named phase, so consecutive phases cover the job's
+    time in the worker without gaps.
+    """
+
+    def __init__(self):
+        self.started = time()
+        self._last = self.started
+        self.phases: Dict[str, float] = {}
+
+    def add(self, phase: str, seconds: float):
+        """Charge some seconds to a phase."""
+        self.phases[phase] = round(self.phases.get(phase, 0) + seconds, 3)
+
+    def lap(self, phase: str):
+        """Charge the time since the previous lap to a phase."""
+        now = time()
+        self.add(phase, now - self._last)
+        self._last = now
+
+
 class JobMetrics:
     """
     A way to collect metrics from a subprocess.
 
-    To get memory, we use resource.getrusage(RUSAGE_CHILDREN).
-    To avoid accumulating the memory usage from all subprocesses
-    we subtract the previous rusage values to get a delta for
-    just the current subprocess.
+    To get memory, CPU time and I/O counts, the job's process is reaped
+    with os.wait4(), which returns the resource usage of that process (and
+    of any children it waited for) alone. Unlike getrusage(RUSAGE_CHILDREN)
+    this is exact for concurrent jobs, and ru_maxrss is the job's own peak.
+    (Linux counts the RSS the process had before exec, so ru_maxrss is
+    never below the worker's own RSS at the time the job started.)
 
     To get the time to run metrics we subtract the start time from
     the end time (e.g., {jobtype}_end_time - {jobtype}_start_time)
@@ -106,72 +406,104 @@ class JobMetrics:
             "runtime_in_seconds": 262,
             "disk_storage_in_bytes": 4003345,
         },
+        "features": {
+            "calc_type": "mg-auto",
+            "grid_points": 1216609,
+            "atoms": 913
+        },
+        "timings": {
+            "worker": {
+                "queue_wait": 3.204,
+                "claim": 0.061,
+                "download": 0.412,
+                "status_updates": 0.048,
+                "execution": 262.31,
+                "metrics": 0.002,
+                "upload": 1.873,
+                "cleanup": 0.011
+            },
+            "submission": {
+                "fetch_job_info": 0.043,
+                "prepare_job": 0.187,
+                "enqueue": 0.065
+            }
+        }
     }
+
+    The "features" are those the job service sent with the job (if any),
+    kept so the runtime/memory estimator can be trained from these files.
+    For PDB2PQR jobs whose structure the job service couldn't size (e.g.
+    an RCSB ID), the worker fills in "atoms" once the file is downloaded.
+    The "timings" are the seconds spent in each phase of the job, by the
+    worker and (if the message carried them) by the job service. The
+    metrics are uploaded last, so only the final status update is left out.
+
+    With a ResourceSampler attached, its samples are uploaded next to the
+    metrics, as {jobtype}-timeseries.json, but not listed in the job's
+    output files.
     """
 
+    RUSAGE_FIELDS = (
+        "ru_utime",
+        "ru_stime",
+        "ru_maxrss",
+        "ru_ixrss",
+        "ru_idrss",
+        "ru_isrss",
+        "ru_minflt",
+        "ru_majflt",
+        "ru_nswap",
+        "ru_inblock",
+        "ru_oublock",
+        "ru_msgsnd",
+        "ru_msgrcv",
+        "ru_nsignals",
+        "ru_nvcsw",
+        "ru_nivcsw",
+    )
+
     def __init__(self):
-        """Capture the initial state of the resource usage."""
-        metrics = getrusage(RUSAGE_CHILDREN)
+        """Start with no resource usage recorded."""
         self.output_dir = None
         self._start_time = 0
         self._end_time = 0
         self.exit_code = None
-        self.values: Dict = {}
-        self.values["ru_utime"] = metrics.ru_utime
-        self.values["ru_stime"] = metrics.ru_stime
-        self.values["ru_maxrss"] = metrics.ru_maxrss
-        self.values["ru_ixrss"] = metrics.ru_ixrss
-        self.values["ru_idrss"] = metrics.ru_idrss
-        self.values["ru_isrss"] = metrics.ru_isrss
-        self.values["ru_minflt"] = metrics.ru_minflt
-        self.values["ru_majflt"] = metrics.ru_majflt
-        self.values["ru_nswap"] = metrics.ru_nswap
-        self.values["ru_inblock"] = metrics.ru_inblock
-        self.values["ru_oublock"] = metrics.ru_oublock
-        self.values["ru_msgsnd"] = metrics.ru_msgsnd
-        self.values["ru_msgrcv"] = metrics.ru_msgrcv
-        self.values["ru_nsignals"] = metrics.ru_nsignals
-        self.values["ru_nvcsw"] = metrics.ru_nvcsw
-        self.values["ru_nivcsw"] = metrics.ru_nivcsw
-
-    def get_rusage_delta(self):
+        self.features: Optional[Dict] = None
+        self.sampler: Optional[ResourceSampler] = None
+        self.disk_usage = 0
+        self.phases = PhaseTimer()
+        self.submission_timings: Optional[Dict] = None
+        self.sent_at: Optional[float] = None
+        self.values: Dict = {name: 0 for name in self.RUSAGE_FIELDS}
+
+    def record_rusage(self, usage: struct_rusage):
+        """Keep the resource usage of the job's reaped process.
+
+        :param usage:  The rusage returned by os.wait4() for the process
         """
-        Caluculate the difference between the last time getrusage
-        was called and now.
+        for name in self.RUSAGE_FIELDS:
+            self.values[name] = getattr(usage, name)
+        self.values["ru_utime"] = round(usage.ru_utime, 2)
+        self.values["ru_stime"] = round(usage.ru_stime, 2)
+
+    def get_rusage(self):
+        """
+        Get the resource usage of the job's process.
 
-        :param memory_disk_usage: Need to subtract out the files in memory.
         :return:  The rusage values as a dictionary
         :rtype:  Dict
         """
-        metrics = getrusage(RUSAGE_CHILDREN)
-        self.values["ru_utime"] = round(
-            metrics.ru_utime - self.values["ru_utime"], 2
-        )
-        self.values["ru_stime"] = round(
-            metrics.ru_stime - self.values["ru_stime"], 2
-        )
-        self.values["ru_maxrss"] = metrics.ru_maxrss - self.values["ru_maxrss"]
-        self.values["ru_ixrss"] = metrics.ru_ixrss - self.values["ru_ixrss"]
-        self.values["ru_idrss"] = metrics.ru_idrss - self.values["ru_idrss"]
-        self.values["ru_isrss"] = metrics.ru_isrss - self.values["ru_isrss"]
-        self.values["ru_minflt"] = metrics.ru_minflt - self.values["ru_minflt"]
-        self.values["ru_majflt"] = metrics.ru_majflt - self.values["ru_majflt"]
-        self.values["ru_nswap"] = metrics.ru_nswap - self.values["ru_nswap"]
-        self.values["ru_inblock"] = (
-            metrics.ru_inblock - self.values["ru_inblock"]
-        )
-        self.values["ru_oublock"] = (
-            metrics.ru_oublock - self.values["ru_oublock"]
-        )
-        self.values["ru_msgsnd"] = metrics.ru_msgsnd - self.values["ru_msgsnd"]
-        self.values["ru_msgrcv"] = metrics.ru_msgrcv - self.values["ru_msgrcv"]
-        self.values["ru_nsignals"] = (
-            metrics.ru_nsignals - self.values["ru_nsignals"]
-        )
-        self.values["ru_nvcsw"] = metrics.ru_nvcsw - self.values["ru_nvcsw"]
-        self.values["ru_nivcsw"] = metrics.ru_nivcsw - self.values["ru_nivcsw"]
         return self.values
 
+    def measure_storage(self, output_dir: str):
+        """Record the disk usage of the job directory before it is removed.
+
+        Args:
+            output_dir (str): The directory to find the output files.
+        """
+        self.output_dir = Path(output_dir)
+        self.disk_usage = self.get_storage_usage()
+
     def get_storage_usage(self):
         """Get the total number of bytes of the output files.
 
@@ -216,6 +548,27 @@ class JobMetrics:
         """
         self._exit_code = exit_code
 
+    def get_timings(self):
+        """
+        Get the seconds spent in each phase of the job.
+
+        The time from the job service preparing the job to SQS accepting
+        its message is derived from the message's SentTimestamp.
+
+        Returns:
+            Dict: The worker's phases, and the job service's if known.
+        """
+        timings = {"worker": dict(self.phases.phases)}
+        if self.submission_timings is not None:
+            submission = dict(self.submission_timings)
+            prepared_at = submission.pop("prepared_at", None)
+            if prepared_at is not None and self.sent_at is not None:
+                submission["enqueue"] = round(
+                    max(self.sent_at - prepared_at, 0), 3
+                )
+            timings["submission"] = submission
+        return timings
+
     def get_metrics(self):
         """
         Create a dictionary of memory usage, execution time, and amount of
@@ -227,25 +580,33 @@ class JobMetrics:
         metrics = {
             "metrics": {"rusage": {}},
         }
-        disk_usage = self.get_storage_usage()
-        metrics["metrics"]["rusage"] = self.get_rusage_delta()
+        metrics["metrics"]["rusage"] = self.get_rusage()
         metrics["metrics"]["runtime_in_seconds"] = round(
             self.end_time - self.start_time, 2
         )
-        metrics["metrics"]["disk_storage_in_bytes"] = disk_usage
+        metrics["metrics"]["disk_storage_in_bytes"] = self.disk_usage
         metrics["metrics"]["exit_code"] = self.exit_code
+        if self.features is not None:
+            metrics["features"] = self.features
+        metrics["timings"] = self.get_timings()
         return metrics
 
-    def write_metrics(self, job_tag: str, job_type: str, output_dir: str):
-        """Get the metrics of the latest subprocess and create the output file.
+    def publish_metrics(
+        self, s3client: client, job_tag: str, job_type: str
+    ) -> List[str]:
+        """Upload the metrics, and the samples if any, to the output bucket.
+
+        They are built in memory and uploaded after the job directory is
+        gone, so that they include the time spent uploading and cleaning up.
 
         Args:
+            s3client (client): S3 client used to upload the files.
+            job_tag (str): Unique ID for this job.
             job_type (str): Either "apbs" or "pdb2pqr".
-            output_dir (str): The directory to find the output files.
         Returns:
-            N/A
+            List[str]: The S3 object keys that were uploaded and belong in
+                the job's output files (not the samples).
         """
-        self.output_dir = Path(output_dir)
         metrics = self.get_metrics()
         _LOGGER.info(
             "%s %s METRICS: exit_code %s %s",
@@ -254,8 +615,35 @@ class JobMetrics:
             metrics["metrics"]["exit_code"],
             metrics,
         )
-        with open(f"{job_type}-metrics.json", "w") as fout:
-            fout.write(dumps(metrics, indent=4))
+        # The document bodies, and whether they are listed as job outputs
+        documents = {
+            f"{job_type}-metrics.json": (dumps(metrics, indent=4), True)
+        }
+        if self.sampler is not None and self.sampler.count:
+            documents[f"{job_type}-timeseries.json"] = (
+                dumps(self.sampler.get_timeseries(), separators=(",", ":")),
+                False,
+            )
+
+        uploaded = []
+        for name, (body, is_output) in documents.items():
+            object_name = f"{job_tag}/{name}"
+            try:
+                s3client.put_object(
+                    Body=body,
+                    Bucket=GLOBAL_VARS["S3_TOPLEVEL_BUCKET"],
+                    Key=object_name,
+                )
+                if is_output:
+                    uploaded.append(object_name)
+            except ClientError as error:
+                _LOGGER.exception(
+                    "%s ERROR: Failed to upload file, %s \n\t%s",
+                    job_tag,
+                    object_name,
+                    error,
+                )
+        return uploaded
 
 
 def print_current_state():
@@ -289,8 +677,22 @@ def signal_help(signal_number, frame):
 
 def terminate_process(signal_number, frame):
     # pylint: disable=unused-argument
-    print("Caught (SIGTERM) terminating the process\n", file=stderr)
-    sys.exit()
+    # NOTE: A first SIGTERM (e.g. a spot interruption or a scale-in)
+    #       drains the worker, and main() returns once running jobs have
+    #       finished or been requeued. A second one exits right away.
+    if DRAINING.is_set():
+        print("Caught (SIGTERM) terminating the process\n", file=stderr)
+        # sys.exit() would wait in main() for the running jobs to end, so
+        # kill them and leave at once. The handler may interrupt a holder
+        # of _JOB_PROCS_LOCK, so it works on a copy instead of locking.
+        for proc in list(_JOB_PROCS):
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        _exit(0)
+    print("Caught (SIGTERM) draining the worker\n", file=stderr)
+    DRAINING.set()
 
 
 def toggle_processing(signal_number, frame):
@@ -301,19 +703,83 @@ def toggle_processing(signal_number, frame):
     print(f"PROCESSING set to:{PROCESSING}\n", file=stderr)
 
 
+def profile_setting(name: str, default: str) -> str:
+    """Get a setting from the environment, else from the worker profile.
+
+    :param name:  The environment variable name
+    :param default:  The value if neither the environment nor the profile
+                     sets it
+    :return:  The setting
+    :rtype:  str
+    """
+    profile = WORKER_PROFILES.get(GLOBAL_VARS["WORKER_PROFILE"], {})
+    return getenv(name, profile.get(name, default))
+
+
 def update_environment(signal_number, frame):
     # pylint: disable=unused-argument
-    # TODO: This may need to be increased or calculated based
-    #       on complexity of the job (dimension of molecule?)
-    #       The job could get launched multiple times if the
-    #       job takes longer than Q_TIMEOUT
+    # NOTE: Running jobs keep their message invisible through a
+    #       VisibilityHeartbeat, so Q_TIMEOUT only needs to cover the
+    #       time between receiving a message and starting its job.
     global GLOBAL_VARS
+    GLOBAL_VARS["WORKER_PROFILE"] = getenv("WORKER_PROFILE")
+    if GLOBAL_VARS["WORKER_PROFILE"] not in (None, *WORKER_PROFILES):
+        raise ValueError(
+            f"Unknown WORKER_PROFILE '{GLOBAL_VARS['WORKER_PROFILE']}'"
+        )
     GLOBAL_VARS["Q_TIMEOUT"] = int(getenv("SQS_QUEUE_TIMEOUT", "300"))
     GLOBAL_VARS["AWS_REGION"] = getenv("SQS_AWS_REGION", "us-west-2")
-    GLOBAL_VARS["MAX_TRIES"] = int(getenv("SQS_MAX_TRIES", "60"))
+    # Seconds the queue must stay empty before the worker stops receiving
+    GLOBAL_VARS["MAX_IDLE_TIME"] = int(getenv("SQS_MAX_IDLE_TIME", "900"))
     GLOBAL_VARS["RETRY_TIME"] = int(getenv("SQS_RETRY_TIME", "15"))
+    GLOBAL_VARS["WAIT_TIME"] = min(int(getenv("SQS_WAIT_TIME", "20")), 20)
+    GLOBAL_VARS["MAX_MESSAGES"] = min(
+        int(profile_setting("SQS_MAX_MESSAGES", "1")), 10
+    )
+    GLOBAL_VARS["JOB_SLOTS"] = max(int(profile_setting("JOB_SLOTS", "1")), 1)
+    GLOBAL_VARS["TRANSFER_THREADS"] = max(
+        int(getenv("TRANSFER_THREADS", "8")), 1
+    )
+    # Local cache of input files (0 MB disables it), optionally backed by
+    # a shared S3 prefix for URL inputs
+    GLOBAL_VARS["INPUT_CACHE_MB"] = int(getenv("INPUT_CACHE_MB", "1024"))
+    GLOBAL_VARS["INPUT_CACHE_BUCKET"] = getenv("INPUT_CACHE_BUCKET")
+    GLOBAL_VARS["INPUT_CACHE_PREFIX"] = getenv(
+        "INPUT_CACHE_PREFIX", "input-cache/"
+    )
+    GLOBAL_VARS["HEARTBEAT_TIMEOUT"] = max(
+        int(getenv("SQS_HEARTBEAT_TIMEOUT", "120")), 3
+    )
+    # Time running jobs get to finish after a SIGTERM before they are
+    # killed and requeued; keep it well below the container's stop timeout
+    # (ECS: stopTimeout, 30 s by default)
+    GLOBAL_VARS["DRAIN_GRACE_SECONDS"] = max(
+        int(getenv("DRAIN_GRACE_SECONDS", "20")), 0
+    )
+    # Cap on each of stdout/stderr of a job, in bytes (0 for no limit)
+    GLOBAL_VARS["LOG_MAX_BYTES"] = int(getenv("LOG_MAX_BYTES", "0"))
+    # Resource samples of running jobs (0 seconds, the default, disables
+    # them); only the latest MAX_SAMPLES samples of a job are kept
+    GLOBAL_VARS["SAMPLE_SECONDS"] = float(
+        getenv("METRICS_SAMPLE_SECONDS", "0")
+    )
+    GLOBAL_VARS["MAX_SAMPLES"] = max(
+        int(getenv("METRICS_MAX_SAMPLES", "4096")), 1
+    )
+    # A CPU count of 0 means the job may use every CPU of the worker
+    GLOBAL_VARS["APBS_CPUS"] = int(profile_setting("APBS_CPUS", "0"))
+    GLOBAL_VARS["APBS_MEMORY_MB"] = int(
+        profile_setting("APBS_MEMORY_MB", "4096")
+    )
+    GLOBAL_VARS["PDB2PQR_CPUS"] = int(profile_setting("PDB2PQR_CPUS", "1"))
+    GLOBAL_VARS["PDB2PQR_MEMORY_MB"] = int(
+        profile_setting("PDB2PQR_MEMORY_MB", "1024")
+    )
     GLOBAL_VARS["LOG_LEVEL"] = int(getenv("LOG_LEVEL", str(INFO)))
     GLOBAL_VARS["JOB_PATH"] = getenv("JOB_PATH", "/var/tmp/")
+    GLOBAL_VARS["INPUT_CACHE_DIR"] = getenv(
+        "INPUT_CACHE_DIR", f"{GLOBAL_VARS['JOB_PATH']}input-cache"
+    )
     GLOBAL_VARS["S3_TOPLEVEL_BUCKET"] = getenv("OUTPUT_BUCKET")
     GLOBAL_VARS["QUEUE"] = getenv("JOB_QUEUE_NAME")
     _LOGGER.setLevel(GLOBAL_VARS["LOG_LEVEL"])
@@ -324,9 +790,42 @@ def update_environment(signal_number, frame):
         raise ValueError("Environment variable 'JOB_QUEUE_NAME' is not set")
 
 
+def get_client(service_name: str, region_name: Optional[str] = None) -> Any:
+    """Return a pooled boto3 client, creating it on first use.
+
+    :param service_name:  The AWS service name (e.g. "s3", "sqs")
+    :param region_name:  The AWS region; the default region if None
+    :return:  The shared client for the service and region
+    :rtype:  botocore.client.BaseClient
+    """
+    global _SESSION
+    key = (service_name, region_name)
+    service_client = _CLIENTS.get(key)
+    if service_client is not None:
+        return service_client
+
+    # Building clients is not thread-safe, using them is
+    with _CLIENTS_LOCK:
+        service_client = _CLIENTS.get(key)
+        if service_client is None:
+            if _SESSION is None:
+                _SESSION = Session()
+            service_client = _SESSION.client(
+                service_name, region_name=region_name, config=CLIENT_CONFIG
+            )
+            _CLIENTS[key] = service_client
+    return service_client
+
+
 def get_messages(sqs: client, qurl: str) -> Any:
     """Get SQS Messages from the queue.
 
+    Each receive long-polls for up to WAIT_TIME seconds and asks for up to
+    MAX_MESSAGES messages. While the queue stays empty, the pause between
+    receives grows (with jitter) up to RETRY_TIME. Once the queue has been
+    empty for MAX_IDLE_TIME seconds, counting the long polls, or once the
+    worker starts draining, give up.
+
     :param sqs:  S3 output bucket for the job being updated
     :type sqs:  boto3.client connection
     :param qurl:  URL for the SNS Queue to listen for new messages
@@ -334,25 +833,515 @@ def get_messages(sqs: client, qurl: str) -> Any:
     :rtype:  Any
     """
     loop = 0
+    idle_deadline = time() + GLOBAL_VARS["MAX_IDLE_TIME"]
 
-    messages = sqs.receive_message(
-        QueueUrl=qurl,
-        MaxNumberOfMessages=1,
-        VisibilityTimeout=GLOBAL_VARS["Q_TIMEOUT"],
-    )
-
-    while "Messages" not in messages:
-        loop += 1
-        if loop == GLOBAL_VARS["MAX_TRIES"]:
-            return None
-        _LOGGER.debug("Waiting ....")
-        sleep(GLOBAL_VARS["RETRY_TIME"])
+    while True:
         messages = sqs.receive_message(
             QueueUrl=qurl,
-            MaxNumberOfMessages=1,
+            MaxNumberOfMessages=GLOBAL_VARS["MAX_MESSAGES"],
             VisibilityTimeout=GLOBAL_VARS["Q_TIMEOUT"],
+            WaitTimeSeconds=GLOBAL_VARS["WAIT_TIME"],
+            AttributeNames=["SentTimestamp"],
+        )
+        if "Messages" in messages:
+            return messages
+        remaining = idle_deadline - time()
+        if remaining <= 0:
+            return None
+        loop += 1
+        _LOGGER.debug("Waiting ....")
+        delay = min(GLOBAL_VARS["RETRY_TIME"], uniform(0, 2**loop), remaining)
+        if DRAINING.wait(delay):
+            return None
+
+
+class LeasedMessages:
+    """
+    Messages received from SQS but not yet started by this worker.
+
+    A batched receive can return more messages than the worker is about to
+    run. While they wait here, a background thread keeps them invisible to
+    other workers by renewing their visibility timeout (Q_TIMEOUT) at half
+    its length. Releasing the buffer makes them visible again right away.
+    """
+
+    def __init__(self, sqs: client, qurl: str):
+        self._sqs = sqs
+        self._qurl = qurl
+        self._messages: deque = deque()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread: Optional[Thread] = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._messages)
+
+    def add(self, messages: List[Dict]):
+        """Hold messages until they are popped to be run."""
+        with self._lock:
+            self._messages.extend(messages)
+
+    def peek(self) -> Optional[Dict]:
+        """Return the oldest held message without removing it."""
+        with self._lock:
+            if self._messages:
+                return self._messages[0]
+        return None
+
+    def pop(self) -> Optional[Dict]:
+        """Take the oldest held message, or None if there are none."""
+        with self._lock:
+            if self._messages:
+                return self._messages.popleft()
+        return None
+
+    def _set_visibility(self, messages: List[Dict], timeout: int):
+        for start in range(0, len(messages), 10):
+            end = start + 10
+            entries = [
+                {
+                    "Id": str(idx),
+                    "ReceiptHandle": message["ReceiptHandle"],
+                    "VisibilityTimeout": timeout,
+                }
+                for idx, message in enumerate(messages[start:end])
+            ]
+            try:
+                self._sqs.change_message_visibility_batch(
+                    QueueUrl=self._qurl, Entries=entries
+                )
+            except ClientError as cerr:
+                _LOGGER.warning(
+                    "Unable to change visibility of held messages: %s", cerr
+                )
+
+    def renew(self):
+        """Extend the visibility timeout of every held message."""
+        with self._lock:
+            messages = list(self._messages)
+        self._set_visibility(messages, GLOBAL_VARS["Q_TIMEOUT"])
+
+    def release(self):
+        """Return every held message to the queue immediately."""
+        with self._lock:
+            messages = list(self._messages)
+            self._messages.clear()
+        if messages:
+            _LOGGER.info("Releasing %s held message(s)", len(messages))
+            self._set_visibility(messages, 0)
+
+    def _renew_loop(self):
+        while not self._stopped.wait(GLOBAL_VARS["Q_TIMEOUT"] / 2):
+            self.renew()
+
+    def start(self):
+        """Start renewing the visibility of held messages."""
+        self._stopped.clear()
+        self._thread = Thread(
+            target=self._renew_loop, name="sqs-lease", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop renewing and release any messages still held."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.release()
+
+
+class JobClaimedError(Exception):
+    """Raised when another worker holds a live lease on a job."""
+
+    def __init__(self, job_tag: str, holder: Dict, same_message: bool):
+        super().__init__(f"{job_tag} is claimed by {holder.get('owner')}")
+        self.holder = holder
+        self.same_message = same_message
+
+
+class JobInterruptedError(Exception):
+    """Raised when a job is killed because the worker is draining."""
+
+
+class JobLease:
+    """
+    An exclusive, expiring claim on a job, stored as an S3 object.
+
+    SQS may deliver a message more than once. Before a job runs, its worker
+    creates the lease object with a put conditional on it not existing
+    (If-None-Match), which only one worker can win. The lease names its
+    owner, the SQS message and an expiry time. The owner renews it along
+    with the message's visibility and deletes it once the job's final
+    status is written. A lease that has expired, because its owner died,
+    is taken over with a put conditional on its ETag (If-Match).
+    """
+
+    def __init__(
+        self,
+        s3client: client,
+        job_tag: str,
+        job_type: str,
+        message_id: Optional[str] = None,
+    ):
+        self._s3 = s3client
+        self._job_tag = job_tag
+        self._key = f"{JOB_LEASE_PREFIX}{job_tag}/{job_type}.json"
+        self._owner = f"{gethostname()}:{getpid()}:{uuid4().hex}"
+        self._message_id = message_id
+        self._etag: Optional[str] = None
+
+    def _put(self, timeout: int, **condition) -> bool:
+        body = {
+            "owner": self._owner,
+            "message_id": self._message_id,
+            "expires": time() + timeout,
+        }
+        try:
+            response = self._s3.put_object(
+                Body=dumps(body),
+                Bucket=GLOBAL_VARS["S3_TOPLEVEL_BUCKET"],
+                Key=self._key,
+                **condition,
+            )
+        except ClientError as cerr:
+            if cerr.response["Error"]["Code"] in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ):
+                return False
+            raise
+        self._etag = response["ETag"]
+        return True
+
+    def acquire(self, timeout: int):
+        """Claim the job for timeout seconds.
+
+        :param timeout:  Seconds until the lease expires unless renewed
+        :raises JobClaimedError:  If another worker holds a live lease
+        """
+        holder: Dict = {}
+        for _ in range(STATUS_WRITE_ATTEMPTS):
+            if self._put(timeout, IfNoneMatch="*"):
+                return
+            try:
+                s3obj = self._s3.get_object(
+                    Bucket=GLOBAL_VARS["S3_TOPLEVEL_BUCKET"], Key=self._key
+                )
+            except ClientError as cerr:
+                if cerr.response["Error"]["Code"] == "NoSuchKey":
+                    # Released since our put; try to create it again
+                    continue
+                raise
+            holder = loads(s3obj["Body"].read().decode("utf-8"))
+            if holder["expires"] > time():
+                break
+            _LOGGER.warning(
+                "%s Taking over expired lease of %s",
+                self._job_tag,
+                holder["owner"],
+            )
+            if self._put(timeout, IfMatch=s3obj["ETag"]):
+                return
+        raise JobClaimedError(
+            self._job_tag,
+            holder,
+            holder.get("message_id") in (None, self._message_id),
         )
-    return messages
+
+    def renew(self, timeout: int) -> bool:
+        """Extend the lease to timeout seconds from now.
+
+        :param timeout:  Seconds until the lease expires unless renewed
+        :return:  False if the lease was lost to another worker
+        :rtype:  bool
+        """
+        if self._etag is None:
+            return False
+        try:
+            renewed = self._put(timeout, IfMatch=self._etag)
+        except ClientError as cerr:
+            _LOGGER.warning(
+                "%s Unable to renew job lease: %s", self._job_tag, cerr
+            )
+            return True
+        if not renewed:
+            _LOGGER.error(
+                "%s Job lease was taken over by another worker", self._job_tag
+            )
+            self._etag = None
+        return renewed
+
+    def release(self):
+        """Delete the lease, once the job's final status is written.
+
+        The lease is read back first and only deleted if it is still ours,
+        so that a lease taken over after ours expired is left in place.
+        """
+        if self._etag is None:
+            return
+        try:
+            holder = self._s3.head_object(
+                Bucket=GLOBAL_VARS["S3_TOPLEVEL_BUCKET"], Key=self._key
+            )
+            if holder["ETag"] != self._etag:
+                _LOGGER.warning(
+                    "%s Job lease was taken over by another worker",
+                    self._job_tag,
+                )
+            else:
+                self._s3.delete_object(
+                    Bucket=GLOBAL_VARS["S3_TOPLEVEL_BUCKET"], Key=self._key
+                )
+        except ClientError as cerr:
+            _LOGGER.warning(
+                "%s Unable to release job lease: %s", self._job_tag, cerr
+            )
+        self._etag = None
+
+
+class VisibilityHeartbeat:
+    """
+    Extend a message's visibility in small steps while its job runs.
+
+    Used as a context manager around a claimed job, from its download to
+    its final status. On entry, and then every HEARTBEAT_TIMEOUT / 3
+    seconds, the message is made invisible for another HEARTBEAT_TIMEOUT
+    seconds. If the worker dies, the message reappears within one step,
+    not after a pessimistic fixed timeout. The heartbeat keeps going for
+    as long as the job runs, even past max_run_time (an estimate), since
+    letting the message lapse would only get the job run a second time;
+    an overrun is logged once. On exit, the message gets one last lease of
+    Q_TIMEOUT seconds to be deleted. The job's JobLease, if given, is
+    renewed along with the message.
+    """
+
+    def __init__(
+        self,
+        sqs: client,
+        qurl: str,
+        receipt_handle: str,
+        job_tag: str,
+        max_run_time: Optional[int] = None,
+        lease: Optional[JobLease] = None,
+    ):
+        self._sqs = sqs
+        self._qurl = qurl
+        self._receipt_handle = receipt_handle
+        self._job_tag = job_tag
+        self._max_run_time = int(max_run_time) if max_run_time else None
+        self._lease = lease
+        self._stopped = Event()
+        self._thread: Optional[Thread] = None
+
+    def _extend(self, timeout: int) -> bool:
+        if self._lease is not None:
+            self._lease.renew(timeout)
+        try:
+            self._sqs.change_message_visibility(
+                QueueUrl=self._qurl,
+                ReceiptHandle=self._receipt_handle,
+                VisibilityTimeout=timeout,
+            )
+            return True
+        except ClientError as cerr:
+            _LOGGER.warning(
+                "%s Unable to extend message visibility: %s",
+                self._job_tag,
+                cerr,
+            )
+            return False
+
+    def _beat(self):
+        deadline = None
+        if self._max_run_time:
+            deadline = time() + self._max_run_time
+        timeout = GLOBAL_VARS["HEARTBEAT_TIMEOUT"]
+        while not self._stopped.wait(timeout / 3):
+            if deadline is not None and time() >= deadline:
+                _LOGGER.warning(
+                    "%s Job is still running after max_run_time of %s "
+                    "seconds",
+                    self._job_tag,
+                    self._max_run_time,
+                )
+                deadline = None
+            self._extend(timeout)
+
+    def __enter__(self):
+        self._extend(GLOBAL_VARS["HEARTBEAT_TIMEOUT"])
+        self._stopped.clear()
+        self._thread = Thread(
+            target=self._beat, name=f"heartbeat-{self._job_tag}", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self._extend(GLOBAL_VARS["Q_TIMEOUT"])
+        return False
+
+
+def _worker_cpus() -> int:
+    """Count the CPUs this worker may use, honouring a cgroup CPU quota."""
+    cpus = len(sched_getaffinity(0))
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as fin:
+            quota, period = fin.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def _worker_memory_mb() -> int:
+    """Get the memory this worker may use, honouring a cgroup limit."""
+    memory = sysconf("SC_PAGE_SIZE") * sysconf("SC_PHYS_PAGES")
+    for limit_file in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(limit_file) as fin:
+                limit = fin.read().strip()
+            if limit != "max":
+                memory = min(memory, int(limit))
+            break
+        except (OSError, ValueError):
+            continue
+    return memory // (1024 * 1024)
+
+
+def _resource_field(job_info: dict, field: str, default: int) -> int:
+    """Read a CPU or memory amount from a job message.
+
+    A missing, malformed or negative value falls back to the default, so
+    that a bad message can't stop the worker from admitting jobs.
+    """
+    value = job_info.get(field, default)
+    try:
+        amount = int(value)
+    except (TypeError, ValueError):
+        _LOGGER.warning("Ignoring invalid %s in job message: %r", field, value)
+        return default
+    if amount < 0:
+        _LOGGER.warning(
+            "Ignoring negative %s in job message: %s", field, value
+        )
+        return default
+    return amount
+
+
+class ResourceBudget:
+    """
+    Admit jobs into slots by the CPUs and memory they are expected to use.
+
+    Each job reserves CPUs and memory (MB) for as long as it runs. The
+    amounts come from the "cpus" and "memory_mb" fields of the job message
+    when present and valid, or else from the per-job-type defaults in
+    GLOBAL_VARS.
+    A job that needs more than the whole worker is clamped to the whole
+    worker, so it still runs, alone. A job is only admitted if its
+    reservation fits in what the running jobs leave free.
+    """
+
+    def __init__(self):
+        self.cpus = _worker_cpus()
+        self.memory_mb = _worker_memory_mb()
+        self._used_cpus = 0
+        self._used_memory_mb = 0
+        self._lock = Lock()
+        _LOGGER.info(
+            "Job slots: %s, CPUs: %s, memory: %s MB",
+            GLOBAL_VARS["JOB_SLOTS"],
+            self.cpus,
+            self.memory_mb,
+        )
+
+    def request_for(self, job: str) -> Tuple[int, int]:
+        """Get the (CPUs, memory MB) reservation for a job message body."""
+        try:
+            job_info: dict = loads(job)
+        except JSONDecodeError:
+            job_info = {}
+        if not isinstance(job_info, dict):
+            job_info = {}
+        job_type = str(job_info.get("job_type", "")).lower()
+        if JOBTYPE.APBS.name.lower() in job_type:
+            cpus = GLOBAL_VARS["APBS_CPUS"]
+            memory_mb = GLOBAL_VARS["APBS_MEMORY_MB"]
+        else:
+            cpus = GLOBAL_VARS["PDB2PQR_CPUS"]
+            memory_mb = GLOBAL_VARS["PDB2PQR_MEMORY_MB"]
+        cpus = _resource_field(job_info, "cpus", cpus) or self.cpus
+        memory_mb = _resource_field(job_info, "memory_mb", memory_mb)
+        return min(cpus, self.cpus), min(memory_mb, self.memory_mb)
+
+    def try_acquire(self, request: Tuple[int, int]) -> bool:
+        """Reserve resources for a job if they are free."""
+        cpus, memory_mb = request
+        with self._lock:
+            if (
+                self._used_cpus + cpus > self.cpus
+                or self._used_memory_mb + memory_mb > self.memory_mb
+            ):
+                return False
+            self._used_cpus += cpus
+            self._used_memory_mb += memory_mb
+            return True
+
+    def release(self, request: Tuple[int, int]):
+        """Return the resources reserved for a finished job."""
+        cpus, memory_mb = request
+        with self._lock:
+            self._used_cpus -= cpus
+            self._used_memory_mb -= memory_mb
+
+
+def read_status_object(s3client: client, job_tag: str, objectfile: str):
+    """Get a job's status file, waiting a little for it to be created.
+
+    :param s3client:  S3 client for the output bucket
+    :param job_tag:  Unique ID for this job
+    :param objectfile:  The S3 object key of the status file
+    :return:  The S3 get_object response
+    :rtype:  Dict
+    """
+    for delay in STATUS_READ_DELAYS + (None,):
+        try:
+            return s3client.get_object(
+                Bucket=GLOBAL_VARS["S3_TOPLEVEL_BUCKET"], Key=objectfile
+            )
+        except ClientError as cerr:
+            if delay is None or cerr.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            _LOGGER.info(
+                "%s Status file not found yet; retrying in %s s",
+                job_tag,
+                delay,
+            )
+            sleep(delay)
+
+
+def job_is_finished(s3client: client, job_tag: str, job_type: str) -> bool:
+    """Check whether a job already ran, from its status file.
+
+    :param s3client:  S3 client for the output bucket
+    :param job_tag:  Unique ID for this job
+    :param job_type:  The job type (apbs, pdb2pqr, etc.)
+    :return:  True if the job is complete or failed
+    :rtype:  bool
+    """
+    s3obj = read_status_object(
+        s3client, job_tag, f"{job_tag}/{job_type}-status.json"
+    )
+    statobj: dict = loads(s3obj["Body"].read().decode("utf-8"))
+    return statobj[job_type]["status"] in FINISHED_STATES
 
 
 def update_status(
@@ -365,6 +1354,13 @@ def update_status(
 ) -> Dict:
     """Update the status file in the S3 bucket for the current job.
 
+    The status document is read from S3 only on the first update of a job
+    and then kept in _STATUS_CACHE with its ETag. Every write is made
+    conditional on that ETag (If-Match). If someone else changed the file
+    in the meantime, it is read again and the update re-applied, so no
+    update is lost. The cache entry is dropped by the final update, or by
+    run_job if the job ends without one.
+
     :param s3:  S3 output bucket for the job being updated
     :param job_tag:  Unique ID for this job
     :param jobtype:  The job type (apbs, pdb2pqr, etc.)
@@ -373,44 +1369,97 @@ def update_status(
     :return:  Response from storing status file in S3 bucket
     :rtype:  Dict
     """
-    ups3 = resource("s3")
     objectfile = f"{job_tag}/{jobtype}-status.json"
-    s3obj = ups3.Object(GLOBAL_VARS["S3_TOPLEVEL_BUCKET"], objectfile)
-    statobj: dict = loads(s3obj.get()["Body"].read().decode("utf-8"))
+    finished = status in (JOBSTATUS.COMPLETE, JOBSTATUS.FAILED)
 
-    # Update status and timestamps
-    statobj[jobtype]["status"] = status.name.lower()
-    if status == JOBSTATUS.COMPLETE or status == JOBSTATUS.FAILED:
-        statobj[jobtype]["endTime"] = time()
+    object_response = {}
+    for _ in range(STATUS_WRITE_ATTEMPTS):
+        with _STATUS_CACHE_LOCK:
+            cached = _STATUS_CACHE.pop(objectfile, None)
+        if cached is None:
+            s3obj = read_status_object(s3client, job_tag, objectfile)
+            statobj: dict = loads(s3obj["Body"].read().decode("utf-8"))
+            etag: str = s3obj["ETag"]
+        else:
+            statobj, etag = cached
 
-    if status == JOBSTATUS.FAILED and message is not None:
-        statobj[jobtype]["message"] = message
+        # Update status and timestamps
+        statobj[jobtype]["status"] = status.name.lower()
+        if finished:
+            statobj[jobtype]["endTime"] = time()
 
-    statobj[jobtype]["outputFiles"] = output_files
+        if status == JOBSTATUS.FAILED and message is not None:
+            statobj[jobtype]["message"] = message
 
-    object_response = {}
-    try:
-        object_response: dict = s3client.put_object(
-            Body=dumps(statobj),
-            Bucket=GLOBAL_VARS["S3_TOPLEVEL_BUCKET"],
-            Key=objectfile,
-        )
-    except ClientError as cerr:
-        _LOGGER.exception(
-            "%s ERROR: ClientError exception from s3.put_object, %s",
-            job_tag,
-            cerr,
-        )
-    except ParamValidationError as perr:
-        _LOGGER.exception(
-            "%s ERROR: ParamValidation exception from s3.put_object, %s",
-            job_tag,
-            perr,
-        )
+        statobj[jobtype]["outputFiles"] = output_files
 
+        try:
+            object_response: dict = s3client.put_object(
+                Body=dumps(statobj),
+                Bucket=GLOBAL_VARS["S3_TOPLEVEL_BUCKET"],
+                Key=objectfile,
+                IfMatch=etag,
+            )
+        except ClientError as cerr:
+            if cerr.response["Error"]["Code"] in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ):
+                _LOGGER.warning(
+                    "%s Status file changed since it was read; retrying",
+                    job_tag,
+                )
+                continue
+            _LOGGER.exception(
+                "%s ERROR: ClientError exception from s3.put_object, %s",
+                job_tag,
+                cerr,
+            )
+        except ParamValidationError as perr:
+            # A bad request (e.g. a botocore without If-Match) fails every
+            # write the same way, so stop instead of losing every status
+            _LOGGER.exception(
+                "%s ERROR: ParamValidation exception from s3.put_object, %s",
+                job_tag,
+                perr,
+            )
+            raise
+        else:
+            if not finished:
+                with _STATUS_CACHE_LOCK:
+                    _STATUS_CACHE[objectfile] = (
+                        statobj,
+                        object_response["ETag"],
+                    )
+        return object_response
+
+    _LOGGER.error(
+        "%s ERROR: Gave up updating status file after %s conflicts",
+        job_tag,
+        STATUS_WRITE_ATTEMPTS,
+    )
     return object_response
 
 
+def check_conditional_writes(s3client: client):
+    """Make sure botocore can send the conditional S3 writes we rely on.
+
+    :param s3client:  The S3 client the worker writes with
+    :raises RuntimeError:  If PutObject lacks a conditional parameter
+    """
+    members = s3client.meta.service_model.operation_model(
+        "PutObject"
+    ).input_shape.members
+    missing = [
+        name for name in CONDITIONAL_WRITE_PARAMS if name not in members
+    ]
+    if missing:
+        raise RuntimeError(
+            f"botocore {botocore_version} can't send {missing} with "
+            "PutObject; install botocore 1.35.99 or later"
+        )
+
+
 def cleanup_job(job_tag: str, rundir: str) -> int:
     """Remove the directory for the job.
 
@@ -418,73 +1467,650 @@ def cleanup_job(job_tag: str, rundir: str) -> int:
     :return:  int
     """
     _LOGGER.info("%s Deleting run directory, %s", job_tag, rundir)
-    chdir(GLOBAL_VARS["JOB_PATH"])
     rmtree(rundir)
     return 1
 
 
+class InputCache:
+    """A size-bounded, least recently used cache of input files on disk.
+
+    Job slots share one cache. Files are filled once: a slot that asks for
+    a file another slot is already fetching waits for that fetch instead
+    of starting its own. Cached files are copied into the run directory,
+    so a job that changes its inputs can't corrupt the cache.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        :param cache_dir:  The directory to keep cached files in
+        :param max_bytes:  The most bytes of files to keep
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._size = 0
+        self._fills: Dict[str, Event] = {}
+        self._lock = Lock()
+
+        # Adopt files left by an earlier run, oldest first
+        makedirs(cache_dir, exist_ok=True)
+        with scandir(cache_dir) as entries:
+            found = sorted(
+                (entry.stat().st_mtime_ns, entry.name, entry.stat().st_size)
+                for entry in entries
+                if entry.is_file()
+            )
+        for _, name, size in found:
+            if name.endswith(".part"):
+                remove(f"{cache_dir}/{name}")
+                continue
+            self._entries[name] = size
+            self._size += size
+        self._evict()
+
+    def _evict(self):
+        """Drop the least recently used files until within max_bytes.
+
+        Must be called with the lock held. The newest file is kept.
+        """
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                remove(f"{self.cache_dir}/{name}")
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, key: str, dest: str, fill: Callable[[str], None]) -> bool:
+        """Copy the file cached for key to dest, filling it on a miss.
+
+        :param key:  What identifies the file's contents (URL, S3 ETag)
+        :param dest:  The local path to copy the file to
+        :param fill:  Downloads the file to the path it is given
+        :return:  True if the file was already cached
+        :rtype:  bool
+        """
+        name = sha256(key.encode("utf-8")).hexdigest()
+        path = f"{self.cache_dir}/{name}"
+        hit = True
+        while True:
+            with self._lock:
+                if name in self._entries:
+                    self._entries.move_to_end(name)
+                    # An open file survives its eviction
+                    fin = open(path, "rb")
+                    break
+                pending = self._fills.get(name)
+                if pending is None:
+                    self._fills[name] = Event()
+            if pending is not None:
+                pending.wait()
+                continue
+
+            hit = False
+            partial = f"{path}.{get_ident()}.part"
+            try:
+                fill(partial)
+                size = Path(partial).stat().st_size
+                if size > self.max_bytes:
+                    replace(partial, dest)
+                    return hit
+                replace(partial, path)
+                with self._lock:
+                    self._entries[name] = size
+                    self._size += size
+                    self._evict()
+            except BaseException:
+                if Path(partial).exists():
+                    remove(partial)
+                raise
+            finally:
+                with self._lock:
+                    self._fills.pop(name).set()
+
+        with fin, open(dest, "wb") as fout:
+            copyfileobj(fin, fout)
+        return hit
+
+
+def get_input_cache() -> Optional[InputCache]:
+    """Return the worker's input cache, or None if it is disabled.
+
+    :return:  The shared input cache
+    :rtype:  Optional[InputCache]
+    """
+    global _INPUT_CACHE
+    if GLOBAL_VARS["INPUT_CACHE_MB"] <= 0:
+        return None
+    with _INPUT_CACHE_LOCK:
+        if _INPUT_CACHE is None:
+            _INPUT_CACHE = InputCache(
+                GLOBAL_VARS["INPUT_CACHE_DIR"],
+                GLOBAL_VARS["INPUT_CACHE_MB"] * 1024**2,
+            )
+    return _INPUT_CACHE
+
+
+def download_url(s3client: client, job_tag: str, url: str, path: str):
+    """Download a URL input, through the shared S3 cache if configured.
+
+    :param s3client:  S3 client for the shared cache
+    :param job_tag:  Unique ID for this job
+    :param url:  The URL of the input file
+    :param path:  The local path to download the file to
+    """
+    bucket = GLOBAL_VARS["INPUT_CACHE_BUCKET"]
+    shared_key = (
+        f"{GLOBAL_VARS['INPUT_CACHE_PREFIX']}"
+        f"{sha256(url.encode('utf-8')).hexdigest()}"
+    )
+    if bucket is not None:
+        try:
+            s3client.download_file(
+                bucket, shared_key, path, Config=TRANSFER_CONFIG
+            )
+            return
+        except ClientError as error:
+            if error.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                _LOGGER.warning(
+                    "%s Unable to read shared cache for %s: %s",
+                    job_tag,
+                    url,
+                    error,
+                )
+
+    response = HTTP_POOL.request("GET", url, preload_content=False)
+    try:
+        if response.status != 200:
+            raise OSError(f"HTTP {response.status} downloading {url}")
+        with open(path, "wb") as fout:
+            copyfileobj(response, fout)
+    finally:
+        response.release_conn()
+
+    if bucket is not None:
+        try:
+            s3client.upload_file(
+                path, bucket, shared_key, Config=TRANSFER_CONFIG
+            )
+        except (ClientError, S3UploadFailedError) as error:
+            _LOGGER.warning(
+                "%s Unable to fill shared cache for %s: %s",
+                job_tag,
+                url,
+                error,
+            )
+
+
+def input_file_path(
+    job_tag: str, file: str, local_name: Optional[str] = None
+) -> str:
+    """Get the local path an input file is downloaded to.
+
+    :param job_tag:  Unique ID for this job
+    :param file:  A URL or the S3 object key of the input file
+    :param local_name:  File name to save an S3 input as, if not its own
+    :return:  The local path of the input file
+    :rtype:  str
+    """
+    if "https" in file:
+        file_name = file.split("/")[-1]
+        return f"{GLOBAL_VARS['JOB_PATH']}{job_tag}/{file_name}"
+    if local_name is not None:
+        return f"{GLOBAL_VARS['JOB_PATH']}{job_tag}/{local_name}"
+    return f"{GLOBAL_VARS['JOB_PATH']}{file}"
+
+
+def count_atoms(path: str) -> Optional[int]:
+    """Count the atom records of a PDB, PQR or mmCIF structure file.
+
+    :param path:  The local path of the structure file
+    :return:  The number of ATOM/HETATM records, None if there are none
+              or the file can't be read
+    :rtype:  Optional[int]
+    """
+    try:
+        with open(path, "rb") as fin:
+            atoms = sum(
+                1 for line in fin if line.startswith((b"ATOM", b"HETATM"))
+            )
+    except OSError as error:
+        _LOGGER.warning("Unable to count atoms in %s: %s", path, error)
+        return None
+    return atoms or None
+
+
+def download_input_file(
+    s3client: client,
+    job_tag: str,
+    inbucket: str,
+    file: str,
+    local_name: Optional[str] = None,
+    etag: Optional[str] = None,
+) -> str:
+    """Download one input file, from a URL or the input bucket.
+
+    Files are served from the worker's input cache when possible. URL
+    inputs are keyed by URL, and S3 inputs by ETag alone, so that a file
+    uploaded again for another job is a hit. S3 inputs whose ETag the job
+    message doesn't give are not cached.
+
+    :param s3client:  S3 input bucket with input files.
+    :param job_tag:  Unique ID for this job
+    :param inbucket:  The name of the input bucket
+    :param file:  A URL or the S3 object key of the input file
+    :param local_name:  File name to save an S3 input as, if not its own
+    :param etag:  The ETag of an S3 input, from the job message
+    :return:  The local path of the downloaded file
+    :rtype:  str
+    """
+    local_path = input_file_path(job_tag, file, local_name)
+    if "https" in file:
+        cache_key = file
+
+        def fill(path: str):
+            download_url(s3client, job_tag, file, path)
+
+    else:
+        cache_key = None if etag is None else f"etag:{etag}"
+
+        def fill(path: str):
+            s3client.download_file(
+                inbucket, file, path, Config=TRANSFER_CONFIG
+            )
+
+    cache = get_input_cache()
+    if cache is None or cache_key is None:
+        fill(local_path)
+        return local_path
+
+    if cache.fetch(cache_key, local_path, fill):
+        _LOGGER.debug("%s Input cache hit for %s", job_tag, file)
+    return local_path
+
+
+def download_input_files(
+    s3client: client,
+    job_tag: str,
+    inbucket: str,
+    input_files: List[str],
+    input_renames: Optional[Dict[str, str]] = None,
+    input_etags: Optional[Dict[str, str]] = None,
+) -> List[str]:
+    """Download all input files of a job concurrently.
+
+    Up to TRANSFER_THREADS files are fetched at once; large S3 objects are
+    also fetched in parallel ranges, as set by TRANSFER_CONFIG.
+
+    :param s3client:  S3 input bucket with input files.
+    :param job_tag:  Unique ID for this job
+    :param inbucket:  The name of the input bucket
+    :param input_files:  URLs and S3 object keys of the input files
+    :param input_renames:  Local file names of S3 inputs, by object key
+    :param input_etags:  ETags of S3 inputs, by object key
+    :return:  The input files that could not be downloaded
+    :rtype:  List[str]
+    """
+    failed_files = []
+    if not input_files:
+        return failed_files
+    with ThreadPoolExecutor(
+        max_workers=min(GLOBAL_VARS["TRANSFER_THREADS"], len(input_files)),
+        thread_name_prefix="download",
+    ) as executor:
+        futures = {
+            executor.submit(
+                download_input_file,
+                s3client,
+                job_tag,
+                inbucket,
+                file,
+                (input_renames or {}).get(file),
+                (input_etags or {}).get(file),
+            ): file
+            for file in input_files
+        }
+        for future in futures:
+            file = futures[future]
+            try:
+                future.result()
+            except Exception as error:
+                # TODO: intendo 2021/05/05 - Find more specific exception
+                _LOGGER.exception(
+                    "%s ERROR: Download failed for file, %s \n\t%s",
+                    job_tag,
+                    file,
+                    error,
+                )
+                failed_files.append(file)
+    return failed_files
+
+
+def snapshot_files(rundir: str) -> Dict[str, Tuple[int, int]]:
+    """Record the size and modification time of each file in a directory.
+
+    :param rundir:  The local directory where the job is being executed.
+    :return:  The (size, mtime in ns) of each file, by file name
+    :rtype:  Dict[str, Tuple[int, int]]
+    """
+    with scandir(rundir) as entries:
+        return {
+            entry.name: (entry.stat().st_size, entry.stat().st_mtime_ns)
+            for entry in entries
+            if entry.is_file()
+        }
+
+
+def changed_files(
+    rundir: str, input_snapshot: Dict[str, Tuple[int, int]]
+) -> List[str]:
+    """List the files a job created or changed in its run directory.
+
+    :param rundir:  The local directory where the job is being executed.
+    :param input_snapshot:  The input files, from snapshot_files()
+    :return:  The names of new or changed files, in directory order
+    :rtype:  List[str]
+    """
+    return [
+        name
+        for name, stats in snapshot_files(rundir).items()
+        if input_snapshot.get(name) != stats
+    ]
+
+
+def publish_output_files(
+    s3client: client,
+    job_tag: str,
+    rundir: str,
+    upload_names: List[str],
+) -> List[str]:
+    """Upload the files a job created or changed to the output bucket.
+
+    Input files that are unchanged since they were downloaded are skipped
+    by the caller (see changed_files). The others are uploaded
+    concurrently, and large ones (e.g. .dx maps) in multipart chunks.
+
+    :param s3client:  S3 client used to upload the files
+    :param job_tag:  Unique ID for this job
+    :param rundir:  The local directory where the job is being executed.
+    :param upload_names:  The names of the files to upload
+    :return:  The S3 object keys that were uploaded, in directory order
+    :rtype:  List[str]
+    """
+    if not upload_names:
+        return []
+
+    output_files = []
+    with ThreadPoolExecutor(
+        max_workers=min(GLOBAL_VARS["TRANSFER_THREADS"], len(upload_names)),
+        thread_name_prefix="upload",
+    ) as executor:
+        futures = {}
+        for name in upload_names:
+            _LOGGER.info(
+                "%s Uploading file to output bucket, %s", job_tag, name
+            )
+            futures[name] = executor.submit(
+                s3client.upload_file,
+                f"{rundir}/{name}",
+                GLOBAL_VARS["S3_TOPLEVEL_BUCKET"],
+                f"{job_tag}/{name}",
+                Config=TRANSFER_CONFIG,
+            )
+        for name, future in futures.items():
+            try:
+                future.result()
+                output_files.append(f"{job_tag}/{name}")
+            except (ClientError, S3UploadFailedError, OSError) as error:
+                _LOGGER.exception(
+                    "%s ERROR: Failed to upload file, %s \n\t%s",
+                    job_tag,
+                    f"{job_tag}/{name}",
+                    error,
+                )
+    return output_files
+
+
+def record_cached_result(
+    s3client: client, job_info: Dict, inbucket: str, output_files: List[str]
+):
+    """Record a finished job's outputs for reuse by identical jobs.
+
+    The job service looks the manifest up by the job's result cache key,
+    and copies the listed outputs instead of queueing a repeat job.
+
+    :param s3client:  S3 client used to write the manifest
+    :param job_info:  The job message, with its result_cache_key
+    :param inbucket:  The input bucket holding the cache manifests
+    :param output_files:  The S3 object keys of the job's outputs
+    """
+    job_tag = job_info["job_tag"]
+    manifest = {
+        "job_tag": job_tag,
+        "job_id": job_info["job_id"],
+        "job_type": job_info["job_type"],
+        "output_files": output_files,
+        "created": time(),
+    }
+    try:
+        s3client.put_object(
+            Body=dumps(manifest),
+            Bucket=inbucket,
+            Key=f"{RESULT_CACHE_PREFIX}{job_info['result_cache_key']}.json",
+        )
+    except ClientError as error:
+        _LOGGER.warning(
+            "%s Unable to record result in cache: %s", job_tag, error
+        )
+
+
+def stream_to_file(pipe: BinaryIO, fout: BinaryIO, max_bytes: int):
+    """Copy a subprocess pipe to a file as the output arrives.
+
+    If the stream grows beyond max_bytes, only its first and last
+    max_bytes / 2 bytes are kept, with a marker in between noting how many
+    bytes were dropped, so memory use is bounded by max_bytes / 2.
+
+    Args:
+        pipe (BinaryIO): The pipe to read until EOF.
+        fout (BinaryIO): The unbuffered file to write to.
+        max_bytes (int): The most bytes to keep (0 for no limit).
+    """
+    head_bytes = max_bytes - max_bytes // 2
+    tail_bytes = max_bytes // 2
+    written = 0
+    tail: deque = deque()
+    tail_size = 0
+    dropped = 0
+    for chunk in iter(lambda: pipe.read1(LOG_CHUNK_SIZE), b""):
+        if not max_bytes or written < head_bytes:
+            keep = len(chunk) if not max_bytes else head_bytes - written
+            fout.write(chunk[:keep])
+            written += min(keep, len(chunk))
+            chunk = chunk[keep:]
+        if chunk:
+            tail.append(chunk)
+            tail_size += len(chunk)
+            while tail and tail_size - len(tail[0]) >= tail_bytes:
+                tail_size -= len(tail[0])
+                dropped += len(tail.popleft())
+    if tail_size > tail_bytes:
+        dropped += tail_size - tail_bytes
+        excess = tail_size - tail_bytes
+        tail[0] = tail[0][excess:]
+    if dropped:
+        fout.write(f"\n[... truncated {dropped} bytes ...]\n".encode("utf-8"))
+    for chunk in tail:
+        fout.write(chunk)
+
+
+def wait_for_process(proc: Popen) -> Tuple[int, struct_rusage]:
+    """Reap a job's process, letting kill_running_jobs() reach it.
+
+    :param proc:  The running process of a job
+    :return:  The exit code (negative signal number if killed) and the
+              resource usage of the process
+    :rtype:  Tuple[int, struct_rusage]
+    """
+    with _JOB_PROCS_LOCK:
+        _JOB_PROCS.add(proc)
+        if _ABORTING.is_set():
+            proc.kill()
+    try:
+        # Wait without reaping, then reap under the lock, so that a drain
+        # can never signal a PID that has been reused
+        waitid(P_PID, proc.pid, WEXITED | WNOWAIT)
+        with _JOB_PROCS_LOCK:
+            _, status, usage = wait4(proc.pid, 0)
+            if WIFSIGNALED(status):
+                proc.returncode = -WTERMSIG(status)
+            else:
+                proc.returncode = WEXITSTATUS(status)
+        return proc.returncode, usage
+    finally:
+        with _JOB_PROCS_LOCK:
+            _JOB_PROCS.discard(proc)
+
+
+def kill_running_jobs() -> int:
+    """Kill the processes of running jobs, and of any that start later.
+
+    :return:  The number of processes killed
+    :rtype:  int
+    """
+    with _JOB_PROCS_LOCK:
+        _ABORTING.set()
+        for proc in _JOB_PROCS:
+            proc.kill()
+        return len(_JOB_PROCS)
+
+
 def execute_command(
     job_tag: str,
     command_line_str: str,
     stdout_filename: str,
     stderr_filename: str,
+    rundir: Optional[str] = None,
+    metrics: Optional[JobMetrics] = None,
 ) -> int:
     """Spawn a subprocess and collect all the information about it.
     Returns the exit code the of the executed command.
 
+    stdout and stderr go straight to their files while the command runs,
+    so they are never held in memory and are on disk if the worker dies.
+    With LOG_MAX_BYTES set, each file is capped (see stream_to_file).
+
+    The command runs in its own session, so a SIGTERM that dumb-init
+    forwards to the worker's process group doesn't kill it; a drain gives
+    it the grace period first.
+
     Args:
         job_tag (str): The unique job id.
         command_line_str (str): The command and arguments.
         stdout_filename (str): The name of the output file for stdout.
         stderr_filename (str): The name of the output file for stderr.
+        rundir (Optional[str]): The working directory of the command.
+        metrics (Optional[JobMetrics]): Where to record the resource
+            usage of the command, and its samples if SAMPLE_SECONDS is set.
     Return:
         exit_code (int): The exit code of the executed command
+    Raises:
+        JobInterruptedError: If the command was killed by a drain
     """
+    if _ABORTING.is_set():
+        raise JobInterruptedError(f"{job_tag} not started; worker is draining")
     command_split = command_line_str.split()
-    stdout_text: str
-    stderr_text: str
-    exit_code: int
-    try:
-        proc = run(command_split, stdout=PIPE, stderr=PIPE, check=True)
-        stdout_text = proc.stdout.decode("utf-8")
-        stderr_text = proc.stderr.decode("utf-8")
-        exit_code = proc.returncode
-    except CalledProcessError as cpe:
-        _LOGGER.exception(
-            "%s failed to run command, %s: %s",
+    max_bytes = GLOBAL_VARS["LOG_MAX_BYTES"]
+    with open(stdout_filename, "wb", buffering=0) as stdout_file, open(
+        stderr_filename, "wb", buffering=0
+    ) as stderr_file:
+        if not max_bytes:
+            # Let the command write to the files directly
+            proc = Popen(
+                command_split,
+                cwd=rundir,
+                stdout=stdout_file,
+                stderr=stderr_file,
+                start_new_session=True,
+            )
+            pumps: List[Thread] = []
+        else:
+            proc = Popen(
+                command_split,
+                cwd=rundir,
+                stdout=PIPE,
+                stderr=PIPE,
+                start_new_session=True,
+            )
+            pumps = [
+                Thread(
+                    target=stream_to_file,
+                    args=(pipe, fout, max_bytes),
+                    daemon=True,
+                )
+                for pipe, fout in (
+                    (proc.stdout, stdout_file),
+                    (proc.stderr, stderr_file),
+                )
+            ]
+        for pump in pumps:
+            pump.start()
+        if metrics is not None and GLOBAL_VARS["SAMPLE_SECONDS"] > 0:
+            metrics.sampler = ResourceSampler(
+                proc.pid,
+                GLOBAL_VARS["SAMPLE_SECONDS"],
+                GLOBAL_VARS["MAX_SAMPLES"],
+            )
+            metrics.sampler.start()
+        try:
+            exit_code, usage = wait_for_process(proc)
+        finally:
+            if metrics is not None and metrics.sampler is not None:
+                metrics.sampler.stop()
+        for pump in pumps:
+            pump.join()
+        if max_bytes:
+            proc.stdout.close()
+            proc.stderr.close()
+
+    if metrics is not None:
+        metrics.record_rusage(usage)
+    if exit_code < 0 and (_ABORTING.is_set() or DRAINING.is_set()):
+        # Whatever sent the signal, the job is rerun elsewhere
+        raise JobInterruptedError(f"{job_tag} killed; worker is draining")
+    if exit_code != 0:
+        _LOGGER.error(
+            "%s failed to run command, %s: exit code %s",
             job_tag,
             command_line_str,
-            cpe,
+            exit_code,
         )
-        stdout_text = cpe.stdout.decode("utf-8")
-        stderr_text = cpe.stderr.decode("utf-8")
-        exit_code = cpe.returncode
-
-    # Write stdout to file
-    with open(stdout_filename, "w") as fout:
-        fout.write(stdout_text)
-
-    # Write stderr to file
-    with open(stderr_filename, "w") as fout:
-        fout.write(stderr_text)
-
     return exit_code
 
 
-# TODO: intendo - 2021/05/10 - Break run_job into multiple functions
-#                              to reduce complexity.
 def run_job(
     job: str,
     s3client: client,
     metrics: JobMetrics,
     queue_url: str,
     receipt_handle: str,
+    message_id: Optional[str] = None,
 ) -> int:
-    """Remove the directory for the job.
+    """Claim a job and run it, unless it already ran.
+
+    From the claim until the lease is released, a VisibilityHeartbeat
+    renews both the lease and the message's visibility, so neither lapses
+    during a long download or upload. The lease is released however the
+    job ends.
 
     :param job:  The job file describing what needs to be run.
     :param s3client:  S3 input bucket with input files.
+    :param queue_url:  URL of the job queue
+    :param receipt_handle:  The receipt handle of the job's message
+    :param message_id:  The ID of the SQS message, recorded in the lease
     :return:  int
+    :raises JobClaimedError:  If another worker is running the job
+    :raises JobInterruptedError:  If the job was killed by a drain
     """
     ret_val = 1
     try:
@@ -504,58 +2130,101 @@ def run_job(
         return ret_val
     job_type = job_info["job_type"]
     job_tag = f"{job_info['job_date']}/{job_info['job_id']}"
+
+    # Claim the job, so that a duplicate delivery of its message can't run
+    # it again. The status is checked under the claim, since the lease is
+    # only released once the final status is written.
+    lease = JobLease(s3client, job_tag, job_type, message_id)
+    lease.acquire(GLOBAL_VARS["Q_TIMEOUT"])
+    heartbeat = VisibilityHeartbeat(
+        get_client("sqs", GLOBAL_VARS["AWS_REGION"]),
+        queue_url,
+        receipt_handle,
+        job_tag,
+        job_info.get("max_run_time"),
+        lease,
+    )
+    try:
+        with heartbeat:
+            if job_is_finished(s3client, job_tag, job_type):
+                _LOGGER.info(
+                    "%s Job already ran; dropping its message", job_tag
+                )
+                return 0
+            return run_claimed_job(job_info, s3client, metrics)
+    finally:
+        lease.release()
+        # A final status evicts the job's cached status document, but an
+        # interrupted or failed run may not have written one
+        with _STATUS_CACHE_LOCK:
+            _STATUS_CACHE.pop(f"{job_tag}/{job_type}-status.json", None)
+
+
+# TODO: intendo - 2021/05/10 - Break run_claimed_job into multiple functions
+#                              to reduce complexity.
+def run_claimed_job(job_info: dict, s3client: client, metrics: JobMetrics):
+    """Download a claimed job's inputs, run it and publish its outputs.
+
+    :param job_info:  The job message
+    :param s3client:  S3 input bucket with input files.
+    :param metrics:  Where to record the job's metrics
+    :return:  int
+    :raises JobInterruptedError:  If the job was killed by a drain
+    """
+    ret_val = 1
+    job_type = job_info["job_type"]
+    job_tag = f"{job_info['job_date']}/{job_info['job_id']}"
     rundir = f"{GLOBAL_VARS['JOB_PATH']}{job_tag}"
     inbucket = job_info["bucket_name"]
+    metrics.submission_timings = job_info.get("timings")
+    metrics.phases.lap("claim")
 
-    # Prepare job directory and download input files
+    # Prepare job directory and download input files. The process working
+    # directory is shared by every job slot, so only absolute paths are used.
     makedirs(rundir, exist_ok=True)
-    chdir(rundir)
 
-    for file in job_info["input_files"]:
-        if "https" in file:
-            name = f"{job_tag}/{file.split('/')[-1]}"
-            try:
-                request.urlretrieve(file, f"{GLOBAL_VARS['JOB_PATH']}{name}")
-            except Exception as error:
-                # TODO: intendo 2021/05/05 - Find more specific exception
-                _LOGGER.exception(
-                    "%s ERROR: Download failed for file, %s \n\t%s",
-                    job_tag,
-                    name,
-                    error,
-                )
-                update_status(
-                    s3client,
-                    job_tag,
-                    job_type,
-                    JOBSTATUS.FAILED,
-                    [],
-                    "Failed to download input file. Job did not run.",
-                )
-                return cleanup_job(job_tag, rundir)
-
-        else:
-            try:
-                s3client.download_file(
-                    inbucket, file, f"{GLOBAL_VARS['JOB_PATH']}{file}"
-                )
-            except Exception as error:
-                # TODO: intendo 2021/05/05 - Find more specific exception
-                _LOGGER.exception(
-                    "%s ERROR: Download failed for file, %s \n\t%s",
-                    job_tag,
-                    file,
-                    error,
-                )
-                update_status(
-                    s3client,
+    failed_files = download_input_files(
+        s3client,
+        job_tag,
+        inbucket,
+        job_info["input_files"],
+        job_info.get("input_renames"),
+        job_info.get("input_etags"),
+    )
+    if failed_files:
+        update_status(
+            s3client,
+            job_tag,
+            job_type,
+            JOBSTATUS.FAILED,
+            [],
+            f"Failed to download input file(s): {failed_files}. "
+            "Job did not run.",
+        )
+        return cleanup_job(job_tag, rundir)
+    input_snapshot = snapshot_files(rundir)
+
+    # The job service can't size fetched (e.g. RCSB) structures, so count
+    # their atoms here for the estimator to be trained on
+    features = job_info.get("features")
+    if (
+        features is not None
+        and features.get("atoms") is None
+        and JOBTYPE.PDB2PQR.name.lower() in job_type
+        and job_info["input_files"]
+    ):
+        structure = job_info["input_files"][0]
+        features = dict(
+            features,
+            atoms=count_atoms(
+                input_file_path(
                     job_tag,
-                    job_type,
-                    JOBSTATUS.FAILED,
-                    [],
-                    "Failed to download input file. Job did not run.",
+                    structure,
+                    (job_info.get("input_renames") or {}).get(structure),
                 )
-                return cleanup_job(job_tag, rundir)
+            ),
+        )
+    metrics.phases.lap("download")
 
     # Run job and record associated metrics
     update_status(
@@ -565,6 +2234,7 @@ def run_job(
         JOBSTATUS.RUNNING,
         [],
     )
+    metrics.phases.lap("status_updates")
 
     # TODO: (Eo300) consider moving binary
     #       command (e.g. 'apbs', 'pdb2pqr30') into SQS message
@@ -575,28 +2245,28 @@ def run_job(
     else:
         raise KeyError(f"Invalid job type, {job_type}")
 
-    if "max_run_time" in job_info:
-        sqs = client("sqs", region_name=GLOBAL_VARS["AWS_REGION"])
-        sqs.change_message_visibility(
-            QueueUrl=queue_url,
-            ReceiptHandle=receipt_handle,
-            VisibilityTimeout=int(job_info["max_run_time"]),
-        )
-
     # Execute job binary with appropriate arguments and record metrics
+    metrics.features = features
     try:
         metrics.start_time = time()
         metrics.exit_code = execute_command(
             job_tag,
             command,
-            f"{job_type}.stdout.txt",
-            f"{job_type}.stderr.txt",
+            f"{rundir}/{job_type}.stdout.txt",
+            f"{rundir}/{job_type}.stderr.txt",
+            rundir,
+            metrics,
         )
         metrics.end_time = time()
-
-        # We need to create the {job_type}-metrics.json before we upload
-        # the files to the S3_TOPLEVEL_BUCKET.
-        metrics.write_metrics(job_tag, job_type, ".")
+        metrics.phases.lap("execution")
+
+        # The metrics themselves are uploaded once the directory is gone
+        metrics.measure_storage(rundir)
+        metrics.phases.lap("metrics")
+    except JobInterruptedError:
+        # Leave the outputs and status for the worker that reruns the job
+        cleanup_job(job_tag, rundir)
+        raise
     except Exception as error:
         # TODO: intendo 2021/05/05 - Find more specific exception
         _LOGGER.exception(
@@ -607,43 +2277,22 @@ def run_job(
         # TODO: Should this return 1 because noone else will succeed?
         ret_val = 1
 
-    # Upload directory contents to S3
-    for file in listdir("."):
-        try:
-            file_path = f"{job_tag}/{file}"
-            _LOGGER.info(
-                "%s Uploading file to output bucket, %s", job_tag, file
-            )
-            s3client.upload_file(
-                f"{GLOBAL_VARS['JOB_PATH']}{file_path}",
-                GLOBAL_VARS["S3_TOPLEVEL_BUCKET"],
-                f"{file_path}",
-            )
-        except ClientError as error:
-            _LOGGER.exception(
-                "%s ERROR: Failed to upload file, %s \n\t%s",
-                job_tag,
-                f"{job_tag}/{file}",
-                error,
-            )
-        # ret_val = 1
-
+    # Upload new and changed files to S3
     # TODO: 2021/03/30, Elvis - Will need to address how we bundle output
     #       subdirectory for PDB2PKA when used; I previous bundled it as
     #       a compressed tarball (i.e. "{job_id}-pdb2pka_output.tar.gz")
+    upload_names = changed_files(rundir, input_snapshot)
+    output_files = publish_output_files(
+        s3client, job_tag, rundir, upload_names
+    )
+    uploaded_all = len(output_files) == len(upload_names)
+    metrics.phases.lap("upload")
 
-    # Create list of output files
-    input_files_no_id = [  # Remove job_id prefix from input file list
-        "".join(name.split("/")[-1]) for name in job_info["input_files"]
-    ]
-    output_files = [
-        f"{job_tag}/{filename}"
-        for filename in listdir(".")
-        if filename not in input_files_no_id
-    ]
-
-    # Cleanup job directory and update status
+    # Cleanup job directory, publish the metrics and update status
     cleanup_job(job_tag, rundir)
+    metrics.phases.lap("cleanup")
+    if metrics.exit_code is not None:
+        output_files += metrics.publish_metrics(s3client, job_tag, job_type)
     update_status(
         s3client,
         job_tag,
@@ -652,9 +2301,90 @@ def run_job(
         output_files,
     )
 
+    # Let identical later jobs reuse the outputs of a clean, complete run
+    if (
+        "result_cache_key" in job_info
+        and metrics.exit_code == 0
+        and uploaded_all
+    ):
+        record_cached_result(s3client, job_info, inbucket, output_files)
+
     return ret_val
 
 
+def run_slot(
+    message: Dict,
+    s3client: client,
+    sqs: client,
+    qurl: str,
+    budget: ResourceBudget,
+    request: Tuple[int, int],
+) -> None:
+    """Run one job in a worker slot and delete its message when done.
+
+    :param message:  The SQS message describing the job
+    :param s3client:  S3 input bucket with input files.
+    :param sqs:  SQS client for the job queue
+    :param qurl:  URL of the job queue
+    :param budget:  The resources to release when the job ends
+    :param request:  The (CPUs, memory MB) reserved for the job
+    :return:  None
+    """
+    metrics = JobMetrics()
+    sent_timestamp = message.get("Attributes", {}).get("SentTimestamp")
+    if sent_timestamp is not None:
+        # SentTimestamp is in milliseconds since the epoch
+        metrics.sent_at = int(sent_timestamp) / 1000
+        metrics.phases.add(
+            "queue_wait", max(metrics.phases.started - metrics.sent_at, 0)
+        )
+    try:
+        run_job(
+            message["Body"],
+            s3client,
+            metrics,
+            qurl,
+            message["ReceiptHandle"],
+            message.get("MessageId"),
+        )
+        sqs.delete_message(
+            QueueUrl=qurl, ReceiptHandle=message["ReceiptHandle"]
+        )
+    except JobClaimedError as claimed:
+        if claimed.same_message:
+            # Redelivered while its claim is live; look again once the
+            # claim could have expired, to take over from a dead worker
+            delay = claimed.holder.get("expires", 0) - time()
+            _LOGGER.info("%s; retrying in %d s", claimed, max(delay, 0))
+            sqs.change_message_visibility(
+                QueueUrl=qurl,
+                ReceiptHandle=message["ReceiptHandle"],
+                VisibilityTimeout=min(max(ceil(delay), 1), 43200),
+            )
+        else:
+            # Another message for the same job; that one runs it
+            _LOGGER.info("%s; dropping duplicate message", claimed)
+            sqs.delete_message(
+                QueueUrl=qurl, ReceiptHandle=message["ReceiptHandle"]
+            )
+    except JobInterruptedError as interrupted:
+        # Let another worker pick the job up now, not after a timeout
+        _LOGGER.warning("%s; returning its message to the queue", interrupted)
+        sqs.change_message_visibility(
+            QueueUrl=qurl,
+            ReceiptHandle=message["ReceiptHandle"],
+            VisibilityTimeout=0,
+        )
+    except Exception as error:
+        _LOGGER.exception(
+            "ERROR: Job failed in worker slot, %s \n\t%s",
+            message["Body"],
+            error,
+        )
+    finally:
+        budget.release(request)
+
+
 def build_parser():
     """Build argument parser.
 
@@ -680,27 +2410,112 @@ def main() -> None:
     :return:  None
     """
 
-    s3client = client("s3")
-    sqs = client("sqs", region_name=GLOBAL_VARS["AWS_REGION"])
+    s3client = get_client("s3")
+    check_conditional_writes(s3client)
+    sqs = get_client("sqs", GLOBAL_VARS["AWS_REGION"])
     queue_url = sqs.get_queue_url(QueueName=GLOBAL_VARS["QUEUE"])
     qurl = queue_url["QueueUrl"]
     lasttime = datetime.now()
 
-    metrics = JobMetrics()
+    leased = LeasedMessages(sqs, qurl)
+    leased.start()
+    budget = ResourceBudget()
+    running: set = set()
+    drain_deadline: Optional[float] = None
 
     # The structure of the SQS messages is documented at:
     # https://docs.aws.amazon.com/AWSSimpleQueueService/
     # latest/APIReference/API_ReceiveMessage.html
-    messages = get_messages(sqs, qurl)
-    while messages:
-        for idx in messages["Messages"]:
-            run_job(idx["Body"], s3client, metrics, qurl, idx["ReceiptHandle"])
-            sqs.delete_message(
-                QueueUrl=qurl, ReceiptHandle=idx["ReceiptHandle"]
+    with ThreadPoolExecutor(
+        max_workers=GLOBAL_VARS["JOB_SLOTS"], thread_name_prefix="job-slot"
+    ) as executor:
+        while True:
+            running = {future for future in running if not future.done()}
+
+            if DRAINING.is_set():
+                # Take no new work. Running jobs get the grace period to
+                # finish, then are killed and their messages requeued.
+                leased.release()
+                if not running:
+                    break
+                if drain_deadline is None:
+                    drain_deadline = (
+                        time() + GLOBAL_VARS["DRAIN_GRACE_SECONDS"]
+                    )
+                    _LOGGER.info(
+                        "Draining: waiting up to %s s for %s running job(s)",
+                        GLOBAL_VARS["DRAIN_GRACE_SECONDS"],
+                        len(running),
+                    )
+                remaining = drain_deadline - time()
+                if remaining <= 0:
+                    killed = kill_running_jobs()
+                    if killed:
+                        _LOGGER.warning(
+                            "Drain grace period is over; killed %s job(s)",
+                            killed,
+                        )
+                    remaining = DRAIN_CHECK_SECONDS
+                wait(running, timeout=remaining, return_when=FIRST_COMPLETED)
+                continue
+
+            # Start held jobs, oldest first, while slots and resources allow.
+            # A job that doesn't fit blocks the ones behind it, so large
+            # APBS jobs aren't starved by a stream of small ones.
+            while PROCESSING and len(running) < GLOBAL_VARS["JOB_SLOTS"]:
+                idx = leased.peek()
+                if idx is None:
+                    break
+                request = budget.request_for(idx["Body"])
+                if not budget.try_acquire(request):
+                    break
+                leased.pop()
+                running.add(
+                    executor.submit(
+                        run_slot, idx, s3client, sqs, qurl, budget, request
+                    )
+                )
+
+            if not PROCESSING:
+                # Don't hold on to messages while paused
+                leased.release()
+                if running:
+                    wait(
+                        running,
+                        timeout=DRAIN_CHECK_SECONDS,
+                        return_when=FIRST_COMPLETED,
+                    )
+                else:
+                    DRAINING.wait(10)
+                continue
+
+            if running and (
+                len(running) >= GLOBAL_VARS["JOB_SLOTS"] or len(leased)
+            ):
+                # Wake up now and then to notice a drain
+                wait(
+                    running,
+                    timeout=DRAIN_CHECK_SECONDS,
+                    return_when=FIRST_COMPLETED,
+                )
+                continue
+
+            # A slot is free and nothing is held, so look for more work
+            messages = get_messages(sqs, qurl)
+            if messages:
+                leased.add(messages["Messages"])
+                continue
+            # The queue stayed empty for MAX_IDLE_TIME. Stop, unless jobs are
+            # still running: until they are done, keep receiving for the
+            # free slots (get_messages also returns on a drain).
+            if not running:
+                break
+            wait(
+                running,
+                timeout=DRAIN_CHECK_SECONDS,
+                return_when=FIRST_COMPLETED,
             )
-        while not PROCESSING:
-            sleep(10)
-        messages = get_messages(sqs, qurl)
+    leased.stop()
     _LOGGER.info("DONE: %s", str(datetime.now() - lasttime))
 
 
@@ -2,10 +2,16 @@
 
 from json import load
 from pathlib import Path
+
+from boto3 import client
+from moto import mock_aws
+from moto.s3 import models as moto_s3_models
 import pytest
 
 from .constants import INPUT_DIR, REF_DIR
+from lambda_services.job_service.launcher import s3_utils
 from lambda_services.job_service.launcher.apbs_runner import Runner
+from lambda_services.job_service.launcher.jobsetup import MissingFilesError
 from lambda_services.job_service.launcher.utils import apbs_infile_creator
 
 
@@ -49,3 +55,133 @@ def test_apbs_infile_creator(
 
     # Compare contents with reference file
     assert new_infile_contents == open(expected_path, "r").read()
+
+
+@mock_aws
+def test_prepare_job_removewater(monkeypatch: pytest.MonkeyPatch):
+    # Use small chunks and parts so the PQR file is streamed in pieces
+    monkeypatch.setattr(s3_utils, "STREAM_CHUNK_SIZE", 1000)
+    monkeypatch.setattr(s3_utils, "MULTIPART_PART_SIZE", 20000)
+    monkeypatch.setattr(moto_s3_models, "S3_UPLOAD_PART_MIN_SIZE", 20000)
+
+    input_bucket_name = "pytest_input_bucket"
+    output_bucket_name = "pytest_output_bucket"
+    job_id: str = "sampleId"
+    job_date: str = "2021-05-16"
+    job_tag: str = f"{job_date}/{job_id}"
+
+    s3_client = client("s3")
+    for bucket_name in (input_bucket_name, output_bucket_name):
+        s3_client.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "us-west-2"},
+        )
+
+    # A PQR file with waters, and a remark that merely mentions them
+    molecule_text = (
+        "REMARK   1 HOH and WAT are kept here\n"
+        + (INPUT_DIR / Path("1fas.pqr")).read_text()
+    )
+    water_lines = (
+        "HETATM 9001  O   HOH   901      1.000   2.000   3.000 "
+        "-0.8000 1.5000\n"
+        "ATOM   9002  O   WAT W 902      4.000   5.000   6.000 "
+        "-0.8000 1.5000\n"
+        # A 5-digit serial runs into the record name
+        "HETATM10000  O   HOH W1000      7.000   8.000   9.000 "
+        "-0.8000 1.5000\n"
+    )
+    pqr_text = molecule_text.replace("\nTER", f"\n{water_lines}TER")
+    s3_client.put_object(
+        Bucket=output_bucket_name,
+        Key=f"{job_tag}/1fas.pqr",
+        Body=pqr_text,
+    )
+    s3_client.put_object(
+        Bucket=output_bucket_name,
+        Key=f"{job_tag}/{job_id}.in",
+        Body=(INPUT_DIR / Path(f"{job_id}.in")).read_text(),
+    )
+
+    form: dict = load(open(INPUT_DIR / Path("test-job_service-input.json")))[
+        1
+    ]["job"]["form"]
+    form["removewater"] = "on"
+    runner = Runner(form, job_id, job_date)
+    runner.prepare_job(output_bucket_name, input_bucket_name)
+
+    def read_object(bucket_name: str, object_name: str) -> str:
+        return (
+            s3_client.get_object(Bucket=bucket_name, Key=object_name)["Body"]
+            .read()
+            .decode("utf-8")
+        )
+
+    """The original is kept in the output bucket, unchanged"""
+    assert read_object(output_bucket_name, f"{job_tag}/1fas-water.pqr") == (
+        pqr_text
+    )
+    assert f"{job_tag}/1fas-water.pqr" in runner.output_files
+
+    """Only the water atom records are removed from the job input"""
+    assert read_object(input_bucket_name, f"{job_tag}/1fas.pqr") == (
+        molecule_text
+    )
+    # Multipart uploads have an ETag of the form '<hash>-<part count>'
+    assert (
+        "-"
+        in s3_client.head_object(
+            Bucket=input_bucket_name, Key=f"{job_tag}/1fas.pqr"
+        )["ETag"]
+    )
+
+
+@mock_aws
+def test_prepare_job_missing_files(monkeypatch: pytest.MonkeyPatch):
+    input_bucket_name = "pytest_input_bucket"
+    job_id: str = "sampleId"
+    job_date: str = "2021-05-16"
+    job_tag: str = f"{job_date}/{job_id}"
+
+    s3_client = client("s3")
+    s3_client.create_bucket(
+        Bucket=input_bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "us-west-2"},
+    )
+    pqr_bytes = (INPUT_DIR / Path("1fas.pqr")).read_bytes()
+    for file_name, body in (
+        ("1fas.in", b"mol pqr 1fas.pqr"),
+        ("1fas.pqr", pqr_bytes),
+    ):
+        s3_client.put_object(
+            Bucket=input_bucket_name, Key=f"{job_tag}/{file_name}", Body=body
+        )
+
+    # Count the listings; existence checks must not need anything else
+    list_calls = []
+    list_prefix = s3_utils.S3Utils.list_prefix
+    monkeypatch.setattr(
+        s3_utils.S3Utils,
+        "list_prefix",
+        lambda *args: list_calls.append(args) or list_prefix(*args),
+    )
+
+    runner = Runner(
+        {"filename": "1fas.in", "support_files": ["1fas.pqr", "1fas.dx"]},
+        job_id,
+        job_date,
+    )
+    with pytest.raises(MissingFilesError) as err:
+        runner.prepare_job("pytest_output_bucket", input_bucket_name)
+    assert err.value.missing_files == [f"{job_tag}/1fas.dx"]
+
+    """The job prefix is listed once, and its sizes and ETags are kept"""
+    index = runner.input_index(input_bucket_name)
+    assert len(list_calls) == 1
+    assert index[f"{job_tag}/1fas.pqr"].size == len(pqr_bytes)
+    assert (
+        index[f"{job_tag}/1fas.pqr"].etag
+        == s3_client.head_object(
+            Bucket=input_bucket_name, Key=f"{job_tag}/1fas.pqr"
+        )["ETag"]
+    )
@@ -1,7 +1,21 @@
 """Tests for the generating unique IDs and S3 tokens."""
 
 from copy import copy
-from lambda_services.api_service.api_service import generate_id_and_tokens
+from datetime import datetime
+from os import environ
+from unittest.mock import patch
+from urllib.parse import parse_qsl, urlsplit
+from boto3 import client
+from botocore.config import Config
+from dateutil.tz import UTC
+from lambda_services.api_service.api_service import (
+    MAX_FILE_SIZE,
+    MAX_PLAN_PARTS,
+    MULTIPART_THRESHOLD,
+    BatchPresigner,
+    generate_id_and_tokens,
+)
+from lambda_services.api_service.aws_clients import reset_clients
 from moto import mock_aws
 
 
@@ -37,3 +51,123 @@ def test_generate_id_and_tokens():
         f"Job ID ({response['job_id']}) used in response does "
         "not match Job ID in request"
     )
+
+
+@mock_aws
+def test_batch_presigner_matches_botocore():
+    """Batch-signed URLs match botocore's SigV4 presigned URLs."""
+    signing_time = datetime(2021, 5, 16, 12, 0, 0, tzinfo=UTC)
+    object_name = "2021-05-16/sampleId/sanitization test 1fas.pdb"
+    s3_client = client(
+        "s3", region_name="us-east-1", config=Config(signature_version="s3v4")
+    )
+
+    for bucket_name in ("sample-bucket", "TEST_BUCKET"):
+        with patch.dict(environ, {"AWS_DEFAULT_REGION": "us-east-1"}):
+            reset_clients()
+            presigner = BatchPresigner(bucket_name, signing_time=signing_time)
+            batch_url = urlsplit(presigner.presign_put(object_name))
+
+        with patch(
+            "botocore.auth.get_current_datetime",
+            return_value=signing_time.replace(tzinfo=None),
+        ):
+            expected_url = urlsplit(
+                s3_client.generate_presigned_url(
+                    "put_object",
+                    Params={"Bucket": bucket_name, "Key": object_name},
+                    ExpiresIn=3600,
+                    HttpMethod="PUT",
+                )
+            )
+
+        assert batch_url.netloc == expected_url.netloc
+        assert batch_url.path == expected_url.path
+        assert dict(parse_qsl(batch_url.query)) == dict(
+            parse_qsl(expected_url.query)
+        )
+    reset_clients()
+
+
+@mock_aws
+def test_generate_id_and_tokens_multipart():
+    """Files declared above the threshold get a multipart upload plan."""
+    bucket_name = "sample-bucket"
+    client("s3", region_name="us-east-1").create_bucket(Bucket=bucket_name)
+    large_size = MULTIPART_THRESHOLD + 1
+    event = {
+        "job_id": "sampleJobID",
+        "file_list": ["small.in", "large.pqr"],
+        "file_sizes": {"small.in": 1024, "large.pqr": large_size},
+    }
+
+    with patch.dict(
+        environ,
+        {"INPUT_BUCKET": bucket_name, "AWS_DEFAULT_REGION": "us-east-1"},
+    ):
+        reset_clients()
+        response = generate_id_and_tokens(event, None)
+
+    assert set(response["urls"]) == set(event["file_list"])
+    assert list(response["multipart"]) == ["large.pqr"]
+    upload_plan = response["multipart"]["large.pqr"]
+    assert upload_plan["part_size"] * len(upload_plan["parts"]) >= large_size
+    assert [part["part_number"] for part in upload_plan["parts"]] == list(
+        range(1, len(upload_plan["parts"]) + 1)
+    )
+    assert "uploadId=" in upload_plan["complete_url"]
+
+    uploads = client("s3", region_name="us-east-1").list_multipart_uploads(
+        Bucket=bucket_name
+    )["Uploads"]
+    assert [upload["UploadId"] for upload in uploads] == [
+        upload_plan["upload_id"]
+    ]
+    reset_clients()
+
+
+@mock_aws
+def test_generate_id_and_tokens_invalid_sizes():
+    """Bad declared sizes get a 400 and start no multipart upload."""
+    bucket_name = "sample-bucket"
+    client("s3", region_name="us-east-1").create_bucket(Bucket=bucket_name)
+
+    for file_size in ("large", None, -1, 1.5, True, MAX_FILE_SIZE + 1):
+        event = {
+            "job_id": "sampleJobID",
+            "file_list": ["large.pqr"],
+            "file_sizes": {"large.pqr": file_size},
+        }
+        with patch.dict(
+            environ,
+            {"INPUT_BUCKET": bucket_name, "AWS_DEFAULT_REGION": "us-east-1"},
+        ):
+            reset_clients()
+            response = generate_id_and_tokens(event, None)
+
+        assert response["statusCode"] == 400, file_size
+        assert "large.pqr" in response["error"]
+        assert "urls" not in response
+
+    uploads = client("s3", region_name="us-east-1").list_multipart_uploads(
+        Bucket=bucket_name
+    )
+    assert not uploads.get("Uploads")
+    reset_clients()
+
+
+@mock_aws
+def test_batch_presigner_caps_plan_parts():
+    """Upload plans for the largest files stay within MAX_PLAN_PARTS."""
+    with patch.dict(environ, {"AWS_DEFAULT_REGION": "us-east-1"}):
+        reset_clients()
+        presigner = BatchPresigner("sample-bucket")
+        upload_plan = presigner.presign_multipart_upload(
+            "2021-05-16/sampleId/large.pqr", "uploadId", MAX_FILE_SIZE
+        )
+
+    assert len(upload_plan["parts"]) <= MAX_PLAN_PARTS
+    assert upload_plan["part_size"] * len(upload_plan["parts"]) >= (
+        MAX_FILE_SIZE
+    )
+    reset_clients()
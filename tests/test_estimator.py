@@ -0,0 +1,244 @@
+from json import dumps, loads
+from math import log
+from pathlib import Path
+from random import Random
+
+from moto import mock_aws
+from boto3 import client
+from lambda_services.job_service import job_service
+from lambda_services.job_service.launcher import estimator
+import pytest
+
+
+def synthetic_samples(count: int, seed: int = 0) -> list:
+    """APBS samples whose runtime and memory grow with the grid size."""
+    rng = Random(seed)
+    samples = []
+    for _ in range(count):
+        grid_points = rng.choice([33, 65, 97, 129, 161]) ** 3
+        atoms = rng.randint(500, 20000)
+        noise = 1 + rng.uniform(-0.1, 0.1)
+        samples.append(
+            (
+                "apbs",
+                {
+                    "calc_type": "mg-auto",
+                    "grid_points": grid_points,
+                    "atoms": atoms,
+                },
+                2e-4 * grid_points * noise,
+                100 + 1e-3 * grid_points * noise,
+            )
+        )
+    return samples
+
+
+def test_apbs_features():
+    infile_text = Path("tests/input_data/1fas.in").read_text()
+    features = estimator.apbs_features(infile_text, {"1fas.pqr": 64609})
+    assert features == {
+        "calc_type": "mg-auto",
+        "grid_points": 129 * 97 * 97,
+        "atoms": 64609 // estimator.BYTES_PER_ATOM[".pqr"],
+    }
+
+
+def test_pdb2pqr_features():
+    features = estimator.pdb2pqr_features(
+        "--ph-calc-method=propka --with-ph=7 --ff=parse 1fas.pdb 1fas.pqr",
+        "https://files.rcsb.org/download/1fas.pdb",
+        None,
+    )
+    assert features == {"pka_method": "propka", "atoms": None}
+
+
+def test_train_and_predict():
+    model = estimator.train_model(synthetic_samples(200))
+    grid_points = 97**3
+    estimate = estimator.predict(
+        model,
+        "apbs",
+        {"calc_type": "mg-auto", "grid_points": grid_points, "atoms": None},
+    )
+
+    """Point estimates are close, upper bounds add a margin"""
+    assert abs(log(estimate.runtime_seconds / (2e-4 * grid_points))) < 0.2
+    assert estimate.runtime_upper > estimate.runtime_seconds
+    assert estimate.memory_upper > estimate.memory_mb
+
+    """Unseen variants fall back to the job type; unseen types can't tell"""
+    assert estimator.predict(model, "apbs", {"calc_type": "fe-manual"})
+    assert estimator.predict(model, "pdb2pqr", {}) is None
+
+
+@mock_aws
+def test_load_samples():
+    """Each successful job with features is one sample, cache hits none."""
+    bucket_name = "pytest_output_bucket"
+    s3_client = client("s3")
+    s3_client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "us-west-2"},
+    )
+
+    def metrics_json(runtime: float, exit_code: int = 0, **extra) -> str:
+        return dumps(
+            {
+                "metrics": {
+                    "rusage": {"ru_maxrss": 204800},
+                    "runtime_in_seconds": runtime,
+                    "exit_code": exit_code,
+                },
+                **extra,
+            }
+        )
+
+    features = {"pka_method": "propka", "atoms": 1000}
+    jobs = {
+        "firstId": metrics_json(10.0, features=features),
+        "secondId": metrics_json(20.0, features=features),
+        "failedId": metrics_json(30.0, 1, features=features),
+        "unfeaturedId": metrics_json(40.0),
+    }
+    for job_id, body in jobs.items():
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=f"2021-05-16/{job_id}/pdb2pqr-metrics.json",
+            Body=body,
+        )
+    # The result cache copies the outputs of the first job for a repeat
+    s3_client.copy_object(
+        CopySource={
+            "Bucket": bucket_name,
+            "Key": "2021-05-16/firstId/pdb2pqr-metrics.json",
+        },
+        Bucket=bucket_name,
+        Key="2021-05-16/repeatId/pdb2pqr-metrics.json",
+    )
+
+    samples = estimator.load_samples(bucket_name, "2021-05-16/")
+
+    assert sorted(samples, key=lambda sample: sample[2]) == [
+        ("pdb2pqr", features, 10.0, 200.0),
+        ("pdb2pqr", features, 20.0, 200.0),
+    ]
+
+
+@pytest.mark.parametrize(
+    "memory_limit_mb,queued", [(15 * 1024, True), (1, False)]
+)
+@mock_aws
+def test_interpret_job_submission_estimate(memory_limit_mb: int, queued: bool):
+    input_bucket_name = "pytest_input_bucket"
+    output_bucket_name = "pytest_output_bucket"
+    queue_name = "pytest_sqs_job_queue"
+    region_name = "us-west-2"
+    job_tag = "2021-05-16/sampleId"
+
+    s3_client = client("s3")
+    for bucket_name in (input_bucket_name, output_bucket_name):
+        s3_client.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": region_name},
+        )
+    sqs_client = client("sqs", region_name=region_name)
+    sqs_client.create_queue(QueueName=queue_name)
+    s3_client.put_object(
+        Bucket=input_bucket_name,
+        Key="info/versions.json",
+        Body=Path("tests/input_data/versions.json").read_text(),
+    )
+    s3_client.put_object(
+        Bucket=input_bucket_name,
+        Key="estimator/model.json",
+        Body=dumps(estimator.train_model(synthetic_samples(200))),
+    )
+
+    # A direct APBS job with its input and molecule files
+    for file_name in ("1fas.in", "1fas.pqr"):
+        s3_client.put_object(
+            Bucket=input_bucket_name,
+            Key=f"{job_tag}/{file_name}",
+            Body=Path(f"tests/input_data/{file_name}").read_text(),
+        )
+    job_object_name = f"{job_tag}/apbs-direct-job.json"
+    s3_client.put_object(
+        Bucket=input_bucket_name,
+        Key=job_object_name,
+        Body=dumps(
+            {"form": {"filename": "1fas.in", "support_files": ["1fas.pqr"]}}
+        ),
+    )
+
+    # Retrieve original global variable names from module
+    original_globals = {
+        name: getattr(job_service, name)
+        for name in (
+            "OUTPUT_BUCKET",
+            "SQS_QUEUE_NAME",
+            "JOB_QUEUE_REGION",
+            "VERSION_BUCKET",
+            "VERSION_KEY",
+            "ESTIMATOR_BUCKET",
+            "ESTIMATOR_KEY",
+            "JOB_MEMORY_LIMIT_MB",
+        )
+    }
+    job_service.OUTPUT_BUCKET = output_bucket_name
+    job_service.SQS_QUEUE_NAME = queue_name
+    job_service.JOB_QUEUE_REGION = region_name
+    job_service.VERSION_BUCKET = input_bucket_name
+    job_service.VERSION_KEY = "info/versions.json"
+    job_service.ESTIMATOR_BUCKET = input_bucket_name
+    job_service.ESTIMATOR_KEY = "estimator/model.json"
+    job_service.JOB_MEMORY_LIMIT_MB = memory_limit_mb
+    job_service.invalidate_caches()
+
+    outcomes = job_service.interpret_job_submission(
+        {
+            "Records": [
+                {
+                    "s3": {
+                        "bucket": {"name": input_bucket_name},
+                        "object": {"key": job_object_name},
+                    }
+                }
+            ]
+        },
+        None,
+    )
+
+    queue_url: str = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
+    queue_message_response = sqs_client.receive_message(
+        QueueUrl=queue_url, MaxNumberOfMessages=1
+    )
+    status_object_data: dict = loads(
+        s3_client.get_object(
+            Bucket=output_bucket_name, Key=f"{job_tag}/apbs-status.json"
+        )["Body"].read()
+    )
+    if queued:
+        """The prediction sets the timeout and memory of the job"""
+        assert outcomes[job_object_name] == "queued"
+        message_contents: dict = loads(
+            queue_message_response["Messages"][0]["Body"]
+        )
+        assert message_contents["features"]["calc_type"] == "mg-auto"
+        assert message_contents["features"]["grid_points"] == 129 * 97 * 97
+        assert (
+            estimator.MIN_RUNTIME_SECONDS
+            <= message_contents["max_run_time"]
+            < job_service.JOB_RUNTIME_LIMIT
+        )
+        assert message_contents["memory_mb"] > 0
+    else:
+        """Infeasible jobs fail early with a message"""
+        assert outcomes[job_object_name] == "not queued"
+        assert "Messages" not in queue_message_response
+        assert status_object_data["apbs"]["status"] == "failed"
+        assert "memory" in status_object_data["apbs"]["message"]
+
+    # Reset module global variables to original state
+    for name, value in original_globals.items():
+        setattr(job_service, name, value)
+    job_service.invalidate_caches()
@@ -0,0 +1,910 @@
+"""Tests for claiming, draining and measuring jobs in the job controller."""
+
+from importlib.util import module_from_spec, spec_from_file_location
+from io import BytesIO
+from json import dumps, loads
+from os import getpid
+from pathlib import Path
+from threading import Event
+from time import sleep, time
+
+from moto import mock_aws
+from boto3 import client
+import pytest
+
+# The job controller is a script in the worker image, not a package
+JOB_CONTROL_PATH = Path(__file__).parents[1] / "src/docker/job_control.py"
+_SPEC = spec_from_file_location("job_control", JOB_CONTROL_PATH)
+job_control = module_from_spec(_SPEC)
+_SPEC.loader.exec_module(job_control)
+
+OUTPUT_BUCKET = "pytest-output-bucket"
+REGION_NAME = "us-west-2"
+JOB_TAG = "2021-05-16/sampleId"
+LEASE_KEY = f"{job_control.JOB_LEASE_PREFIX}{JOB_TAG}/pdb2pqr.json"
+
+
+@pytest.fixture
+def output_bucket(monkeypatch: pytest.MonkeyPatch):
+    """Create the output bucket and point the job controller at it."""
+    monkeypatch.setenv("AWS_DEFAULT_REGION", REGION_NAME)
+    monkeypatch.setitem(
+        job_control.GLOBAL_VARS, "S3_TOPLEVEL_BUCKET", OUTPUT_BUCKET
+    )
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "AWS_REGION", REGION_NAME)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "Q_TIMEOUT", 300)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "HEARTBEAT_TIMEOUT", 120)
+    monkeypatch.setattr(job_control, "_CLIENTS", {})
+    with mock_aws():
+        s3_client = client("s3", region_name=REGION_NAME)
+        s3_client.create_bucket(
+            Bucket=OUTPUT_BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": REGION_NAME},
+        )
+        yield s3_client
+
+
+def read_lease(s3_client) -> dict:
+    s3obj = s3_client.get_object(Bucket=OUTPUT_BUCKET, Key=LEASE_KEY)
+    return loads(s3obj["Body"].read())
+
+
+def lease_exists(s3_client) -> bool:
+    response = s3_client.list_objects_v2(
+        Bucket=OUTPUT_BUCKET, Prefix=job_control.JOB_LEASE_PREFIX
+    )
+    return response["KeyCount"] > 0
+
+
+def test_acquire_live_lease(output_bucket):
+    """A live lease can't be claimed again, by any message."""
+    holder = job_control.JobLease(output_bucket, JOB_TAG, "pdb2pqr", "msg-1")
+    holder.acquire(300)
+    assert read_lease(output_bucket)["message_id"] == "msg-1"
+
+    """A redelivery of the same message waits for the lease to expire"""
+    redelivery = job_control.JobLease(
+        output_bucket, JOB_TAG, "pdb2pqr", "msg-1"
+    )
+    with pytest.raises(job_control.JobClaimedError) as claimed:
+        redelivery.acquire(300)
+    assert claimed.value.same_message
+    assert claimed.value.holder["expires"] > time()
+
+    """Another message for the same job is a duplicate"""
+    duplicate = job_control.JobLease(
+        output_bucket, JOB_TAG, "pdb2pqr", "msg-2"
+    )
+    with pytest.raises(job_control.JobClaimedError) as claimed:
+        duplicate.acquire(300)
+    assert not claimed.value.same_message
+
+    """The holder keeps its lease, and can claim the job again once done"""
+    assert holder.renew(300)
+    holder.release()
+    assert not lease_exists(output_bucket)
+    duplicate.acquire(300)
+    assert read_lease(output_bucket)["message_id"] == "msg-2"
+
+
+def test_acquire_expired_lease(output_bucket):
+    """An expired lease is taken over, and its old owner loses it."""
+    dead_worker = job_control.JobLease(
+        output_bucket, JOB_TAG, "pdb2pqr", "msg-1"
+    )
+    dead_worker.acquire(-1)
+
+    new_worker = job_control.JobLease(
+        output_bucket, JOB_TAG, "pdb2pqr", "msg-1"
+    )
+    new_worker.acquire(300)
+    assert read_lease(output_bucket)["owner"] == new_worker._owner
+
+    assert not dead_worker.renew(300)
+    # Releasing a lost lease leaves the new owner's lease in place
+    dead_worker.release()
+    assert read_lease(output_bucket)["owner"] == new_worker._owner
+
+
+def test_release_lost_lease(output_bucket):
+    """Releasing a lease that was taken over leaves the new one alone."""
+    dead_worker = job_control.JobLease(
+        output_bucket, JOB_TAG, "pdb2pqr", "msg-1"
+    )
+    dead_worker.acquire(-1)
+    new_worker = job_control.JobLease(
+        output_bucket, JOB_TAG, "pdb2pqr", "msg-1"
+    )
+    new_worker.acquire(300)
+
+    # No renewal since the takeover, so the old owner doesn't know yet
+    dead_worker.release()
+
+    assert read_lease(output_bucket)["owner"] == new_worker._owner
+    new_worker.release()
+    assert not lease_exists(output_bucket)
+
+
+@pytest.fixture
+def job_queue(output_bucket):
+    """Create a job queue holding one message for the sample job."""
+    sqs_client = client("sqs", region_name=REGION_NAME)
+    queue_url = sqs_client.create_queue(QueueName="pytest-job-q")["QueueUrl"]
+    sqs_client.send_message(
+        QueueUrl=queue_url,
+        MessageBody=dumps(
+            {
+                "job_date": "2021-05-16",
+                "job_id": "sampleId",
+                "job_tag": JOB_TAG,
+                "job_type": "pdb2pqr",
+                "bucket_name": "pytest-input-bucket",
+                "input_files": [],
+                "command_line_args": "",
+                "max_run_time": 300,
+            }
+        ),
+    )
+    yield sqs_client, queue_url
+
+
+def run_queued_message(sqs_client, queue_url: str, s3_client):
+    """Run the queued job in a worker slot, as main() does."""
+    message = sqs_client.receive_message(
+        QueueUrl=queue_url, AttributeNames=["All"], VisibilityTimeout=300
+    )["Messages"][0]
+    budget = job_control.ResourceBudget()
+    request = (0, 0)
+    budget.try_acquire(request)
+    job_control.run_slot(
+        message, s3_client, sqs_client, queue_url, budget, request
+    )
+    return message
+
+
+def queued_messages(sqs_client, queue_url: str) -> int:
+    attributes = sqs_client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=[
+            "ApproximateNumberOfMessages",
+            "ApproximateNumberOfMessagesNotVisible",
+        ],
+    )["Attributes"]
+    return sum(int(count) for count in attributes.values())
+
+
+def upload_status(s3_client, status: str):
+    s3_client.put_object(
+        Bucket=OUTPUT_BUCKET,
+        Key=f"{JOB_TAG}/pdb2pqr-status.json",
+        Body=dumps({"jobtype": "pdb2pqr", "pdb2pqr": {"status": status}}),
+    )
+
+
+def test_run_slot_job_finished(output_bucket, job_queue):
+    """A redelivered message of a finished job is dropped, not rerun."""
+    sqs_client, queue_url = job_queue
+    upload_status(output_bucket, "complete")
+
+    run_queued_message(sqs_client, queue_url, output_bucket)
+
+    assert queued_messages(sqs_client, queue_url) == 0
+    assert not lease_exists(output_bucket)
+
+
+def test_run_slot_duplicate_message(output_bucket, job_queue):
+    """A second message for a claimed job is deleted."""
+    sqs_client, queue_url = job_queue
+    upload_status(output_bucket, "running")
+    holder = job_control.JobLease(output_bucket, JOB_TAG, "pdb2pqr", "other")
+    holder.acquire(300)
+
+    run_queued_message(sqs_client, queue_url, output_bucket)
+
+    assert queued_messages(sqs_client, queue_url) == 0
+    assert read_lease(output_bucket)["owner"] == holder._owner
+
+
+def test_run_slot_redelivered_message(output_bucket, job_queue):
+    """A redelivery of the claimed message is kept until the claim expires."""
+    sqs_client, queue_url = job_queue
+    upload_status(output_bucket, "running")
+    message_id = sqs_client.receive_message(
+        QueueUrl=queue_url, VisibilityTimeout=0
+    )["Messages"][0]["MessageId"]
+    holder = job_control.JobLease(
+        output_bucket, JOB_TAG, "pdb2pqr", message_id
+    )
+    holder.acquire(300)
+
+    run_queued_message(sqs_client, queue_url, output_bucket)
+
+    assert queued_messages(sqs_client, queue_url) == 1
+    assert read_lease(output_bucket)["owner"] == holder._owner
+
+
+def test_execute_command_interrupted(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """A job killed by a signal during a drain is requeued, not failed."""
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "LOG_MAX_BYTES", 0)
+    # The job fails unless it runs in its own session, where a SIGTERM
+    # forwarded to the worker's process group can't reach it
+    command = tmp_path / "job.py"
+    command.write_text(
+        "#!/usr/bin/env python3\n"
+        "import os, signal\n"
+        "assert os.getsid(0) == os.getpid()\n"
+        "os.kill(os.getpid(), signal.SIGTERM)\n"
+    )
+    command.chmod(0o755)
+
+    job_control.DRAINING.set()
+    try:
+        with pytest.raises(job_control.JobInterruptedError):
+            job_control.execute_command(
+                JOB_TAG,
+                str(command),
+                str(tmp_path / "job.stdout.txt"),
+                str(tmp_path / "job.stderr.txt"),
+                str(tmp_path),
+            )
+    finally:
+        job_control.DRAINING.clear()
+
+
+def test_execute_command_rusage(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """Each job's rusage is its own process's, not all children's."""
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "LOG_MAX_BYTES", 0)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "SAMPLE_SECONDS", 0)
+    command = tmp_path / "job.py"
+    command.write_text(
+        "#!/usr/bin/env python3\n"
+        "import sys\n"
+        "block = b'x' * (int(sys.argv[1]) * 2**20)\n"
+        "total = sum(range(10**7))\n"
+        "sys.exit(3)\n"
+    )
+    command.chmod(0o755)
+
+    usage = {}
+    for megabytes in (384, 1):
+        metrics = job_control.JobMetrics()
+        exit_code = job_control.execute_command(
+            JOB_TAG,
+            f"{command} {megabytes}",
+            str(tmp_path / "job.stdout.txt"),
+            str(tmp_path / "job.stderr.txt"),
+            str(tmp_path),
+            metrics,
+        )
+        assert exit_code == 3
+        usage[megabytes] = metrics.get_rusage()
+
+    """ru_maxrss (KiB) is the peak of each job, even after a bigger one"""
+    # Both include the worker's RSS at the fork, which is below the gap
+    assert usage[384]["ru_maxrss"] >= 384 * 1024
+    assert usage[1]["ru_maxrss"] < usage[384]["ru_maxrss"] - 64 * 1024
+    assert usage[384]["ru_utime"] > 0
+
+
+def test_publish_metrics_samples_not_outputs(output_bucket):
+    """Resource samples are uploaded, but not listed as job outputs."""
+    metrics = job_control.JobMetrics()
+    metrics.exit_code = 0
+    metrics.sampler = job_control.ResourceSampler(getpid(), 1, 10)
+    metrics.sampler.sample()
+
+    output_files = metrics.publish_metrics(output_bucket, JOB_TAG, "apbs")
+
+    assert output_files == [f"{JOB_TAG}/apbs-metrics.json"]
+    s3obj = output_bucket.get_object(
+        Bucket=OUTPUT_BUCKET, Key=f"{JOB_TAG}/apbs-timeseries.json"
+    )
+    assert loads(s3obj["Body"].read())["samples"] == 1
+
+
+def test_phase_timer(monkeypatch: pytest.MonkeyPatch):
+    """Laps charge consecutive intervals; repeated phases add up."""
+    clock = iter([100.0, 101.5, 104.0, 104.25])
+    monkeypatch.setattr(job_control, "time", lambda: next(clock))
+    phases = job_control.PhaseTimer()
+
+    phases.lap("download")
+    phases.lap("execution")
+    phases.add("queue_wait", 2.0)
+    phases.lap("download")
+
+    assert phases.started == 100.0
+    assert phases.phases == {
+        "download": 1.75,
+        "execution": 2.5,
+        "queue_wait": 2.0,
+    }
+
+
+def test_get_timings():
+    """The enqueue time spans the job's preparation to its SentTimestamp."""
+    metrics = job_control.JobMetrics()
+    metrics.phases.add("execution", 12.0)
+    assert metrics.get_timings() == {"worker": {"execution": 12.0}}
+
+    metrics.submission_timings = {
+        "fetch_job_info": 0.04,
+        "prepare_job": 0.2,
+        "prepared_at": 1000.0,
+    }
+    metrics.sent_at = 1000.0625
+    assert metrics.get_timings() == {
+        "worker": {"execution": 12.0},
+        "submission": {
+            "fetch_job_info": 0.04,
+            "prepare_job": 0.2,
+            "enqueue": 0.062,
+        },
+    }
+    """Clock skew can't make it negative; the message is left as is"""
+    metrics.sent_at = 999.0
+    assert metrics.get_timings()["submission"]["enqueue"] == 0
+    assert metrics.submission_timings["prepared_at"] == 1000.0
+
+
+@pytest.fixture
+def receive_settings(monkeypatch: pytest.MonkeyPatch):
+    """Receive without long polls, so an empty queue returns at once."""
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "WAIT_TIME", 0)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "MAX_MESSAGES", 10)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "RETRY_TIME", 1)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "MAX_IDLE_TIME", 60)
+
+
+def test_get_messages_batch(job_queue, receive_settings):
+    """One receive returns every queued message, up to MAX_MESSAGES."""
+    sqs_client, queue_url = job_queue
+    for _ in range(2):
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody="{}")
+
+    messages = job_control.get_messages(sqs_client, queue_url)["Messages"]
+
+    assert len(messages) == 3
+    assert all("SentTimestamp" in msg["Attributes"] for msg in messages)
+    """They stay invisible to other workers for Q_TIMEOUT"""
+    assert "Messages" not in sqs_client.receive_message(QueueUrl=queue_url)
+
+
+def test_get_messages_idle(
+    output_bucket, receive_settings, monkeypatch: pytest.MonkeyPatch
+):
+    """An empty queue is given up on after MAX_IDLE_TIME seconds."""
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "MAX_IDLE_TIME", 1)
+    sqs_client = client("sqs", region_name=REGION_NAME)
+    queue_url = sqs_client.create_queue(QueueName="pytest-empty-q")["QueueUrl"]
+
+    start = time()
+    assert job_control.get_messages(sqs_client, queue_url) is None
+    assert 1 <= time() - start < 5
+
+
+def test_get_messages_draining(output_bucket, receive_settings):
+    """A draining worker stops waiting for messages at once."""
+    sqs_client = client("sqs", region_name=REGION_NAME)
+    queue_url = sqs_client.create_queue(QueueName="pytest-empty-q")["QueueUrl"]
+
+    job_control.DRAINING.set()
+    try:
+        start = time()
+        assert job_control.get_messages(sqs_client, queue_url) is None
+        assert time() - start < 5
+    finally:
+        job_control.DRAINING.clear()
+
+
+def test_leased_messages(job_queue, receive_settings):
+    """Held messages are run oldest first, and released to the queue."""
+    sqs_client, queue_url = job_queue
+    sqs_client.send_message(QueueUrl=queue_url, MessageBody="{}")
+    leased = job_control.LeasedMessages(sqs_client, queue_url)
+    leased.add(job_control.get_messages(sqs_client, queue_url)["Messages"])
+    assert len(leased) == 2
+
+    first = leased.peek()
+    assert leased.pop() is first
+    assert loads(first["Body"])["job_tag"] == JOB_TAG
+
+    """Renewing keeps the held message invisible"""
+    leased.renew()
+    assert "Messages" not in sqs_client.receive_message(QueueUrl=queue_url)
+
+    """Releasing makes it visible again at once, and empties the buffer"""
+    leased.release()
+    assert len(leased) == 0
+    assert leased.pop() is None
+    returned = sqs_client.receive_message(QueueUrl=queue_url)["Messages"]
+    assert returned[0]["Body"] == "{}"
+
+
+@pytest.fixture
+def budget_settings(monkeypatch: pytest.MonkeyPatch):
+    """Pretend the worker has 4 CPUs and 4096 MB, and set job defaults."""
+    monkeypatch.setattr(job_control, "_worker_cpus", lambda: 4)
+    monkeypatch.setattr(job_control, "_worker_memory_mb", lambda: 4096)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "JOB_SLOTS", 2)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "APBS_CPUS", 0)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "APBS_MEMORY_MB", 2048)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "PDB2PQR_CPUS", 1)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "PDB2PQR_MEMORY_MB", 1024)
+
+
+@pytest.mark.parametrize(
+    "job,expected",
+    [
+        pytest.param({"job_type": "pdb2pqr"}, (1, 1024), id="pdb2pqr"),
+        # 0 CPUs means the whole worker
+        pytest.param({"job_type": "apbs"}, (4, 2048), id="apbs"),
+        pytest.param(
+            {"job_type": "apbs", "cpus": 2, "memory_mb": 3000},
+            (2, 3000),
+            id="from message",
+        ),
+        pytest.param(
+            {"job_type": "apbs", "cpus": 64, "memory_mb": 99999},
+            (4, 4096),
+            id="clamped",
+        ),
+        pytest.param(
+            {"job_type": "pdb2pqr", "cpus": "many", "memory_mb": -1},
+            (1, 1024),
+            id="malformed",
+        ),
+    ],
+)
+def test_budget_request_for(budget_settings, job: dict, expected: tuple):
+    """Reservations come from the message, else the job type defaults."""
+    budget = job_control.ResourceBudget()
+    assert budget.request_for(dumps(job)) == expected
+
+
+def test_budget_request_for_invalid_body(budget_settings):
+    """A body that isn't a JSON object gets the PDB2PQR defaults."""
+    budget = job_control.ResourceBudget()
+    assert budget.request_for("not json") == (1, 1024)
+    assert budget.request_for("[1, 2]") == (1, 1024)
+
+
+def test_budget_acquire_release(budget_settings):
+    """Jobs are admitted while their CPUs and memory fit."""
+    budget = job_control.ResourceBudget()
+    assert budget.try_acquire((2, 2048))
+    assert not budget.try_acquire((3, 1024))
+    assert not budget.try_acquire((1, 3000))
+    assert budget.try_acquire((2, 2048))
+    assert not budget.try_acquire((0, 1))
+
+    budget.release((2, 2048))
+    assert budget.try_acquire((1, 1024))
+
+
+def test_main_receives_while_job_runs(
+    job_queue,
+    receive_settings,
+    budget_settings,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """A worker whose queue ran dry still fills slots a long job leaves."""
+    sqs_client, queue_url = job_queue
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "MAX_IDLE_TIME", 0)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "QUEUE", "pytest-job-q")
+    ran = []
+    second_job_ran = Event()
+
+    def run_slot(message, s3client, sqs, qurl, budget, request):
+        try:
+            ran.append(message["Body"])
+            if len(ran) == 1:
+                # The queue is empty while this job runs; then a job arrives
+                sleep(0.5)
+                sqs_client.send_message(QueueUrl=queue_url, MessageBody="{}")
+                second_job_ran.wait(10)
+            else:
+                second_job_ran.set()
+            sqs.delete_message(
+                QueueUrl=qurl, ReceiptHandle=message["ReceiptHandle"]
+            )
+        finally:
+            budget.release(request)
+
+    monkeypatch.setattr(job_control, "run_slot", run_slot)
+    job_control.main()
+
+    assert second_job_ran.is_set()
+    assert ran[1] == "{}"
+    assert queued_messages(sqs_client, queue_url) == 0
+
+
+INPUT_BUCKET = "pytest-input-bucket"
+
+
+@pytest.fixture
+def job_path(output_bucket, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """Run jobs under tmp_path, with an input bucket and no input cache."""
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "JOB_PATH", f"{tmp_path}/")
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "TRANSFER_THREADS", 4)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "INPUT_CACHE_MB", 0)
+    output_bucket.create_bucket(
+        Bucket=INPUT_BUCKET,
+        CreateBucketConfiguration={"LocationConstraint": REGION_NAME},
+    )
+    (tmp_path / JOB_TAG).mkdir(parents=True)
+    yield tmp_path
+
+
+def test_download_input_files(output_bucket, job_path: Path):
+    """Every input is downloaded, renamed ones under their local name."""
+    input_files = [f"{JOB_TAG}/in-{idx}.pqr" for idx in range(5)]
+    for object_name in input_files:
+        output_bucket.put_object(
+            Bucket=INPUT_BUCKET, Key=object_name, Body=object_name
+        )
+    renames = {input_files[0]: "in-0-renamed.pqr"}
+
+    failed = job_control.download_input_files(
+        output_bucket, JOB_TAG, INPUT_BUCKET, input_files, renames
+    )
+
+    assert failed == []
+    assert (job_path / JOB_TAG / "in-0-renamed.pqr").read_text() == (
+        input_files[0]
+    )
+    assert not (job_path / JOB_TAG / "in-0.pqr").exists()
+    for object_name in input_files[1:]:
+        assert (job_path / object_name).read_text() == object_name
+
+
+def test_download_input_files_missing(output_bucket, job_path: Path):
+    """Inputs that can't be downloaded are all reported."""
+    output_bucket.put_object(
+        Bucket=INPUT_BUCKET, Key=f"{JOB_TAG}/present.pqr", Body="ATOM"
+    )
+    input_files = [
+        f"{JOB_TAG}/missing-1.pqr",
+        f"{JOB_TAG}/present.pqr",
+        f"{JOB_TAG}/missing-2.pqr",
+    ]
+
+    failed = job_control.download_input_files(
+        output_bucket, JOB_TAG, INPUT_BUCKET, input_files
+    )
+
+    assert failed == [input_files[0], input_files[2]]
+    assert (job_path / JOB_TAG / "present.pqr").read_text() == "ATOM"
+    assert (
+        job_control.download_input_files(
+            output_bucket, JOB_TAG, INPUT_BUCKET, []
+        )
+        == []
+    )
+
+
+def fill_with(contents: bytes, fills: list):
+    """Build an InputCache fill that writes contents and counts its calls."""
+
+    def fill(path: str):
+        fills.append(path)
+        Path(path).write_bytes(contents)
+
+    return fill
+
+
+def test_input_cache_lru(tmp_path: Path):
+    """The least recently used file is evicted; hits don't refill."""
+    cache = job_control.InputCache(f"{tmp_path}/cache", 10)
+    fills = []
+    dest = f"{tmp_path}/dest"
+
+    assert not cache.fetch("a", dest, fill_with(b"aaaa", fills))
+    assert cache.fetch("a", dest, fill_with(b"----", fills))
+    assert Path(dest).read_bytes() == b"aaaa"
+    assert not cache.fetch("b", dest, fill_with(b"bbbb", fills))
+    # "a" is used again, so "b" is the one evicted for "c"
+    assert cache.fetch("a", dest, fill_with(b"----", fills))
+    assert not cache.fetch("c", dest, fill_with(b"cccc", fills))
+    assert len(fills) == 3
+
+    assert cache.fetch("a", dest, fill_with(b"----", fills))
+    assert cache.fetch("c", dest, fill_with(b"----", fills))
+    assert not cache.fetch("b", dest, fill_with(b"bbbb", fills))
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+
+
+def test_input_cache_oversized(tmp_path: Path):
+    """A file larger than the cache is handed over without being kept."""
+    cache = job_control.InputCache(f"{tmp_path}/cache", 10)
+    fills = []
+    dest = f"{tmp_path}/dest"
+
+    assert not cache.fetch("big", dest, fill_with(b"x" * 20, fills))
+    assert Path(dest).read_bytes() == b"x" * 20
+    assert not cache.fetch("big", dest, fill_with(b"x" * 20, fills))
+    assert len(fills) == 2
+    assert list((tmp_path / "cache").iterdir()) == []
+
+
+def test_download_input_file_cached_by_etag(
+    output_bucket, job_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """An S3 input uploaded again for another job is a cache hit."""
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "INPUT_CACHE_MB", 1)
+    monkeypatch.setitem(
+        job_control.GLOBAL_VARS, "INPUT_CACHE_DIR", f"{job_path}/cache"
+    )
+    monkeypatch.setattr(job_control, "_INPUT_CACHE", None)
+    other_tag = "2021-05-16/otherId"
+    (job_path / other_tag).mkdir(parents=True)
+    etags = {}
+    for job_tag in (JOB_TAG, other_tag):
+        etags[job_tag] = output_bucket.put_object(
+            Bucket=INPUT_BUCKET, Key=f"{job_tag}/1fas.pdb", Body="ATOM"
+        )["ETag"]
+    assert etags[JOB_TAG] == etags[other_tag]
+
+    job_control.download_input_file(
+        output_bucket,
+        JOB_TAG,
+        INPUT_BUCKET,
+        f"{JOB_TAG}/1fas.pdb",
+        etag=etags[JOB_TAG],
+    )
+    # Only the cache can serve the second job's copy now
+    output_bucket.delete_object(
+        Bucket=INPUT_BUCKET, Key=f"{other_tag}/1fas.pdb"
+    )
+    job_control.download_input_file(
+        output_bucket,
+        other_tag,
+        INPUT_BUCKET,
+        f"{other_tag}/1fas.pdb",
+        etag=etags[other_tag],
+    )
+
+    assert (job_path / other_tag / "1fas.pdb").read_text() == "ATOM"
+    assert len(list((job_path / "cache").iterdir())) == 1
+
+    """An S3 input without an ETag is downloaded, not cached"""
+    output_bucket.put_object(
+        Bucket=INPUT_BUCKET, Key=f"{JOB_TAG}/1fas.in", Body="read"
+    )
+    job_control.download_input_file(
+        output_bucket, JOB_TAG, INPUT_BUCKET, f"{JOB_TAG}/1fas.in"
+    )
+    assert (job_path / JOB_TAG / "1fas.in").read_text() == "read"
+    assert len(list((job_path / "cache").iterdir())) == 1
+
+
+def test_changed_files(tmp_path: Path):
+    """Only files created or changed since the snapshot are listed."""
+    (tmp_path / "unchanged.pqr").write_text("ATOM 1")
+    (tmp_path / "changed.in").write_text("READ")
+    (tmp_path / "subdir").mkdir()
+    snapshot = job_control.snapshot_files(str(tmp_path))
+    assert set(snapshot) == {"unchanged.pqr", "changed.in"}
+
+    (tmp_path / "changed.in").write_text("READ mol pqr")
+    (tmp_path / "new.dx").write_text("object 1")
+
+    assert sorted(job_control.changed_files(str(tmp_path), snapshot)) == [
+        "changed.in",
+        "new.dx",
+    ]
+
+
+def test_publish_output_files(
+    output_bucket, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """Outputs are uploaded, and only those uploaded are returned."""
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "TRANSFER_THREADS", 2)
+    for name in ("a.dx", "b.txt", "c.pqr"):
+        (tmp_path / name).write_text(name)
+
+    output_files = job_control.publish_output_files(
+        output_bucket,
+        JOB_TAG,
+        str(tmp_path),
+        ["a.dx", "vanished.txt", "c.pqr"],
+    )
+
+    assert output_files == [f"{JOB_TAG}/a.dx", f"{JOB_TAG}/c.pqr"]
+    for object_name in output_files:
+        s3obj = output_bucket.get_object(Bucket=OUTPUT_BUCKET, Key=object_name)
+        assert s3obj["Body"].read().decode() == object_name.split("/")[-1]
+    assert (
+        job_control.publish_output_files(
+            output_bucket, JOB_TAG, str(tmp_path), []
+        )
+        == []
+    )
+
+
+@pytest.mark.parametrize(
+    "data,max_bytes,expected",
+    [
+        pytest.param(b"0123456789", 0, b"0123456789", id="no limit"),
+        pytest.param(b"0123456789", 10, b"0123456789", id="within limit"),
+        pytest.param(
+            b"0123456789abcdefghij",
+            10,
+            b"01234\n[... truncated 10 bytes ...]\nfghij",
+            id="truncated",
+        ),
+        pytest.param(
+            b"0123456789abcdefghij",
+            5,
+            b"012\n[... truncated 15 bytes ...]\nij",
+            id="odd limit",
+        ),
+    ],
+)
+def test_stream_to_file(data: bytes, max_bytes: int, expected: bytes):
+    """A capped stream keeps its head and tail around a marker."""
+    fout = BytesIO()
+    job_control.stream_to_file(BytesIO(data), fout, max_bytes)
+    assert fout.getvalue() == expected
+
+
+def test_stream_to_file_chunks():
+    """The head and tail are exact when the output spans many reads."""
+    data = bytes(range(256)) * 1000
+    assert len(data) > 3 * job_control.LOG_CHUNK_SIZE
+    fout = BytesIO()
+
+    job_control.stream_to_file(BytesIO(data), fout, 1000)
+
+    marker = f"\n[... truncated {len(data) - 1000} bytes ...]\n".encode()
+    assert fout.getvalue() == data[:500] + marker + data[-500:]
+
+
+class RecordingQueue:
+    """Stands in for the SQS client, recording visibility changes."""
+
+    def __init__(self):
+        self.extensions = []
+
+    def change_message_visibility(self, **kwargs):
+        self.extensions.append((time(), kwargs["VisibilityTimeout"]))
+
+
+class RecordingLease:
+    """Stands in for a JobLease, recording renewals."""
+
+    def __init__(self):
+        self.renewals = []
+
+    def renew(self, timeout: int) -> bool:
+        self.renewals.append(timeout)
+        return True
+
+
+def test_heartbeat_past_max_run_time(monkeypatch: pytest.MonkeyPatch):
+    """A job running past max_run_time keeps its message and lease."""
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "HEARTBEAT_TIMEOUT", 0.3)
+    monkeypatch.setitem(job_control.GLOBAL_VARS, "Q_TIMEOUT", 300)
+    queue = RecordingQueue()
+    lease = RecordingLease()
+
+    start = time()
+    with job_control.VisibilityHeartbeat(
+        queue, "queue-url", "receipt", JOB_TAG, 1, lease
+    ):
+        sleep(1.6)
+
+    beats = [at - start for at, timeout in queue.extensions if timeout == 0.3]
+    assert beats[0] < 0.1
+    assert any(at > 1.3 for at in beats)
+    """On exit, the message gets Q_TIMEOUT to publish the outputs"""
+    assert queue.extensions[-1][1] == 300
+    assert lease.renewals == [timeout for _, timeout in queue.extensions]
+
+
+def test_run_job_lease_released_on_error(
+    output_bucket, job_queue, monkeypatch: pytest.MonkeyPatch
+):
+    """A job that fails before it runs releases its lease."""
+    sqs_client, queue_url = job_queue
+    # There is no status file to check the job against
+    monkeypatch.setattr(job_control, "STATUS_READ_DELAYS", ())
+
+    run_queued_message(sqs_client, queue_url, output_bucket)
+
+    assert not lease_exists(output_bucket)
+    """The message is kept, to be retried"""
+    assert queued_messages(sqs_client, queue_url) == 1
+
+
+def test_run_job_heartbeat_covers_download(
+    output_bucket, job_queue, job_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """The lease is renewed by the heartbeat while inputs download."""
+    sqs_client, queue_url = job_queue
+    upload_status(output_bucket, "pending")
+    lease_expiry = []
+
+    def download_input_files(s3client, job_tag, inbucket, files, *args):
+        lease_expiry.append(read_lease(output_bucket)["expires"] - time())
+        return ["missing.pqr"]
+
+    monkeypatch.setattr(
+        job_control, "download_input_files", download_input_files
+    )
+
+    run_queued_message(sqs_client, queue_url, output_bucket)
+
+    # Acquired for Q_TIMEOUT (300 s), renewed for HEARTBEAT_TIMEOUT (120 s)
+    assert 0 < lease_expiry[0] <= 120
+    assert not lease_exists(output_bucket)
+    assert queued_messages(sqs_client, queue_url) == 0
+    s3obj = output_bucket.get_object(
+        Bucket=OUTPUT_BUCKET, Key=f"{JOB_TAG}/pdb2pqr-status.json"
+    )
+    assert loads(s3obj["Body"].read())["pdb2pqr"]["status"] == "failed"
+
+
+def read_status(s3_client) -> dict:
+    s3obj = s3_client.get_object(
+        Bucket=OUTPUT_BUCKET, Key=f"{JOB_TAG}/pdb2pqr-status.json"
+    )
+    return loads(s3obj["Body"].read())
+
+
+def test_update_status_conflict(output_bucket):
+    """An update made over a changed status file keeps both changes."""
+    upload_status(output_bucket, "pending")
+    objectfile = f"{JOB_TAG}/pdb2pqr-status.json"
+
+    job_control.update_status(
+        output_bucket, JOB_TAG, "pdb2pqr", job_control.JOBSTATUS.RUNNING, []
+    )
+    assert read_status(output_bucket)["pdb2pqr"]["status"] == "running"
+    assert objectfile in job_control._STATUS_CACHE
+
+    """Someone else writes the file, so the cached ETag is stale"""
+    status = read_status(output_bucket)
+    status["pdb2pqr"]["message"] = "written elsewhere"
+    output_bucket.put_object(
+        Bucket=OUTPUT_BUCKET, Key=objectfile, Body=dumps(status)
+    )
+
+    job_control.update_status(
+        output_bucket,
+        JOB_TAG,
+        "pdb2pqr",
+        job_control.JOBSTATUS.COMPLETE,
+        [f"{JOB_TAG}/output.pqr"],
+    )
+    status = read_status(output_bucket)["pdb2pqr"]
+    assert status["status"] == "complete"
+    assert status["outputFiles"] == [f"{JOB_TAG}/output.pqr"]
+    assert status["message"] == "written elsewhere"
+    assert status["endTime"] is not None
+    assert objectfile not in job_control._STATUS_CACHE
+
+
+def test_run_job_forgets_status_on_error(
+    output_bucket, job_queue, monkeypatch: pytest.MonkeyPatch
+):
+    """A job that fails after a status update leaves nothing cached."""
+    sqs_client, queue_url = job_queue
+    upload_status(output_bucket, "pending")
+
+    def run_claimed_job(job_info, s3client, metrics):
+        job_control.update_status(
+            s3client, JOB_TAG, "pdb2pqr", job_control.JOBSTATUS.RUNNING, []
+        )
+        raise RuntimeError("job failed")
+
+    monkeypatch.setattr(job_control, "run_claimed_job", run_claimed_job)
+
+    run_queued_message(sqs_client, queue_url, output_bucket)
+
+    assert read_status(output_bucket)["pdb2pqr"]["status"] == "running"
+    assert f"{JOB_TAG}/pdb2pqr-status.json" not in job_control._STATUS_CACHE
@@ -12,6 +12,7 @@ from moto import mock_aws
 from boto3 import client
 from botocore.exceptions import ClientError
 from lambda_services.job_service import job_service
+from lambda_services.job_service.launcher import aws_clients
 import pytest
 
 
@@ -148,12 +149,42 @@ def initialize_version_environment():
         original_VERSION_KEY = job_service.VERSION_KEY
         job_service.VERSION_BUCKET = version_bucket
         job_service.VERSION_KEY = version_key
+        job_service.invalidate_caches()
 
         yield
 
         # Reset state of environment variables
         job_service.VERSION_BUCKET = original_VERSION_BUCKET
         job_service.VERSION_KEY = original_VERSION_KEY
+        job_service.invalidate_caches()
+
+
+def test_get_client_is_pooled():
+    """The same client is returned for a service/region pair."""
+    with mock_aws():
+        aws_clients.reset_clients()
+        s3_client = aws_clients.get_client("s3")
+        assert aws_clients.get_client("s3") is s3_client
+        assert aws_clients.get_client("sqs", "us-west-2") is not s3_client
+        assert (
+            s3_client.meta.config.max_pool_connections
+            == aws_clients.CLIENT_CONFIG.max_pool_connections
+        )
+        aws_clients.reset_clients()
+        assert aws_clients.get_client("s3") is not s3_client
+
+
+def test_get_version_info_is_cached(initialize_version_environment):
+    """Version info is served from cache until invalidated."""
+    version_info = job_service.get_version_info("sample_job_tag")
+    client("s3").delete_object(
+        Bucket=job_service.VERSION_BUCKET, Key=job_service.VERSION_KEY
+    )
+    assert job_service.get_version_info("sample_job_tag") == version_info
+
+    job_service.invalidate_caches()
+    with pytest.raises(ClientError):
+        job_service.get_version_info("sample_job_tag")
 
 
 def test_get_job_info(initialize_input_bucket):
@@ -503,6 +534,21 @@ def test_interpret_job_submission_success(
     message_contents: dict = loads(queue_message["Body"])
     message_receipt_handle = queue_message["ReceiptHandle"]
 
+    # Only checking the phases here since timings vary from run to run
+    timings: dict = message_contents.pop("timings")
+    assert set(timings) == {"fetch_job_info", "prepare_job", "prepared_at"}
+    assert all(value >= 0 for value in timings.values())
+
+    """S3 inputs of a listed job prefix come with their ETags"""
+    input_etags: dict = message_contents.pop("input_etags", {})
+    for object_name, etag in input_etags.items():
+        assert (
+            s3_client.head_object(Bucket=input_bucket_name, Key=object_name)[
+                "ETag"
+            ]
+            == etag
+        )
+
     """Compare queue contents with expected"""
     assert message_contents == expected_sqs_message
 
@@ -538,6 +584,12 @@ def test_interpret_job_submission_success(
     for output_file in status_object_data[job_type]["outputFiles"]:
         assert object_exists(s3_client, output_bucket_name, output_file)
 
+    # Check that renamed input files are not copied within S3
+    for file_name in expected_sqs_message.get("input_renames", {}).values():
+        assert not object_exists(
+            s3_client, input_bucket_name, f"{job_tag}/{file_name}"
+        )
+
     # Only checking type here since startTime is determined at runtime
     assert isinstance(status_object_data[job_type]["startTime"], float)
     assert status_object_data[job_type]["endTime"] is None
@@ -553,3 +605,624 @@ def test_interpret_job_submission_success(
     job_service.JOB_QUEUE_REGION = original_JOB_QUEUE_REGION
     job_service.VERSION_BUCKET = original_VERSION_BUCKET
     job_service.VERSION_KEY = original_VERSION_KEY
+
+
+@mock_aws
+def test_interpret_job_submission_all_records():
+    """Every record of a batched S3 event is interpreted and queued."""
+    input_bucket_name = "pytest_input_bucket"
+    output_bucket_name = "pytest_output_bucket"
+    version_bucket_name = "pytest_version_bucket"
+    version_object_key = "info/versions.json"
+    queue_name = "pytest_sqs_job_queue"
+    region_name = "us-west-2"
+
+    s3_client, sqs_client = initialize_s3_and_sqs_clients(
+        input_bucket_name, output_bucket_name, queue_name, region_name
+    )
+    create_version_bucket_and_file(
+        version_bucket_name, region_name, version_object_key
+    )
+
+    # Retrieve original global variable names from module
+    original_OUTPUT_BUCKET = job_service.OUTPUT_BUCKET
+    original_SQS_QUEUE_NAME = job_service.SQS_QUEUE_NAME
+    original_JOB_QUEUE_REGION = job_service.JOB_QUEUE_REGION
+    original_VERSION_BUCKET = job_service.VERSION_BUCKET
+    original_VERSION_KEY = job_service.VERSION_KEY
+
+    # More runnable jobs than fit in one SQS batch, plus a missing one
+    job_info: dict = INPUT_JOB_LIST[2]["job"]
+    job_object_names = [
+        f"2021-05-16/sampleId{index:02d}/pdb2pqr-sample-job.json"
+        for index in range(job_service.SQS_BATCH_SIZE + 1)
+    ]
+    for job_object_name in job_object_names:
+        upload_data(
+            s3_client, input_bucket_name, job_object_name, dumps(job_info)
+        )
+    missing_object_name = "2021-05-16/missingId/pdb2pqr-sample-job.json"
+    s3_event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": input_bucket_name},
+                    "object": {"key": object_name},
+                }
+            }
+            for object_name in job_object_names + [missing_object_name]
+        ]
+    }
+
+    # Set module globals and interpret the batched trigger
+    job_service.SQS_QUEUE_NAME = queue_name
+    job_service.OUTPUT_BUCKET = output_bucket_name
+    job_service.JOB_QUEUE_REGION = region_name
+    job_service.VERSION_BUCKET = version_bucket_name
+    job_service.VERSION_KEY = version_object_key
+    outcomes: dict = job_service.interpret_job_submission(s3_event, None)
+
+    """Each record has an outcome; only the missing one failed"""
+    assert outcomes == {
+        **{object_name: "queued" for object_name in job_object_names},
+        missing_object_name: "error",
+    }
+
+    """Every runnable job was queued exactly once"""
+    queue_url: str = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
+    job_tags = []
+    while True:
+        queue_message_response = sqs_client.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10
+        )
+        if "Messages" not in queue_message_response:
+            break
+        for queue_message in queue_message_response["Messages"]:
+            job_tags.append(loads(queue_message["Body"])["job_tag"])
+            sqs_client.delete_message(
+                QueueUrl=queue_url,
+                ReceiptHandle=queue_message["ReceiptHandle"],
+            )
+    assert sorted(job_tags) == sorted(
+        object_name.rsplit("/", 1)[0] for object_name in job_object_names
+    )
+
+    """The job that could not be prepared is marked as failed"""
+    status_object_data: dict = loads(
+        download_data(
+            s3_client,
+            output_bucket_name,
+            "2021-05-16/missingId/pdb2pqr-status.json",
+        )
+    )
+    assert status_object_data["pdb2pqr"]["status"] == "failed"
+    assert status_object_data["pdb2pqr"]["endTime"] is not None
+
+    """A job whose failure can't be recorded makes Lambda retry the event"""
+    job_service.OUTPUT_BUCKET = "missing_output_bucket"
+    with pytest.raises(RuntimeError, match="missingId"):
+        job_service.interpret_job_submission(
+            {"Records": s3_event["Records"][-1:]}, None
+        )
+
+    # Reset module global variables to original state
+    job_service.SQS_QUEUE_NAME = original_SQS_QUEUE_NAME
+    job_service.OUTPUT_BUCKET = original_OUTPUT_BUCKET
+    job_service.JOB_QUEUE_REGION = original_JOB_QUEUE_REGION
+    job_service.VERSION_BUCKET = original_VERSION_BUCKET
+    job_service.VERSION_KEY = original_VERSION_KEY
+
+
+@mock_aws
+def test_interpret_job_submission_result_cache():
+    """A repeat of a finished job reuses its outputs instead of queueing."""
+    input_bucket_name = "pytest_input_bucket"
+    output_bucket_name = "pytest_output_bucket"
+    version_bucket_name = "pytest_version_bucket"
+    version_object_key = "info/versions.json"
+    queue_name = "pytest_sqs_job_queue"
+    region_name = "us-west-2"
+
+    s3_client, sqs_client = initialize_s3_and_sqs_clients(
+        input_bucket_name, output_bucket_name, queue_name, region_name
+    )
+    create_version_bucket_and_file(
+        version_bucket_name, region_name, version_object_key
+    )
+
+    # Retrieve original global variable names from module
+    original_OUTPUT_BUCKET = job_service.OUTPUT_BUCKET
+    original_SQS_QUEUE_NAME = job_service.SQS_QUEUE_NAME
+    original_JOB_QUEUE_REGION = job_service.JOB_QUEUE_REGION
+    original_VERSION_BUCKET = job_service.VERSION_BUCKET
+    original_VERSION_KEY = job_service.VERSION_KEY
+    original_RESULT_CACHE_DAYS = job_service.RESULT_CACHE_DAYS
+
+    job_service.SQS_QUEUE_NAME = queue_name
+    job_service.OUTPUT_BUCKET = output_bucket_name
+    job_service.JOB_QUEUE_REGION = region_name
+    job_service.VERSION_BUCKET = version_bucket_name
+    job_service.VERSION_KEY = version_object_key
+    job_service.RESULT_CACHE_DAYS = 7
+
+    def submit(job_id: str) -> dict:
+        job_object_name = f"2021-05-16/{job_id}/pdb2pqr-sample-job.json"
+        upload_data(
+            s3_client,
+            input_bucket_name,
+            job_object_name,
+            dumps(INPUT_JOB_LIST[2]["job"]),
+        )
+        return job_service.interpret_job_submission(
+            {
+                "Records": [
+                    {
+                        "s3": {
+                            "bucket": {"name": input_bucket_name},
+                            "object": {"key": job_object_name},
+                        }
+                    }
+                ]
+            },
+            None,
+        )[job_object_name]
+
+    # The first job is queued with its cache key
+    assert submit("firstId") == "queued"
+    queue_url: str = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
+    queue_message = sqs_client.receive_message(
+        QueueUrl=queue_url, MaxNumberOfMessages=1
+    )["Messages"][0]
+    sqs_client.delete_message(
+        QueueUrl=queue_url, ReceiptHandle=queue_message["ReceiptHandle"]
+    )
+    cache_key: str = loads(queue_message["Body"])["result_cache_key"]
+
+    # Outputs and manifest, as the worker would write them
+    first_outputs = {
+        "2021-05-16/firstId/firstId.pqr": "ATOM      1  N   ALA",
+        "2021-05-16/firstId/firstId.in": "read\n  mol pqr firstId.pqr\nend",
+    }
+    for object_name, contents in first_outputs.items():
+        upload_data(s3_client, output_bucket_name, object_name, contents)
+    upload_data(
+        s3_client,
+        input_bucket_name,
+        f"result-cache/{cache_key}.json",
+        dumps(
+            {
+                "job_tag": "2021-05-16/firstId",
+                "job_id": "firstId",
+                "job_type": "pdb2pqr",
+                "output_files": list(first_outputs),
+                "created": time(),
+            }
+        ),
+    )
+
+    # The repeat job is complete without being queued
+    assert submit("secondId") == "not queued"
+    assert "Messages" not in sqs_client.receive_message(
+        QueueUrl=queue_url, MaxNumberOfMessages=1
+    )
+    status_object_data: dict = loads(
+        download_data(
+            s3_client,
+            output_bucket_name,
+            "2021-05-16/secondId/pdb2pqr-status.json",
+        )
+    )
+    assert status_object_data["pdb2pqr"]["status"] == "complete"
+    assert isinstance(status_object_data["pdb2pqr"]["endTime"], float)
+    assert status_object_data["pdb2pqr"]["outputFiles"] == [
+        "2021-05-16/secondId/secondId.pqr",
+        "2021-05-16/secondId/secondId.in",
+    ]
+    assert (
+        download_data(
+            s3_client, output_bucket_name, "2021-05-16/secondId/secondId.in"
+        )
+        == b"read\n  mol pqr secondId.pqr\nend"
+    )
+
+    # Reset module global variables to original state
+    job_service.SQS_QUEUE_NAME = original_SQS_QUEUE_NAME
+    job_service.OUTPUT_BUCKET = original_OUTPUT_BUCKET
+    job_service.JOB_QUEUE_REGION = original_JOB_QUEUE_REGION
+    job_service.VERSION_BUCKET = original_VERSION_BUCKET
+    job_service.VERSION_KEY = original_VERSION_KEY
+    job_service.RESULT_CACHE_DAYS = original_RESULT_CACHE_DAYS
+
+
+def test_choose_lane():
+    """Jobs go to the first lane whose criteria they meet."""
+    original_JOB_QUEUE_LANES = job_service.JOB_QUEUE_LANES
+    job_service.JOB_QUEUE_LANES = [
+        {
+            "name": "small",
+            "queue": "small-q",
+            "job_types": ["pdb2pqr"],
+            "max_runtime": 900,
+        },
+        {"name": "medium", "queue": "medium-q", "max_memory_mb": 4096},
+    ]
+
+    def estimate(runtime_seconds: float, memory_mb: float):
+        return job_service.estimator.Estimate(
+            runtime_seconds, memory_mb, runtime_seconds, memory_mb
+        )
+
+    assert job_service.choose_lane("pdb2pqr", None) == "small"
+    assert job_service.choose_lane("pdb2pqr", estimate(10, 100)) == "small"
+    assert job_service.choose_lane("pdb2pqr", estimate(1000, 100)) == "medium"
+    assert job_service.choose_lane("apbs", estimate(10, 100)) == "medium"
+    assert (
+        job_service.choose_lane("apbs", estimate(10, 8192))
+        == job_service.DEFAULT_LANE
+    )
+    assert job_service.get_lane_queue_name("medium") == "medium-q"
+    assert (
+        job_service.get_lane_queue_name(job_service.DEFAULT_LANE)
+        == job_service.SQS_QUEUE_NAME
+    )
+
+    job_service.JOB_QUEUE_LANES = original_JOB_QUEUE_LANES
+
+
+@mock_aws
+def test_interpret_job_submission_lane():
+    """Jobs are sent to the queue of their lane."""
+    input_bucket_name = "pytest_input_bucket"
+    output_bucket_name = "pytest_output_bucket"
+    version_bucket_name = "pytest_version_bucket"
+    version_object_key = "info/versions.json"
+    queue_name = "pytest_sqs_job_queue"
+    small_queue_name = "pytest_sqs_job_queue_small"
+    region_name = "us-west-2"
+
+    s3_client, sqs_client = initialize_s3_and_sqs_clients(
+        input_bucket_name, output_bucket_name, queue_name, region_name
+    )
+    sqs_client.create_queue(QueueName=small_queue_name)
+    create_version_bucket_and_file(
+        version_bucket_name, region_name, version_object_key
+    )
+
+    # Retrieve original global variable names from module
+    original_OUTPUT_BUCKET = job_service.OUTPUT_BUCKET
+    original_SQS_QUEUE_NAME = job_service.SQS_QUEUE_NAME
+    original_JOB_QUEUE_REGION = job_service.JOB_QUEUE_REGION
+    original_VERSION_BUCKET = job_service.VERSION_BUCKET
+    original_VERSION_KEY = job_service.VERSION_KEY
+    original_JOB_QUEUE_LANES = job_service.JOB_QUEUE_LANES
+
+    job_service.SQS_QUEUE_NAME = queue_name
+    job_service.OUTPUT_BUCKET = output_bucket_name
+    job_service.JOB_QUEUE_REGION = region_name
+    job_service.VERSION_BUCKET = version_bucket_name
+    job_service.VERSION_KEY = version_object_key
+    job_service.JOB_QUEUE_LANES = [
+        {"name": "small", "queue": small_queue_name, "job_types": ["pdb2pqr"]}
+    ]
+
+    job_object_name = "2021-05-16/sampleId/pdb2pqr-sample-job.json"
+    upload_data(
+        s3_client,
+        input_bucket_name,
+        job_object_name,
+        dumps(INPUT_JOB_LIST[2]["job"]),
+    )
+    job_service.interpret_job_submission(
+        {
+            "Records": [
+                {
+                    "s3": {
+                        "bucket": {"name": input_bucket_name},
+                        "object": {"key": job_object_name},
+                    }
+                }
+            ]
+        },
+        None,
+    )
+
+    """The PDB2PQR job is in the small queue only"""
+    for name, expected in ((queue_name, False), (small_queue_name, True)):
+        queue_url: str = sqs_client.get_queue_url(QueueName=name)["QueueUrl"]
+        queue_message_response = sqs_client.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=1
+        )
+        assert ("Messages" in queue_message_response) == expected
+    message_contents: dict = loads(
+        queue_message_response["Messages"][0]["Body"]
+    )
+    assert message_contents["lane"] == "small"
+
+    # Reset module global variables to original state
+    job_service.SQS_QUEUE_NAME = original_SQS_QUEUE_NAME
+    job_service.OUTPUT_BUCKET = original_OUTPUT_BUCKET
+    job_service.JOB_QUEUE_REGION = original_JOB_QUEUE_REGION
+    job_service.VERSION_BUCKET = original_VERSION_BUCKET
+    job_service.VERSION_KEY = original_VERSION_KEY
+    job_service.JOB_QUEUE_LANES = original_JOB_QUEUE_LANES
+
+
+@mock_aws
+def test_interpret_job_submission_rollback(caplog: pytest.LogCaptureFixture):
+    """A job that can't be enqueued has its status rolled back."""
+    input_bucket_name = "pytest_input_bucket"
+    output_bucket_name = "pytest_output_bucket"
+    version_bucket_name = "pytest_version_bucket"
+    version_object_key = "info/versions.json"
+    queue_name = "pytest_sqs_job_queue"
+    region_name = "us-west-2"
+
+    s3_client, sqs_client = initialize_s3_and_sqs_clients(
+        input_bucket_name, output_bucket_name, queue_name, region_name
+    )
+    create_version_bucket_and_file(
+        version_bucket_name, region_name, version_object_key
+    )
+
+    # Retrieve original global variable names from module
+    original_OUTPUT_BUCKET = job_service.OUTPUT_BUCKET
+    original_SQS_QUEUE_NAME = job_service.SQS_QUEUE_NAME
+    original_JOB_QUEUE_REGION = job_service.JOB_QUEUE_REGION
+    original_VERSION_BUCKET = job_service.VERSION_BUCKET
+    original_VERSION_KEY = job_service.VERSION_KEY
+    original_JOB_QUEUE_LANES = job_service.JOB_QUEUE_LANES
+
+    job_service.SQS_QUEUE_NAME = queue_name
+    job_service.OUTPUT_BUCKET = output_bucket_name
+    job_service.JOB_QUEUE_REGION = region_name
+    job_service.VERSION_BUCKET = version_bucket_name
+    job_service.VERSION_KEY = version_object_key
+    # PDB2PQR jobs go to a queue that doesn't exist
+    job_service.JOB_QUEUE_LANES = [
+        {"name": "small", "queue": "missing_queue", "job_types": ["pdb2pqr"]}
+    ]
+    job_service.invalidate_caches()
+
+    job_object_name = "2021-05-16/sampleId/pdb2pqr-sample-job.json"
+    upload_data(
+        s3_client,
+        input_bucket_name,
+        job_object_name,
+        dumps(INPUT_JOB_LIST[2]["job"]),
+    )
+    outcomes = job_service.interpret_job_submission(
+        {
+            "Records": [
+                {
+                    "s3": {
+                        "bucket": {"name": input_bucket_name},
+                        "object": {"key": job_object_name},
+                    }
+                }
+            ]
+        },
+        None,
+    )
+
+    """The job is reported as failed, not left pending"""
+    assert outcomes[job_object_name] == "error"
+    status_object_data: dict = loads(
+        download_data(
+            s3_client,
+            output_bucket_name,
+            "2021-05-16/sampleId/pdb2pqr-status.json",
+        )
+    )
+    assert status_object_data["pdb2pqr"]["status"] == "failed"
+    assert "queued" in status_object_data["pdb2pqr"]["message"]
+    assert status_object_data["pdb2pqr"]["endTime"] is not None
+    """No enqueue timing is logged for the unsent job"""
+    assert "Submission timings" not in caplog.text
+
+    # Reset module global variables to original state
+    job_service.SQS_QUEUE_NAME = original_SQS_QUEUE_NAME
+    job_service.OUTPUT_BUCKET = original_OUTPUT_BUCKET
+    job_service.JOB_QUEUE_REGION = original_JOB_QUEUE_REGION
+    job_service.VERSION_BUCKET = original_VERSION_BUCKET
+    job_service.VERSION_KEY = original_VERSION_KEY
+    job_service.JOB_QUEUE_LANES = original_JOB_QUEUE_LANES
+    job_service.invalidate_caches()
+
+
+@mock_aws
+@pytest.mark.parametrize(
+    "existing_status,expected_outcome",
+    [
+        ("pending", "queued"),
+        ("running", "already submitted"),
+        ("complete", "already submitted"),
+    ],
+)
+def test_interpret_job_submission_retry(
+    existing_status: str, expected_outcome: str
+):
+    """A retried event neither resets nor reruns a job that already ran."""
+    input_bucket_name = "pytest_input_bucket"
+    output_bucket_name = "pytest_output_bucket"
+    version_bucket_name = "pytest_version_bucket"
+    version_object_key = "info/versions.json"
+    queue_name = "pytest_sqs_job_queue"
+    region_name = "us-west-2"
+
+    s3_client, sqs_client = initialize_s3_and_sqs_clients(
+        input_bucket_name, output_bucket_name, queue_name, region_name
+    )
+    create_version_bucket_and_file(
+        version_bucket_name, region_name, version_object_key
+    )
+
+    # Retrieve original global variable names from module
+    original_OUTPUT_BUCKET = job_service.OUTPUT_BUCKET
+    original_SQS_QUEUE_NAME = job_service.SQS_QUEUE_NAME
+    original_JOB_QUEUE_REGION = job_service.JOB_QUEUE_REGION
+    original_VERSION_BUCKET = job_service.VERSION_BUCKET
+    original_VERSION_KEY = job_service.VERSION_KEY
+
+    job_service.SQS_QUEUE_NAME = queue_name
+    job_service.OUTPUT_BUCKET = output_bucket_name
+    job_service.JOB_QUEUE_REGION = region_name
+    job_service.VERSION_BUCKET = version_bucket_name
+    job_service.VERSION_KEY = version_object_key
+    job_service.invalidate_caches()
+
+    job_object_name = "2021-05-16/sampleId/pdb2pqr-sample-job.json"
+    status_object_name = "2021-05-16/sampleId/pdb2pqr-status.json"
+    upload_data(
+        s3_client,
+        input_bucket_name,
+        job_object_name,
+        dumps(INPUT_JOB_LIST[2]["job"]),
+    )
+    s3_event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": input_bucket_name},
+                    "object": {"key": job_object_name},
+                }
+            }
+        ]
+    }
+
+    # The first try queued the job, which a worker then picked up
+    assert job_service.interpret_job_submission(s3_event, None) == {
+        job_object_name: "queued"
+    }
+    queue_url: str = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
+    queue_message = sqs_client.receive_message(
+        QueueUrl=queue_url, MaxNumberOfMessages=1
+    )["Messages"][0]
+    sqs_client.delete_message(
+        QueueUrl=queue_url, ReceiptHandle=queue_message["ReceiptHandle"]
+    )
+    status_object_data: dict = loads(
+        download_data(s3_client, output_bucket_name, status_object_name)
+    )
+    status_object_data["pdb2pqr"]["status"] = existing_status
+    upload_data(
+        s3_client,
+        output_bucket_name,
+        status_object_name,
+        dumps(status_object_data),
+    )
+
+    # Lambda retries the same event
+    assert job_service.interpret_job_submission(s3_event, None) == {
+        job_object_name: expected_outcome
+    }
+
+    """The status is left as the worker wrote it"""
+    assert (
+        loads(download_data(s3_client, output_bucket_name, status_object_name))
+        == status_object_data
+    )
+    """Only a job that may never have been sent is sent again"""
+    queue_message_response = sqs_client.receive_message(
+        QueueUrl=queue_url, MaxNumberOfMessages=1
+    )
+    assert ("Messages" in queue_message_response) == (
+        existing_status == "pending"
+    )
+
+    # Reset module global variables to original state
+    job_service.SQS_QUEUE_NAME = original_SQS_QUEUE_NAME
+    job_service.OUTPUT_BUCKET = original_OUTPUT_BUCKET
+    job_service.JOB_QUEUE_REGION = original_JOB_QUEUE_REGION
+    job_service.VERSION_BUCKET = original_VERSION_BUCKET
+    job_service.VERSION_KEY = original_VERSION_KEY
+    job_service.invalidate_caches()
+
+
+@mock_aws
+def test_interpret_job_submission_unconfirmed_send():
+    """A job whose send raised stays pending for the retry to resend."""
+    input_bucket_name = "pytest_input_bucket"
+    output_bucket_name = "pytest_output_bucket"
+    version_bucket_name = "pytest_version_bucket"
+    version_object_key = "info/versions.json"
+    queue_name = "pytest_sqs_job_queue"
+    region_name = "us-west-2"
+
+    s3_client, sqs_client = initialize_s3_and_sqs_clients(
+        input_bucket_name, output_bucket_name, queue_name, region_name
+    )
+    create_version_bucket_and_file(
+        version_bucket_name, region_name, version_object_key
+    )
+
+    # Retrieve original global variable names from module
+    original_OUTPUT_BUCKET = job_service.OUTPUT_BUCKET
+    original_SQS_QUEUE_NAME = job_service.SQS_QUEUE_NAME
+    original_JOB_QUEUE_REGION = job_service.JOB_QUEUE_REGION
+    original_VERSION_BUCKET = job_service.VERSION_BUCKET
+    original_VERSION_KEY = job_service.VERSION_KEY
+
+    job_service.SQS_QUEUE_NAME = queue_name
+    job_service.OUTPUT_BUCKET = output_bucket_name
+    job_service.JOB_QUEUE_REGION = region_name
+    job_service.VERSION_BUCKET = version_bucket_name
+    job_service.VERSION_KEY = version_object_key
+    job_service.invalidate_caches()
+    aws_clients.reset_clients()
+
+    job_object_name = "2021-05-16/sampleId/pdb2pqr-sample-job.json"
+    status_object_name = "2021-05-16/sampleId/pdb2pqr-status.json"
+    upload_data(
+        s3_client,
+        input_bucket_name,
+        job_object_name,
+        dumps(INPUT_JOB_LIST[2]["job"]),
+    )
+    s3_event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": input_bucket_name},
+                    "object": {"key": job_object_name},
+                }
+            }
+        ]
+    }
+
+    # The batch request fails with no per-message result
+    def fail_send(**kwargs):
+        raise ClientError(
+            {"Error": {"Code": "InternalError", "Message": "Timed out"}},
+            "SendMessageBatch",
+        )
+
+    aws_clients.get_client("sqs", region_name).meta.events.register(
+        "before-call.sqs.SendMessageBatch", fail_send
+    )
+    with pytest.raises(RuntimeError, match="maybe not queued"):
+        job_service.interpret_job_submission(s3_event, None)
+
+    """The job is left pending rather than rolled back"""
+    status_object_data: dict = loads(
+        download_data(s3_client, output_bucket_name, status_object_name)
+    )
+    assert status_object_data["pdb2pqr"]["status"] == "pending"
+
+    """The retried event sends it"""
+    aws_clients.reset_clients()
+    assert job_service.interpret_job_submission(s3_event, None) == {
+        job_object_name: "queued"
+    }
+    queue_url: str = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
+    queue_message = sqs_client.receive_message(
+        QueueUrl=queue_url, MaxNumberOfMessages=1
+    )["Messages"][0]
+    assert loads(queue_message["Body"])["job_tag"] == "2021-05-16/sampleId"
+
+    # Reset module global variables to original state
+    job_service.SQS_QUEUE_NAME = original_SQS_QUEUE_NAME
+    job_service.OUTPUT_BUCKET = original_OUTPUT_BUCKET
+    job_service.JOB_QUEUE_REGION = original_JOB_QUEUE_REGION
+    job_service.VERSION_BUCKET = original_VERSION_BUCKET
+    job_service.VERSION_KEY = original_VERSION_KEY
+    job_service.invalidate_caches()